@@ -1,22 +1,23 @@
 CREATE TABLE IF NOT EXISTS sensor_readings (
-    id SERIAL PRIMARY KEY,
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    id SERIAL,
+    timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     sensor_id INTEGER NOT NULL,
     temperature REAL,
     humidity REAL,
     voltage REAL,
-    ip_address VARCHAR(50)
-);
+    ip_address VARCHAR(50),
+    puid VARCHAR(64),
+    forward_queued BOOLEAN,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
 
--- Индексы для ускорения запросов
-CREATE INDEX IF NOT EXISTS idx_timestamp ON sensor_readings(timestamp);
-CREATE INDEX IF NOT EXISTS idx_sensor_id ON sensor_readings(sensor_id);
-CREATE INDEX IF NOT EXISTS idx_sensor_id_timestamp ON sensor_readings(sensor_id, timestamp);
+-- Дневные партиции создаёт и удаляет по сроку хранения korobochka.py;
+-- DEFAULT-партиция страхует вставку, если нужной партиции ещё нет
+CREATE TABLE IF NOT EXISTS sensor_readings_default PARTITION OF sensor_readings DEFAULT;
 
--- Дополнительные индексы для фильтрации по диапазонам
-CREATE INDEX IF NOT EXISTS idx_temperature ON sensor_readings(temperature) WHERE temperature IS NOT NULL;
-CREATE INDEX IF NOT EXISTS idx_humidity ON sensor_readings(humidity) WHERE humidity IS NOT NULL;
-CREATE INDEX IF NOT EXISTS idx_voltage ON sensor_readings(voltage) WHERE voltage IS NOT NULL;
+-- Единственный вторичный индекс: выборки последних показаний по датчику.
+-- Фильтры по времени отсекают партиции, поиск по id идёт по первичному ключу
+CREATE INDEX IF NOT EXISTS idx_sensor_id_timestamp ON sensor_readings(sensor_id, timestamp);
 
 -- Представление для последних показаний каждого датчика
 CREATE OR REPLACE VIEW latest_readings AS
@@ -29,4 +30,22 @@ SELECT DISTINCT ON (sensor_id)
     voltage,
     ip_address
 FROM sensor_readings
-ORDER BY sensor_id, timestamp DESC;
\ No newline at end of file
+ORDER BY sensor_id, timestamp DESC;
+
+-- Очередь на пересылку в коллектор (outbox)
+CREATE TABLE IF NOT EXISTS forward_outbox (
+    id SERIAL PRIMARY KEY,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    -- Получатель (FORWARD_NAME / FORWARD_TARGETS); NULL — основной
+    target VARCHAR(50)
+);
+
+
+-- Служебные значения пересылки (watermark досинхронизации)
+CREATE TABLE IF NOT EXISTS forward_state (
+    name VARCHAR(50) PRIMARY KEY,
+    value BIGINT NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -1,7 +1,7 @@
 # server.py
-from flask import Flask, request, jsonify
-from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float
+from flask import Flask, request, jsonify, g, Response
+from datetime import datetime, date, timedelta, timezone
+from sqlalchemy import create_engine, event, inspect, or_, Column, Integer, BigInteger, String, DateTime, Float, Text, Boolean, Index, insert, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import requests
@@ -10,8 +10,25 @@ import os
 from dotenv import load_dotenv
 import socket
 import uuid
+import json
+import queue
+import signal
+import sys
+import time
+import functools
+import re
+from collections import OrderedDict
+import logging
+from concurrent.futures import Future
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from sqlalchemy import text
 
+# Разбор показаний и обвязка логирования — общие с коллектором: в образе лежат рядом,
+# в репозитории — в remove_server/collector
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'remove_server', 'collector'))
+from reading_codec import Reading, ReadingError, parse_reading, expand_payload  # noqa: E402
+from service_common import TokenBucketLimiter, setup_logging  # noqa: E402
+
 # Загрузка переменных окружения из .env файла
 load_dotenv()
 
@@ -24,116 +41,1682 @@ DB_NAME = os.getenv('DB_NAME', 'mydatabase')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
 
+# Пул соединений с БД
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+
+# Хранилище: postgres (по умолчанию) или sqlite — встроенная БД в режиме WAL
+# для маленьких площадок, без отдельного контейнера Postgres
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'postgres').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'korobochka.db')
+USE_SQLITE = STORAGE_BACKEND == 'sqlite'
+
 FORWARD_URL = os.getenv('FORWARD_URL', '')
 
 FORWARD_TIMEOUT = int(os.getenv('FORWARD_TIMEOUT', '5'))
+# Пул пересылки: число воркеров, размер очереди в памяти,
+# сколько ждать места в очереди и как часто перечитывать outbox
+FORWARD_WORKERS = int(os.getenv('FORWARD_WORKERS', '4'))
+FORWARD_QUEUE_SIZE = int(os.getenv('FORWARD_QUEUE_SIZE', '1000'))
+FORWARD_ENQUEUE_TIMEOUT = float(os.getenv('FORWARD_ENQUEUE_TIMEOUT', '0.5'))
+FORWARD_RETRY_INTERVAL = int(os.getenv('FORWARD_RETRY_INTERVAL', '30'))
+FORWARD_DRAIN_TIMEOUT = int(os.getenv('FORWARD_DRAIN_TIMEOUT', '20'))
+# Пакетная пересылка на /data/batch коллектора: пакет уходит, когда набрано
+# FORWARD_BATCH_SIZE показаний или старейшее ждёт FORWARD_BATCH_MAX_AGE секунд.
+# FORWARD_BATCH_SIZE=1 — старый режим, по одному показанию на FORWARD_URL
+FORWARD_BATCH_SIZE = int(os.getenv('FORWARD_BATCH_SIZE', '50'))
+FORWARD_BATCH_MAX_AGE = float(os.getenv('FORWARD_BATCH_MAX_AGE', '2'))
+FORWARD_BATCH_URL = os.getenv('FORWARD_BATCH_URL') or (f"{FORWARD_URL.rstrip('/')}/batch" if FORWARD_URL else '')
+# Дополнительные получатели (резервный, staging-коллектор) — JSON-список:
+# [{"name": "backup", "url": "https://.../data", "workers": 2, "queue_size": 500, "retry_interval": 60}]
+# У каждого своя очередь, пул воркеров и outbox-записи; не заданные ключи берутся
+# из FORWARD_*. Основной получатель — FORWARD_URL под именем FORWARD_NAME
+FORWARD_NAME = os.getenv('FORWARD_NAME', 'primary')
+FORWARD_TARGETS = json.loads(os.getenv('FORWARD_TARGETS') or '[]')
+
+# Досинхронизация: показания, не попавшие в outbox (пересылка была отключена или
+# записи старше outbox), досылаются пачками по RESYNC_CHUNK_SIZE с паузой RESYNC_PAUSE.
+# Без сохранённого watermark старт с первого показания, не попавшего в outbox, —
+# так при первом включении FORWARD_URL уходит весь накопленный офлайн-архив.
+# RESYNC_START_ID=<id> — не досылать показания с id не больше заданного
+# (например, RESYNC_START_ID=<текущий max(id)>, если архив коллектору не нужен).
+# Строки, записанные до появления колонки forward_queued (NULL), коллектор уже
+# получил живой пересылкой — досылаются только явно, с RESYNC_LEGACY=True.
+# Watermark у каждого получателя свой. Получатель из FORWARD_TARGETS, добавленный
+# позже, получает только досинхронизацию; показания, ушедшие в outbox до его
+# появления, ему не досылаются
+RESYNC_ENABLED = os.getenv('RESYNC_ENABLED', 'True').lower() == 'true'
+RESYNC_CHUNK_SIZE = int(os.getenv('RESYNC_CHUNK_SIZE', '500'))
+RESYNC_PAUSE = float(os.getenv('RESYNC_PAUSE', '1'))
+RESYNC_INTERVAL = int(os.getenv('RESYNC_INTERVAL', '60'))
+RESYNC_START_ID = os.getenv('RESYNC_START_ID')
+RESYNC_LEGACY = os.getenv('RESYNC_LEGACY', 'False').lower() == 'true'
+
+# Group commit: запросы ставят строки в очередь, писатель сбрасывает их одной
+# транзакцией каждые GROUP_COMMIT_INTERVAL_MS мс или по GROUP_COMMIT_MAX_ROWS строк.
+# Ответ на запрос уходит только после commit его строки
+GROUP_COMMIT = os.getenv('GROUP_COMMIT', 'False').lower() == 'true'
+GROUP_COMMIT_INTERVAL_MS = int(os.getenv('GROUP_COMMIT_INTERVAL_MS', '20'))
+GROUP_COMMIT_MAX_ROWS = int(os.getenv('GROUP_COMMIT_MAX_ROWS', '200'))
+GROUP_COMMIT_WAIT_TIMEOUT = float(os.getenv('GROUP_COMMIT_WAIT_TIMEOUT', '10'))
+
+# Локальное хранение: дневные партиции sensor_readings, создаются на
+# PARTITION_PREMAKE_DAYS дней вперёд; партиции старше RETENTION_DAYS удаляются (0 — хранить всё)
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', '90'))
+PARTITION_PREMAKE_DAYS = int(os.getenv('PARTITION_PREMAKE_DAYS', '3'))
+PARTITION_CHECK_INTERVAL = int(os.getenv('PARTITION_CHECK_INTERVAL', '3600'))
+
+# Максимум показаний в одном пакетном запросе на /data
+MAX_BATCH_READINGS = int(os.getenv('MAX_BATCH_READINGS', '500'))
+
+# Сжатие по мёртвой зоне: показание сохраняется и пересылается, только если
+# температура или влажность ушли от последнего сохранённого дальше допуска,
+# либо с прошлого сохранения прошло COMPRESS_MAX_INTERVAL секунд (heartbeat)
+COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', 'False').lower() == 'true'
+COMPRESS_TEMPERATURE = float(os.getenv('COMPRESS_TEMPERATURE', '0.2'))
+COMPRESS_HUMIDITY = float(os.getenv('COMPRESS_HUMIDITY', '0.5'))
+COMPRESS_MAX_INTERVAL = float(os.getenv('COMPRESS_MAX_INTERVAL', '300'))
+
+# Ограничение частоты (token bucket): запросов в секунду и запас на всплеск,
+# отдельно по sensor_id и по IP источника; 0 — без ограничения.
+# По умолчанию оба выключены: прошивки не умеют отступать на 429, включать — под
+# известный профиль трафика площадки (например, 1/10 по датчику и 5/30 по IP).
+# Сверх лимита — 429, при исчерпанном пуле БД — сразу 503, без ожидания соединения
+RATE_LIMIT_SENSOR = float(os.getenv('RATE_LIMIT_SENSOR', '0'))
+RATE_LIMIT_SENSOR_BURST = int(os.getenv('RATE_LIMIT_SENSOR_BURST', '10'))
+RATE_LIMIT_IP = float(os.getenv('RATE_LIMIT_IP', '0'))
+RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', '30'))
+
+# Локальное управление увлажнителями — запасной контур на случай обрыва связи с облаком.
+# CONTROL_MODE=fallback — команды, только пока коллектор не отвечает дольше
+# CONTROL_CLOUD_TIMEOUT секунд; local — всегда, на каждом показании.
+# Расписание уставок берётся с коллектора раз в CONTROL_REFRESH_INTERVAL и
+# кэшируется в CONTROL_CACHE_PATH, чтобы пережить перезапуск без связи
+CONTROL_ENABLED = os.getenv('CONTROL_ENABLED', 'False').lower() == 'true'
+CONTROL_MODE = os.getenv('CONTROL_MODE', 'fallback').lower()
+CONTROL_URL = os.getenv('CONTROL_URL') or 'http://10.0.10.2:5001/{controller_id}/{status}'
+CONTROL_SCHEDULE_URL = os.getenv('CONTROL_SCHEDULE_URL') or (
+    re.sub(r'/data/?$', '', FORWARD_URL.rstrip('/')) + '/settings/{sensor_id}/schedule' if FORWARD_URL else ''
+)
+CONTROL_CACHE_PATH = os.getenv('CONTROL_CACHE_PATH', 'control_schedule.json')
+CONTROL_REFRESH_INTERVAL = int(os.getenv('CONTROL_REFRESH_INTERVAL', '300'))
+CONTROL_CLOUD_TIMEOUT = int(os.getenv('CONTROL_CLOUD_TIMEOUT', '180'))
+# Показания старше CONTROL_MAX_AGE секунд (буферизованные) решений не вызывают
+CONTROL_MAX_AGE = int(os.getenv('CONTROL_MAX_AGE', '120'))
+# Неизменившуюся команду повторяем не чаще, чем раз в CONTROL_RESEND_INTERVAL секунд
+CONTROL_RESEND_INTERVAL = int(os.getenv('CONTROL_RESEND_INTERVAL', '60'))
+CONTROL_TIMEOUT = float(os.getenv('CONTROL_TIMEOUT', '5'))
+
+# UDP-приём строк "sensor_id,puid,temperature,humidity[,voltage]" (по строке на показание).
+# UDP_PORT=0 — выключено. Повторы отсекаются по puid среди последних UDP_DEDUP_SIZE
+UDP_HOST = os.getenv('UDP_HOST', '0.0.0.0')
+UDP_PORT = int(os.getenv('UDP_PORT', '0'))
+UDP_DEDUP_SIZE = int(os.getenv('UDP_DEDUP_SIZE', '10000'))
+UDP_MAX_ROWS = int(os.getenv('UDP_MAX_ROWS', '200'))
 
 APP_HOST = os.getenv('APP_HOST', '0.0.0.0')
 APP_PORT = int(os.getenv('APP_PORT', '5000'))
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 
+# === ЛОГИРОВАНИЕ ===
+# Запись в stdout (драйвер логов docker) идёт из отдельного потока через очередь:
+# запросы только кладут запись в очередь и никогда не ждут stdout. Записи с
+# sensor_id ниже WARNING сэмплируются и ограничиваются по частоте на датчик;
+# предупреждения и ошибки пропускаются всегда.
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# В лог попадает каждое LOG_SAMPLE_EVERY-е сообщение датчика (1 — все)
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '1'))
+# Не больше LOG_RATE_PER_SENSOR сообщений в минуту на датчик (0 — без ограничения)
+LOG_RATE_PER_SENSOR = int(os.getenv('LOG_RATE_PER_SENSOR', '30'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Access-лог HTTP-сервера (по строке на запрос); по умолчанию выключен
+LOG_ACCESS = os.getenv('LOG_ACCESS', 'False').lower() == 'true'
+
+
+logger = setup_logging('korobochka', LOG_LEVEL, LOG_SAMPLE_EVERY, LOG_RATE_PER_SENSOR, LOG_QUEUE_SIZE)
+# Access-лог werkzeug — через ту же очередь
+access_logger = logging.getLogger('werkzeug')
+access_logger.setLevel(logging.INFO if LOG_ACCESS else logging.WARNING)
+for _handler in logger.handlers:
+    access_logger.addHandler(_handler)
+access_logger.propagate = False
+
+# === МЕТРИКИ ===
+# Prometheus-метрики для /metrics: задержки запросов и commit, исходы пересылки,
+# глубина очереди и число пересылок в полёте.
+
+REQUEST_SECONDS = Histogram(
+    'korobochka_request_duration_seconds', 'Время обработки HTTP-запроса', ['route', 'method', 'status']
+)
+DB_COMMIT_SECONDS = Histogram('korobochka_db_commit_seconds', 'Время commit транзакции записи показаний')
+READINGS_INSERTED = Counter('korobochka_readings_inserted_total', 'Показаний записано в локальную БД')
+FORWARD_ITEMS = Counter(
+    'korobochka_forward_items_total', 'Исходы пересылки показаний в коллектор', ['target', 'result']
+)
+FORWARD_REQUEST_SECONDS = Histogram(
+    'korobochka_forward_request_seconds', 'Время HTTP-запроса пересылки в коллектор', ['target', 'endpoint']
+)
+FORWARD_INFLIGHT = Gauge('korobochka_forward_inflight', 'Пересылок выполняется прямо сейчас', ['target'])
+FORWARD_QUEUE_DEPTH = Gauge('korobochka_forward_queue_depth', 'Глубина очереди пересылки в памяти', ['target'])
+READINGS_COMPRESSED = Counter('korobochka_readings_compressed_total', 'Показания, отброшенные сжатием')
+CONTROL_COMMANDS = Counter(
+    'korobochka_control_commands_total', 'Команды увлажнителям от локального контура', ['status', 'result']
+)
+REQUESTS_SHED = Counter('korobochka_requests_shed_total', 'Запросы, сброшенные без записи', ['reason'])
+UDP_LINES = Counter('korobochka_udp_lines_total', 'Строки UDP-протокола по исходу', ['result'])
+
 # Строка подключения к БД
-DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+if USE_SQLITE:
+    DATABASE_URL = f"sqlite:///{SQLITE_PATH}"
+    DB_LABEL = f"sqlite:{SQLITE_PATH}"
+else:
+    DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+    DB_LABEL = f"{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 # Инициализация БД
-engine = create_engine(DATABASE_URL, pool_size=5, max_overflow=10)
+if USE_SQLITE:
+    # Писатель в SQLite один: остальные ждут блокировку до timeout секунд
+    engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                           connect_args={"check_same_thread": False, "timeout": 30})
+
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, connection_record):
+        """WAL: чтение не блокирует запись; synchronous=NORMAL — fsync только на checkpoint"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+else:
+    engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
 Base = declarative_base()
 
 class SensorReading(Base):
     __tablename__ = 'sensor_readings'
+    # Партиционирование по дням; ключ партиции обязан входить в первичный ключ.
+    # Из индексов оставлен только нужный /latest-выборкам (sensor_id, timestamp).
+    # В SQLite партиций нет, а автоинкремент возможен только у одиночного ключа;
+    # AUTOINCREMENT не даёт переиспользовать id, на которых держится watermark
+    __table_args__ = (
+        Index('idx_sensor_id_timestamp', 'sensor_id', 'timestamp'),
+        {'postgresql_partition_by': 'RANGE (timestamp)', 'sqlite_autoincrement': True},
+    )
     
-    id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, default=datetime.now)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    timestamp = Column(DateTime, primary_key=not USE_SQLITE, nullable=False, default=datetime.now)
     sensor_id = Column(Integer, nullable=False)
     temperature = Column(Float)
     humidity = Column(Float)
     voltage = Column(Float)
     ip_address = Column(String(50))
+    puid = Column(String(64))
+    # Поставлено ли показание в outbox при записи; NULL/False — кандидат на resync
+    forward_queued = Column(Boolean)
+
+class ForwardOutbox(Base):
+    """Очередь на пересылку: запись живёт, пока коллектор не подтвердит приём"""
+    __tablename__ = 'forward_outbox'
+
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, default=datetime.now)
+    payload = Column(Text, nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    # Имя получателя; NULL — записи до появления нескольких получателей (основной)
+    target = Column(String(50))
+
+class ForwardState(Base):
+    """Служебные значения пересылки (watermark досинхронизации)"""
+    __tablename__ = 'forward_state'
+
+    name = Column(String(50), primary_key=True)
+    value = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
 
 # Создание таблиц
 Base.metadata.create_all(engine)
+# create_all не меняет существующие таблицы — досоздаём новые колонки
+# (в SQLite нет ADD COLUMN IF NOT EXISTS — проверяем по схеме)
+if not USE_SQLITE:
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE sensor_readings ADD COLUMN IF NOT EXISTS puid VARCHAR(64)"))
+        conn.execute(text("ALTER TABLE sensor_readings ADD COLUMN IF NOT EXISTS forward_queued BOOLEAN"))
+        conn.execute(text("ALTER TABLE forward_outbox ADD COLUMN IF NOT EXISTS target VARCHAR(50)"))
+elif 'target' not in {column['name'] for column in inspect(engine).get_columns('forward_outbox')}:
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE forward_outbox ADD COLUMN target VARCHAR(50)"))
 Session = sessionmaker(bind=engine)
 
-def forward_data(data):
-    """Пересылка данных в фоновом потоке"""
-    if not FORWARD_URL:
-        print("⚠️ FORWARD_URL не настроен, пересылка отключена")
+# === ПАРТИЦИИ ===
+
+PARTITION_NAME_RE = re.compile(r'^sensor_readings_p(\d{8})$')
+
+LATEST_READINGS_VIEW = """
+    CREATE OR REPLACE VIEW latest_readings AS
+    SELECT DISTINCT ON (sensor_id)
+        id, timestamp, sensor_id, temperature, humidity, voltage, ip_address
+    FROM sensor_readings
+    ORDER BY sensor_id, timestamp DESC
+"""
+
+
+def _partition_name(day):
+    return f"sensor_readings_p{day:%Y%m%d}"
+
+
+def list_partitions(conn):
+    """Дни, для которых есть партиции sensor_readings"""
+    names = conn.execute(text("""
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'sensor_readings'
+    """)).scalars()
+    days = []
+    for name in names:
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            days.append(datetime.strptime(match.group(1), '%Y%m%d').date())
+    return sorted(days)
+
+
+def create_partition(conn, day):
+    """
+    Создаёт партицию на день. Строки этого дня, успевшие попасть в DEFAULT-партицию,
+    переносятся в новую до ATTACH, иначе Postgres не даст её присоединить.
+    """
+    name = _partition_name(day)
+    start, end = day.isoformat(), (day + timedelta(days=1)).isoformat()
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} (LIKE sensor_readings INCLUDING DEFAULTS)"))
+    conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM sensor_readings_default
+            WHERE timestamp >= '{start}' AND timestamp < '{end}'
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """))
+    conn.execute(text(f"ALTER TABLE sensor_readings ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')"))
+
+
+# Строки, которые ждёт досинхронизация: не попавшие в outbox (FALSE) и, по явному
+# запросу, старые строки без отметки (NULL)
+RESYNC_PENDING_SQL = "forward_queued IS NOT TRUE" if RESYNC_LEGACY else "forward_queued IS FALSE"
+
+
+def _resync_pending():
+    """Условие RESYNC_PENDING_SQL для запросов ORM"""
+    if RESYNC_LEGACY:
+        return SensorReading.forward_queued.isnot(True)
+    return SensorReading.forward_queued.is_(False)
+
+
+def _resync_watermark(conn):
+    """Наименьший watermark досинхронизации по получателям, если она включена и уже инициализирована"""
+    if not (FORWARD_URL and RESYNC_ENABLED):
+        return None
+    return conn.execute(text("""
+        SELECT min(value) FROM forward_state
+        WHERE name = 'resync_watermark' OR name LIKE 'resync_watermark:%'
+    """)).scalar()
+
+
+def _has_unsent_rows(conn, day):
+    """Есть ли в партиции строки, которые ещё ждёт досинхронизация"""
+    watermark = _resync_watermark(conn)
+    if watermark is None:
+        return False
+    return conn.execute(text(f"""
+        SELECT EXISTS (
+            SELECT 1 FROM {_partition_name(day)}
+            WHERE id > :watermark AND {RESYNC_PENDING_SQL}
+        )
+    """), {"watermark": watermark}).scalar()
+
+
+def prune_readings():
+    """SQLite: партиций нет — показания старше срока хранения удаляются построчно"""
+    if not RETENTION_DAYS:
         return
-        
+    cutoff = datetime.combine(date.today() - timedelta(days=RETENTION_DAYS), datetime.min.time())
+    with engine.begin() as conn:
+        query = SensorReading.__table__.delete().where(SensorReading.timestamp < cutoff)
+        watermark = _resync_watermark(conn)
+        if watermark is not None:
+            # Не досинхронизированные строки ждут отправки
+            query = query.where(or_(SensorReading.id <= watermark, ~_resync_pending()))
+        deleted = conn.execute(query).rowcount
+    if deleted:
+        logger.info("🧹 Удалено показаний старше %s: %s", cutoff.date(), deleted)
+        sensor_stats.load()
+
+
+def maintain_partitions():
+    """Создаёт партиции на сегодня и вперёд, удаляет вышедшие за срок хранения"""
+    if USE_SQLITE:
+        return prune_readings()
+    today = date.today()
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS sensor_readings_default PARTITION OF sensor_readings DEFAULT"))
+        existing = set(list_partitions(conn))
+        for offset in range(PARTITION_PREMAKE_DAYS + 1):
+            day = today + timedelta(days=offset)
+            if day not in existing:
+                create_partition(conn, day)
+                logger.info("🗂️ Создана партиция %s", _partition_name(day))
+    if not RETENTION_DAYS:
+        return
+    cutoff = today - timedelta(days=RETENTION_DAYS)
+    dropped = False
+    for day in existing:
+        if day >= cutoff:
+            continue
+        # Каждая партиция — в своей транзакции, чтобы не держать блокировку родителя долго
+        with engine.begin() as conn:
+            if _has_unsent_rows(conn, day):
+                logger.warning("⚠️ Партиция %s старше срока хранения, но не досинхронизирована", _partition_name(day))
+                continue
+            conn.execute(text(f"DROP TABLE IF EXISTS {_partition_name(day)}"))
+        dropped = True
+        logger.info("🧹 Удалена партиция %s", _partition_name(day))
+    # Удалённые строки входили в агрегаты /stats — пересчитываем
+    if dropped:
+        sensor_stats.load()
+
+
+def migrate_to_partitions():
+    """
+    Однократно переводит старую обычную таблицу sensor_readings на дневные партиции.
+    Строки копируются целиком, лишние индексы не переносятся; старое удаляет
+    maintain_partitions по сроку хранения.
+    """
+    if USE_SQLITE:
+        return
+    with engine.begin() as conn:
+        relkind = conn.execute(text(
+            "SELECT relkind FROM pg_class WHERE relname = 'sensor_readings' AND relnamespace = 'public'::regnamespace"
+        )).scalar()
+        if relkind != 'r':
+            return
+        logger.warning("🗂️ Перевод sensor_readings на дневные партиции...")
+        conn.execute(text("DROP VIEW IF EXISTS latest_readings"))
+        conn.execute(text("ALTER TABLE sensor_readings RENAME TO sensor_readings_legacy"))
+        for index in ('idx_timestamp', 'idx_sensor_id', 'idx_sensor_id_timestamp',
+                      'idx_temperature', 'idx_humidity', 'idx_voltage'):
+            conn.execute(text(f"DROP INDEX IF EXISTS {index}"))
+        SensorReading.__table__.create(conn)
+        conn.execute(text("CREATE TABLE sensor_readings_default PARTITION OF sensor_readings DEFAULT"))
+
+        first_day, last_day = conn.execute(text(
+            "SELECT MIN(timestamp)::date, MAX(timestamp)::date FROM sensor_readings_legacy"
+        )).one()
+        day = first_day
+        while day is not None and day <= last_day:
+            create_partition(conn, day)
+            day += timedelta(days=1)
+
+        columns = "id, timestamp, sensor_id, temperature, humidity, voltage, ip_address, puid, forward_queued"
+        copied = conn.execute(text(f"""
+            INSERT INTO sensor_readings ({columns})
+            SELECT id, COALESCE(timestamp, CURRENT_TIMESTAMP), sensor_id, temperature, humidity,
+                   voltage, ip_address, puid, forward_queued
+            FROM sensor_readings_legacy
+        """)).rowcount
+        conn.execute(text(
+            "SELECT setval(pg_get_serial_sequence('sensor_readings', 'id'), "
+            "COALESCE((SELECT MAX(id) FROM sensor_readings), 0) + 1, false)"
+        ))
+        conn.execute(text("DROP TABLE sensor_readings_legacy"))
+        conn.execute(text(LATEST_READINGS_VIEW))
+    logger.warning("🗂️ sensor_readings переведена на партиции, перенесено строк: %s", copied)
+
+
+def partition_maintenance_worker():
+    """Фоновое обслуживание партиций раз в PARTITION_CHECK_INTERVAL секунд"""
+    while not partition_stop.wait(PARTITION_CHECK_INTERVAL):
+        try:
+            maintain_partitions()
+        except Exception as e:
+            logger.error("❌ Ошибка обслуживания партиций: %s", e)
+
+
+partition_stop = threading.Event()
+
+
+def start_partition_maintenance():
+    """Готовит партиции сразу и запускает их фоновое обслуживание"""
+    migrate_to_partitions()
+    maintain_partitions()
+    threading.Thread(target=partition_maintenance_worker, name="partitions", daemon=True).start()
+
+# === СТАТИСТИКА ===
+# Агрегаты по датчикам в памяти: обновляются при каждой записи и один раз
+# пересчитываются из БД при старте (и после удаления партиций по сроку хранения).
+# /stats и /latest отвечают без запросов к БД.
+
+STATS_FIELDS = ('temperature', 'humidity', 'voltage')
+
+
+class SensorStats:
+    """Счётчики, суммы, минимумы, максимумы и последнее показание по каждому датчику"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sensors = {}
+        # max(id) снимка последней загрузки: показания с id не больше уже в агрегатах
+        self._snapshot_id = None
+        # Показания, записанные во время загрузки; None — загрузка не идёт
+        self._replay = None
+
+    @staticmethod
+    def _empty():
+        aggregate = {"count": 0, "last": None}
+        for field in STATS_FIELDS:
+            aggregate[field] = {"count": 0, "sum": 0.0, "min": None, "max": None}
+        return aggregate
+
+    def add(self, values, reading_id):
+        """Учитывает записанное показание"""
+        with self._lock:
+            if self._snapshot_id is not None and reading_id <= self._snapshot_id:
+                return
+            if self._replay is not None:
+                self._replay.append((values, reading_id))
+            self._apply(values, reading_id)
+
+    def _apply(self, values, reading_id):
+        """Добавляет показание в агрегаты; вызывается под блокировкой"""
+        aggregate = self._sensors.get(values["sensor_id"])
+        if aggregate is None:
+            aggregate = self._sensors[values["sensor_id"]] = self._empty()
+        aggregate["count"] += 1
+        for field in STATS_FIELDS:
+            value = values.get(field)
+            if value is None:
+                continue
+            item = aggregate[field]
+            item["count"] += 1
+            item["sum"] += value
+            item["min"] = value if item["min"] is None else min(item["min"], value)
+            item["max"] = value if item["max"] is None else max(item["max"], value)
+        # Буферизованное показание из прошлого не вытесняет более свежее
+        last = aggregate["last"]
+        if last is None or values["timestamp"] >= last["timestamp"]:
+            aggregate["last"] = {
+                "id": reading_id,
+                "timestamp": values["timestamp"],
+                "temperature": values.get("temperature"),
+                "humidity": values.get("humidity"),
+                "voltage": values.get("voltage"),
+                "ip_address": values.get("ip_address"),
+            }
+
+    def load(self):
+        """
+        Пересчитывает агрегаты из БД. Запрос идёт без блокировки — приём не ждёт
+        скан таблицы; показания, записанные за это время, досчитываются по id.
+        """
+        columns = ", ".join(
+            f"COUNT({f}), SUM({f}), MIN({f}), MAX({f})" for f in STATS_FIELDS
+        )
+        with self._lock:
+            self._replay = []
+        try:
+            with engine.connect() as conn:
+                sensors = {}
+                snapshot_id = 0
+                for row in conn.execute(text(f"""
+                    SELECT sensor_id, MAX(id), COUNT(*), {columns}
+                    FROM sensor_readings
+                    GROUP BY sensor_id
+                """)):
+                    snapshot_id = max(snapshot_id, row[1])
+                    aggregate = sensors[row[0]] = self._empty()
+                    aggregate["count"] = row[2]
+                    for i, field in enumerate(STATS_FIELDS):
+                        count, total, low, high = row[3 + i * 4: 7 + i * 4]
+                        aggregate[field] = {"count": count, "sum": float(total or 0), "min": low, "max": high}
+                # Без DISTINCT ON — запрос общий для Postgres и SQLite;
+                # тип timestamp указан явно: SQLite сам вернёт строку
+                for row in conn.execute(text("""
+                    SELECT r.id, r.timestamp, r.sensor_id, r.temperature, r.humidity, r.voltage, r.ip_address
+                    FROM sensor_readings r
+                    JOIN (
+                        SELECT sensor_id, MAX(timestamp) AS timestamp
+                        FROM sensor_readings
+                        GROUP BY sensor_id
+                    ) l ON l.sensor_id = r.sensor_id AND l.timestamp = r.timestamp
+                """).columns(timestamp=DateTime)).mappings():
+                    if row["sensor_id"] in sensors:
+                        sensors[row["sensor_id"]]["last"] = {
+                            key: row[key] for key in ("id", "timestamp", "temperature", "humidity", "voltage", "ip_address")
+                        }
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+        with self._lock:
+            replay, self._replay = self._replay, None
+            self._sensors = sensors
+            self._snapshot_id = snapshot_id
+            # Записанное после снимка в агрегаты ещё не попало
+            for values, reading_id in replay:
+                if reading_id > snapshot_id:
+                    self._apply(values, reading_id)
+        logger.info("📊 Статистика загружена: датчиков %d", len(sensors))
+
+    def sensor_ids(self):
+        """Датчики, от которых есть показания"""
+        with self._lock:
+            return list(self._sensors)
+
+    def stats(self):
+        """Сводка по датчикам в формате бывшего /stats"""
+        with self._lock:
+            result = []
+            for sensor_id in sorted(self._sensors):
+                aggregate = self._sensors[sensor_id]
+                item = {"sensor_id": sensor_id, "readings_count": aggregate["count"]}
+                for field in STATS_FIELDS:
+                    values = aggregate[field]
+                    item[f"avg_{field}"] = round(values["sum"] / values["count"], 2) if values["count"] else None
+                    item[f"min_{field}"] = values["min"]
+                    item[f"max_{field}"] = values["max"]
+                last = aggregate["last"]
+                item["last_reading"] = last["timestamp"].isoformat() if last else None
+                result.append(item)
+            return result
+
+    def latest(self):
+        """Последнее показание каждого датчика"""
+        with self._lock:
+            return [
+                {"sensor_id": sensor_id, **last, "timestamp": last["timestamp"].isoformat()}
+                for sensor_id, last in sorted(
+                    (sensor_id, aggregate["last"]) for sensor_id, aggregate in self._sensors.items()
+                )
+                if last is not None
+            ]
+
+
+sensor_stats = SensorStats()
+
+# === ЛОКАЛЬНОЕ УПРАВЛЕНИЕ ===
+# Решение принимается на каждом свежем показании той же гистерезисной логикой,
+# что у control_humidifier_job во front (день недели и час — по UTC, id
+# контроллера = sensor_id), команда уходит в controller_manager по локальной сети.
+# В режиме fallback, пока коллектор отвечает, управляет облако, а локальное
+# состояние сбрасывается: при перехвате решение начинается с начального правила.
+
+# Момент последнего ответа коллектора (time.monotonic); старт считается ответом
+cloud_seen_at = time.monotonic()
+
+
+def mark_cloud_ok():
+    """Коллектор ответил — облако на связи"""
+    global cloud_seen_at
+    cloud_seen_at = time.monotonic()
+
+
+def cloud_available():
+    """Облако отвечало не дольше CONTROL_CLOUD_TIMEOUT секунд назад"""
+    return bool(FORWARD_URL) and time.monotonic() - cloud_seen_at < CONTROL_CLOUD_TIMEOUT
+
+
+class HumidityControl:
+    """Кэш недельных расписаний (7×24 уставки) и состояние увлажнителей"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schedules = {}
+        # sensor_id -> ETag расписания: неизменившееся коллектор отдаёт как 304
+        self._etags = {}
+        # controller_id -> (ON/OFF, time.monotonic() последней команды)
+        self._status = {}
+        self._commands = queue.Queue(maxsize=100)
+
+    def load_cache(self):
+        """Расписания, сохранённые при прошлой связи с облаком"""
+        try:
+            with open(CONTROL_CACHE_PATH) as f:
+                schedules = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("⚠️ Не удалось прочитать кэш расписаний %s: %s", CONTROL_CACHE_PATH, e)
+            return
+        with self._lock:
+            self._schedules = {int(sensor_id): schedule for sensor_id, schedule in schedules.items()}
+        logger.info("🗓️ Расписания из кэша: датчиков %d", len(self._schedules))
+
+    def _save_cache(self):
+        with self._lock:
+            schedules = dict(self._schedules)
+        tmp_path = f"{CONTROL_CACHE_PATH}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(schedules, f)
+        os.replace(tmp_path, CONTROL_CACHE_PATH)
+
+    def refresh(self, http):
+        """Обновляет расписания известных датчиков с коллектора"""
+        with self._lock:
+            sensor_ids = set(self._schedules)
+        sensor_ids.update(sensor_stats.sensor_ids())
+        changed = False
+        for sensor_id in sorted(sensor_ids):
+            with self._lock:
+                etag = self._etags.get(sensor_id)
+            response = http.get(CONTROL_SCHEDULE_URL.format(sensor_id=sensor_id), timeout=FORWARD_TIMEOUT,
+                                headers={"If-None-Match": etag} if etag else None)
+            if response.status_code == 404:
+                continue
+            if response.status_code == 304:
+                mark_cloud_ok()
+                continue
+            response.raise_for_status()
+            mark_cloud_ok()
+            schedule = response.json()["schedule"]
+            with self._lock:
+                if response.headers.get("ETag"):
+                    self._etags[sensor_id] = response.headers["ETag"]
+                if self._schedules.get(sensor_id) != schedule:
+                    self._schedules[sensor_id] = schedule
+                    changed = True
+        if changed:
+            self._save_cache()
+            logger.info("🗓️ Расписания обновлены")
+
+    def observe(self, values):
+        """Гистерезис по свежему показанию; команда уходит из отдельного потока"""
+        humidity = values.get("humidity")
+        if humidity is None or datetime.now() - values["timestamp"] > timedelta(seconds=CONTROL_MAX_AGE):
+            return
+        controller_id = values["sensor_id"]
+        now_utc = datetime.now(timezone.utc)
+        with self._lock:
+            if CONTROL_MODE != 'local' and cloud_available():
+                self._status.pop(controller_id, None)
+                return
+            schedule = self._schedules.get(controller_id)
+            setting = schedule[now_utc.weekday()][now_utc.hour] if schedule else None
+            if not setting or None in (setting["humidity"], setting["histeresys_up"], setting["histeresys_down"]):
+                return
+            target_humidity = setting["humidity"]
+            current = self._status.get(controller_id)
+            if current is not None and current[0] == "ON":
+                # Выключаем, если влажность выше уставки плюс верхний гистерезис
+                new_status = "OFF" if humidity > target_humidity + setting["histeresys_up"] else "ON"
+            else:
+                # Включаем, если влажность ниже уставки минус нижний гистерезис;
+                # без известного состояния — то же начальное правило, что во front
+                new_status = "ON" if humidity < target_humidity - setting["histeresys_down"] else "OFF"
+            now = time.monotonic()
+            if current is not None and current[0] == new_status and now - current[1] < CONTROL_RESEND_INTERVAL:
+                return
+            self._status[controller_id] = (new_status, now)
+        try:
+            self._commands.put_nowait((controller_id, new_status))
+        except queue.Full:
+            logger.warning("⚠️ Очередь команд увлажнителям заполнена, %s -> %s пропущено", controller_id, new_status)
+
+    def command_worker(self):
+        """Отправляет команды в controller_manager"""
+        http = requests.Session()
+        try:
+            while not forward_stop.is_set():
+                try:
+                    controller_id, status = self._commands.get(timeout=1)
+                except queue.Empty:
+                    continue
+                url = CONTROL_URL.format(controller_id=controller_id, status=status)
+                try:
+                    response = http.get(url, timeout=CONTROL_TIMEOUT)
+                    ok = response.status_code == 200
+                except requests.exceptions.RequestException as e:
+                    logger.error("❌ Контроллер %s недоступен: %s", controller_id, e)
+                    ok = False
+                CONTROL_COMMANDS.labels(status=status, result='ok' if ok else 'failed').inc()
+                if ok:
+                    logger.warning("💧 Локальный контур: контроллер %s -> %s", controller_id, status)
+                else:
+                    # Повтор — на следующем показании после CONTROL_RESEND_INTERVAL
+                    logger.warning("⚠️ Команда %s контроллеру %s не выполнена", status, controller_id)
+        finally:
+            http.close()
+
+    def refresh_worker(self):
+        """Периодическое обновление расписаний"""
+        http = requests.Session()
+        try:
+            while True:
+                try:
+                    self.refresh(http)
+                except Exception as e:
+                    logger.warning("⚠️ Расписания не обновлены (работаем по кэшу): %s", e)
+                if forward_stop.wait(CONTROL_REFRESH_INTERVAL):
+                    break
+        finally:
+            http.close()
+
+
+humidity_control = HumidityControl()
+
+
+def start_humidity_control():
+    """Поднимает локальный контур управления, если он включён"""
+    if not CONTROL_ENABLED:
+        return
+    humidity_control.load_cache()
+    if CONTROL_SCHEDULE_URL:
+        threading.Thread(target=humidity_control.refresh_worker, name="control-schedule", daemon=True).start()
+    threading.Thread(target=humidity_control.command_worker, name="control", daemon=True).start()
+
+# === ЗАПИСЬ В БД ===
+
+# Запросы вставки собираются один раз, компиляция берётся из кэша SQLAlchemy
+INSERT_READINGS = insert(SensorReading.__table__).returning(SensorReading.id, sort_by_parameter_order=True)
+INSERT_OUTBOX = insert(ForwardOutbox.__table__).returning(ForwardOutbox.id, sort_by_parameter_order=True)
+
+
+def write_readings(rows):
+    """
+    Пишет пачку показаний и их записи outbox в одной транзакции.
+    rows — список пар (значения SensorReading, payload для outbox или None).
+    Возвращает список пар (id показания, id outbox или None) в том же порядке.
+    """
+    session = Session()
     try:
-        response = requests.post(FORWARD_URL, json=data, timeout=FORWARD_TIMEOUT)
-        print(f"📤 Переслано на {FORWARD_URL}: {response.status_code}")
-    except Exception as e:
-        print(f"❌ Ошибка пересылки на {FORWARD_URL}: {e}")
+        reading_ids = session.scalars(
+            INSERT_READINGS,
+            [{**values, "forward_queued": payload is not None} for values, payload in rows]
+        ).all()
+        outbox_rows = build_outbox_rows(rows)
+        outbox_ids = session.scalars(
+            INSERT_OUTBOX,
+            outbox_rows
+        ).all() if outbox_rows else []
+        with DB_COMMIT_SECONDS.time():
+            session.commit()
+        READINGS_INSERTED.inc(len(rows))
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    for reading_id, (values, _) in zip(reading_ids, rows):
+        sensor_stats.add(values, reading_id)
+        if COMPRESS_ENABLED:
+            compressor.confirm(values)
+    return pair_outbox_ids(reading_ids, rows, outbox_ids)
+
+
+def build_outbox_rows(rows):
+    """Записи outbox: по одной на каждое пересылаемое показание и каждого получателя"""
+    bodies = [json.dumps(payload) for _, payload in rows if payload is not None]
+    return [{"payload": body, "target": target.name} for body in bodies for target in forward_targets]
+
+
+def pair_outbox_ids(reading_ids, rows, outbox_ids):
+    """Пары (id показания, {получатель: id outbox} или None) в порядке rows"""
+    outbox_ids = iter(outbox_ids)
+    return [
+        (reading_id, {target.name: next(outbox_ids) for target in forward_targets} if payload is not None else None)
+        for reading_id, (_, payload) in zip(reading_ids, rows)
+    ]
+
+
+commit_queue = queue.Queue()
+commit_stop = threading.Event()
+commit_thread = None
+
+
+def group_commit_writer():
+    """Писатель group commit: одна транзакция на пачку запросов"""
+    while True:
+        try:
+            first = commit_queue.get(timeout=1)
+        except queue.Empty:
+            if commit_stop.is_set():
+                break
+            continue
+        batch = [first]
+        flush_at = time.monotonic() + GROUP_COMMIT_INTERVAL_MS / 1000
+        while len(batch) < GROUP_COMMIT_MAX_ROWS:
+            remaining = flush_at - time.monotonic()
+            try:
+                batch.append(commit_queue.get(timeout=remaining) if remaining > 0 else commit_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            results = write_readings([row for row, _ in batch])
+            for (_, fut), result in zip(batch, results):
+                fut.set_result(result)
+        except Exception as e:
+            logger.error("❌ Ошибка group commit (%d строк): %s", len(batch), e)
+            for _, fut in batch:
+                fut.set_exception(e)
+
+
+def store_reading(values, payload):
+    """Сохраняет одно показание: напрямую или через group commit"""
+    if commit_thread is None:
+        return write_readings([(values, payload)])[0]
+    fut = Future()
+    commit_queue.put(((values, payload), fut))
+    return fut.result(timeout=GROUP_COMMIT_WAIT_TIMEOUT)
+
+
+def start_group_commit():
+    """Запускает писателя group commit, если режим включён"""
+    global commit_thread
+    if not GROUP_COMMIT:
+        return
+    commit_thread = threading.Thread(target=group_commit_writer, name="group-commit", daemon=True)
+    commit_thread.start()
+
+
+def stop_group_commit():
+    """Сбрасывает оставшиеся в очереди строки и останавливает писателя"""
+    if commit_thread is None:
+        return
+    commit_stop.set()
+    commit_thread.join(GROUP_COMMIT_WAIT_TIMEOUT)
+
+
+# === ПЕРЕСЫЛКА ===
+# Каждое показание сначала попадает в таблицу forward_outbox — по записи на каждого
+# получателя — в той же транзакции, что и SensorReading, а затем в ограниченные
+# очереди получателей в памяти. У каждого получателя свой пул воркеров с
+# keep-alive сессиями requests, свой sweeper и свой интервал повтора, так что
+# медленный получатель не задерживает остальных. Если очередь полна или
+# получатель недоступен, запись остаётся в outbox и подхватывается позже.
+
+forward_stop = threading.Event()
+forward_threads = []
+# Крайний срок дренажа очередей, выставляется при остановке
+forward_deadline = float('inf')
+
+
+def _is_permanent_reject(status_code):
+    """4xx (кроме 429) — коллектор отверг данные, повтор ничего не изменит"""
+    return 400 <= status_code < 500 and status_code != 429
+
+
+class ForwardTarget:
+    """Получатель пересылки: своя очередь, свой пул воркеров и свои записи outbox"""
+
+    def __init__(self, name, url, batch_url=None, workers=FORWARD_WORKERS, queue_size=FORWARD_QUEUE_SIZE,
+                 retry_interval=FORWARD_RETRY_INTERVAL, batch_size=FORWARD_BATCH_SIZE,
+                 batch_max_age=FORWARD_BATCH_MAX_AGE, timeout=FORWARD_TIMEOUT, primary=False):
+        self.name = name
+        self.url = url
+        self.batch_url = batch_url or f"{url.rstrip('/')}/batch"
+        self.workers = workers
+        self.queue_size = queue_size
+        self.retry_interval = retry_interval
+        self.batch_size = batch_size
+        self.batch_max_age = batch_max_age
+        self.timeout = timeout
+        # Ответы основного получателя — признак того, что облако на связи
+        self.primary = primary
+        self.queue = queue.Queue(maxsize=queue_size)
+        FORWARD_QUEUE_DEPTH.labels(target=name).set_function(self.queue.qsize)
+        # id записей outbox, которые уже лежат в очереди или пересылаются прямо сейчас
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def enqueue(self, outbox_id, payload, timeout):
+        """Ставит запись outbox в очередь; False, если очередь переполнена"""
+        with self._pending_lock:
+            if outbox_id in self._pending:
+                return True
+            self._pending.add(outbox_id)
+        try:
+            self.queue.put((outbox_id, payload), timeout=timeout)
+            return True
+        except queue.Full:
+            with self._pending_lock:
+                self._pending.discard(outbox_id)
+            return False
+
+    def _finish(self, outbox_ids, delivered):
+        """Удаляет доставленные записи из outbox, остальным увеличивает счётчик попыток"""
+        done = [i for i, ok in zip(outbox_ids, delivered) if ok]
+        failed = [i for i, ok in zip(outbox_ids, delivered) if not ok]
+        session = Session()
+        try:
+            if done:
+                session.query(ForwardOutbox).filter(ForwardOutbox.id.in_(done)).delete(synchronize_session=False)
+            if failed:
+                session.query(ForwardOutbox).filter(ForwardOutbox.id.in_(failed)).update(
+                    {ForwardOutbox.attempts: ForwardOutbox.attempts + 1}, synchronize_session=False
+                )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logger.error("❌ Ошибка обновления outbox ID=%s: %s", outbox_ids, e)
+        finally:
+            session.close()
+            with self._pending_lock:
+                self._pending.difference_update(outbox_ids)
+
+    def _responded(self, response):
+        if self.primary and response.status_code < 500:
+            mark_cloud_ok()
+
+    def forward_data(self, http, data):
+        """Пересылка одного показания; True, если повторять не нужно"""
+        failed = FORWARD_ITEMS.labels(target=self.name, result='failed')
+        try:
+            with FORWARD_REQUEST_SECONDS.labels(target=self.name, endpoint='single').time():
+                response = http.post(self.url, json=data, timeout=self.timeout)
+            logger.info("📤 Переслано на %s: %s", self.url, response.status_code,
+                        extra={"sensor_id": data.get("sensor_id")})
+            self._responded(response)
+            if response.ok:
+                FORWARD_ITEMS.labels(target=self.name, result='delivered').inc()
+                return True
+            if _is_permanent_reject(response.status_code):
+                logger.warning("⚠️ %s отклонил показание %s: %s", self.name, data.get('puid'), response.text[:200])
+                FORWARD_ITEMS.labels(target=self.name, result='rejected').inc()
+                return True
+            failed.inc()
+            return False
+        except Exception as e:
+            logger.error("❌ Ошибка пересылки на %s: %s", self.url, e)
+            failed.inc()
+            return False
+
+    def forward_batch(self, http, batch):
+        """Пересылка пакета на /data/batch; список флагов «повторять не нужно» по элементам"""
+        if len(batch) == 1 or self.batch_size <= 1:
+            return [self.forward_data(http, data) for data in batch]
+        failed = FORWARD_ITEMS.labels(target=self.name, result='failed')
+        try:
+            with FORWARD_REQUEST_SECONDS.labels(target=self.name, endpoint='batch').time():
+                response = http.post(self.batch_url, json=batch, timeout=self.timeout)
+            logger.info("📤 Переслан пакет из %d на %s: %s", len(batch), self.batch_url, response.status_code)
+            self._responded(response)
+            if response.ok:
+                results = response.json().get("results", [])
+                if len(results) != len(batch):
+                    logger.warning("⚠️ %s вернул %d результатов на пакет из %d", self.name, len(results), len(batch))
+                    failed.inc(len(batch))
+                    return [False] * len(batch)
+                for data, result in zip(batch, results):
+                    if result.get("status") == "error":
+                        logger.warning("⚠️ %s отклонил показание %s: %s", self.name, data.get('puid'), result.get('message'))
+                        FORWARD_ITEMS.labels(target=self.name, result='rejected').inc()
+                    else:
+                        FORWARD_ITEMS.labels(target=self.name, result='delivered').inc()
+                # inserted, duplicate и error по элементу — всё окончательный ответ
+                return [True] * len(batch)
+            if _is_permanent_reject(response.status_code):
+                # Пакет целиком отвергнут (например, старый коллектор без /data/batch) —
+                # отправляем по одному
+                logger.warning("⚠️ Пакет отклонён %s (%s), пересылка по одному", self.name, response.status_code)
+                return [self.forward_data(http, data) for data in batch]
+            failed.inc(len(batch))
+            return [False] * len(batch)
+        except Exception as e:
+            logger.error("❌ Ошибка пересылки пакета на %s: %s", self.batch_url, e)
+            failed.inc(len(batch))
+            return [False] * len(batch)
+
+    def _collect_batch(self, first):
+        """Добирает пакет из очереди до batch_size или до истечения batch_max_age"""
+        batch = [first]
+        flush_at = time.monotonic() + self.batch_max_age
+        while len(batch) < self.batch_size:
+            # При остановке не ждём добора — забираем только то, что уже в очереди
+            remaining = 0 if forward_stop.is_set() else flush_at - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self.queue.get_nowait())
+                else:
+                    batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def worker(self):
+        """Воркер пула: одна keep-alive сессия на поток"""
+        http = requests.Session()
+        inflight = FORWARD_INFLIGHT.labels(target=self.name)
+        try:
+            while True:
+                if forward_stop.is_set() and time.monotonic() > forward_deadline:
+                    break
+                try:
+                    first = self.queue.get(timeout=1)
+                except queue.Empty:
+                    if forward_stop.is_set():
+                        break
+                    continue
+                batch = self._collect_batch(first)
+                try:
+                    outbox_ids = [outbox_id for outbox_id, _ in batch]
+                    with inflight.track_inprogress():
+                        delivered = self.forward_batch(http, [payload for _, payload in batch])
+                    self._finish(outbox_ids, delivered)
+                finally:
+                    for _ in batch:
+                        self.queue.task_done()
+        finally:
+            http.close()
+
+    def sweeper(self):
+        """Периодически возвращает в очередь недоставленные записи outbox этого получателя"""
+        owned = ForwardOutbox.target == self.name
+        if self.primary:
+            owned = or_(owned, ForwardOutbox.target.is_(None))
+        while not forward_stop.is_set():
+            session = Session()
+            try:
+                with self._pending_lock:
+                    pending = set(self._pending)
+                free = self.queue_size - self.queue.qsize()
+                if free > 0:
+                    rows = session.query(ForwardOutbox).filter(owned).order_by(ForwardOutbox.id).limit(
+                        free + len(pending)
+                    ).all()
+                    for row in rows:
+                        if row.id in pending:
+                            continue
+                        if not self.enqueue(row.id, json.loads(row.payload), timeout=0):
+                            break
+            except Exception as e:
+                logger.error("❌ Ошибка чтения outbox %s: %s", self.name, e)
+            finally:
+                session.close()
+            forward_stop.wait(self.retry_interval)
+
+    def start(self):
+        """Запускает воркеры и sweeper получателя"""
+        for i in range(self.workers):
+            t = threading.Thread(target=self.worker, name=f"forwarder-{self.name}-{i}", daemon=True)
+            t.start()
+            forward_threads.append(t)
+        t = threading.Thread(target=self.sweeper, name=f"outbox-sweeper-{self.name}", daemon=True)
+        t.start()
+        forward_threads.append(t)
+
+
+def build_forward_targets():
+    """Основной получатель из FORWARD_URL и дополнительные из FORWARD_TARGETS"""
+    if not FORWARD_URL:
+        return []
+    targets = [ForwardTarget(FORWARD_NAME, FORWARD_URL, batch_url=FORWARD_BATCH_URL, primary=True)]
+    for options in FORWARD_TARGETS:
+        targets.append(ForwardTarget(**options))
+    return targets
+
+
+forward_targets = build_forward_targets()
+
+
+def enqueue_forward(outbox_ids, payload, timeout=FORWARD_ENQUEUE_TIMEOUT):
+    """
+    Ставит записи outbox в очереди их получателей; False, если хоть одна очередь полна.
+    Ждать места ingest готов только у основного получателя — остальные не тормозят запись.
+    """
+    queued = True
+    for target in forward_targets:
+        outbox_id = outbox_ids.get(target.name)
+        if outbox_id is None:
+            continue
+        if not target.enqueue(outbox_id, payload, timeout if target.primary else 0):
+            queued = False
+    return queued
+
+
+def forward_queue_depth():
+    """Глубина очередей пересылки по получателям"""
+    return {target.name: target.queue.qsize() for target in forward_targets}
+
+
+def _watermark_name(target):
+    """Имя watermark в forward_state; у основного получателя — прежнее, без суффикса"""
+    return 'resync_watermark' if target.primary else f'resync_watermark:{target.name}'
+
+
+def _load_watermark(session, target):
+    """Читает watermark досинхронизации получателя, при первом запуске инициализирует его"""
+    name = _watermark_name(target)
+    state = session.get(ForwardState, name)
+    if state is None:
+        if RESYNC_START_ID:
+            start = int(RESYNC_START_ID)
+        else:
+            first = session.query(func.min(SensorReading.id)).filter(_resync_pending()).scalar()
+            # watermark исключающий: досылаются id > watermark
+            start = first - 1 if first is not None else (session.query(func.max(SensorReading.id)).scalar() or 0)
+        state = ForwardState(name=name, value=start)
+        session.add(state)
+        session.commit()
+        logger.info("🔖 Watermark досинхронизации %s инициализирован: %s", target.name, start)
+    return state
+
+
+def _resync_payload(row):
+    """Payload показания из локальной БД — как у живой пересылки, плюс исходное время"""
+    return Reading(
+        row.sensor_id,
+        timestamp=row.timestamp.isoformat() if row.timestamp else None,
+        temperature=row.temperature,
+        humidity=row.humidity,
+        voltage=row.voltage,
+        puid=row.puid,
+        source_ip=row.ip_address,
+    ).to_wire()
+
+
+def resync_chunk(http, target):
+    """
+    Досылает получателю одну пачку показаний выше его watermark, не прошедших через outbox.
+    Возвращает True, если за watermark ещё остались данные.
+    """
+    session = Session()
+    try:
+        state = _load_watermark(session, target)
+        watermark = state.value
+        upper = session.query(func.max(SensorReading.id)).scalar() or 0
+        if upper <= watermark:
+            return False
+        rows = session.query(SensorReading).filter(
+            SensorReading.id > watermark,
+            SensorReading.id <= upper,
+            _resync_pending()
+        ).order_by(SensorReading.id).limit(RESYNC_CHUNK_SIZE).all()
+
+        if rows:
+            # Старым записям без puid назначаем его один раз — повторы будут идемпотентны
+            for row in rows:
+                if row.puid is None:
+                    row.puid = generate_puid()
+            session.commit()
+
+            delivered = target.forward_batch(http, [_resync_payload(row) for row in rows])
+            if not all(delivered):
+                logger.warning("⚠️ Досинхронизация %s прервана на ID>%s, повтор через %s с",
+                               target.name, watermark, RESYNC_INTERVAL)
+                return False
+            logger.info("🔁 Досинхронизировано на %s %d показаний (ID %s..%s)",
+                        target.name, len(rows), rows[0].id, rows[-1].id)
+
+        more = len(rows) == RESYNC_CHUNK_SIZE
+        state.value = rows[-1].id if more else upper
+        session.commit()
+        return more
+    finally:
+        session.close()
+
+
+def resync_worker():
+    """Фоновая досинхронизация локальной БД со всеми получателями, у каждого свой watermark"""
+    http = requests.Session()
+    try:
+        while not forward_stop.is_set():
+            more = False
+            for target in forward_targets:
+                # Живой трафик важнее: пока очередь получателя заполнена наполовину, ждём
+                if target.queue.qsize() > target.queue_size // 2:
+                    more = True
+                    continue
+                try:
+                    more = resync_chunk(http, target) or more
+                except Exception as e:
+                    logger.error("❌ Ошибка досинхронизации %s: %s", target.name, e)
+            forward_stop.wait(RESYNC_PAUSE if more else RESYNC_INTERVAL)
+    finally:
+        http.close()
+
+
+def start_forwarders():
+    """Запускает пулы воркеров и sweeper'ы всех получателей"""
+    if not FORWARD_URL:
+        logger.warning("⚠️ FORWARD_URL не настроен, пересылка отключена")
+        return
+    for target in forward_targets:
+        target.start()
+    if RESYNC_ENABLED:
+        t = threading.Thread(target=resync_worker, name="resync", daemon=True)
+        t.start()
+        forward_threads.append(t)
+
+
+def stop_forwarders(timeout=FORWARD_DRAIN_TIMEOUT):
+    """Дожидается дренажа очереди; недоставленное остаётся в outbox"""
+    global forward_deadline
+    if not forward_threads:
+        return
+    forward_deadline = time.monotonic() + timeout
+    forward_stop.set()
+    for t in forward_threads:
+        t.join(max(0, forward_deadline - time.monotonic()))
+    logger.warning("🛑 Пересылка остановлена, в очередях осталось: %s", forward_queue_depth())
+
+
+def handle_sigterm(signum, frame):
+    """Корректная остановка по SIGTERM (docker compose down)"""
+    logger.warning("🛑 Получен SIGTERM, дренаж очереди пересылки...")
+    stop_group_commit()
+    stop_forwarders()
+    sys.exit(0)
 
 
 def generate_puid():
     """Генерирует UUID v4 в формате XX...XX-XX...XX (16 hex)"""
     u = uuid.uuid4()
     return f"{u.hex[:8]}-{u.hex[8:]}"
+
+
+sensor_limiter = TokenBucketLimiter(RATE_LIMIT_SENSOR, RATE_LIMIT_SENSOR_BURST)
+ip_limiter = TokenBucketLimiter(RATE_LIMIT_IP, RATE_LIMIT_IP_BURST)
+
+
+def shed_request(source_ip, pool_exhausted):
+    """
+    Дешёвая проверка до разбора тела. None — принимаем, иначе (HTTP-код, сообщение).
+    С group commit запросы ждут писателя, а не соединение, — пул не проверяем.
+    """
+    if pool_exhausted:
+        REQUESTS_SHED.labels(reason='pool').inc()
+        return 503, "Database busy"
+    if not ip_limiter.allow(source_ip):
+        REQUESTS_SHED.labels(reason='ip').inc()
+        return 429, "Rate limit exceeded for source IP"
+    return None
+
+
+def shed_sensors(prepared):
+    """Лимит по датчикам запроса: один жетон на каждый sensor_id"""
+    for sensor_id in {values["sensor_id"] for values, _ in prepared}:
+        if not sensor_limiter.allow(sensor_id):
+            REQUESTS_SHED.labels(reason='sensor').inc()
+            return 429, f"Rate limit exceeded for sensor {sensor_id}"
+    return None
+
+
+def pool_exhausted():
+    """Все соединения пула заняты: новый запрос встал бы в ожидание"""
+    return not GROUP_COMMIT and engine.pool.checkedout() >= DB_POOL_SIZE + DB_MAX_OVERFLOW
+
+
+def shed_response(shed):
+    """Ответ на сброшенный запрос; Retry-After подсказывает паузу"""
+    status, message = shed
+    return jsonify({"status": "error", "message": message}), status, {"Retry-After": "1"}
+
+
+@functools.lru_cache(maxsize=64)
+def resolve_host(host):
+    """Резолвит имя хоста один раз, дальше берёт из кэша"""
+    return socket.gethostbyname(host)
+
+
+def prepare_reading(data, timestamp, source_ip, destination_ip):
+    """
+    Проверяет показание и готовит строку SensorReading и payload для пересылки.
+    Бросает ReadingError (нет sensor_id, не JSON-объект, длинный puid) или ValueError (типы).
+    """
+    reading = parse_reading(data)
+    if reading.puid is None:
+        reading.puid = generate_puid()
+    reading.source_ip = source_ip
+    reading.destination_ip = destination_ip
+
+    # Буферизованное показание: offset — секунды относительно момента отправки
+    if reading.offset is not None:
+        timestamp = timestamp + timedelta(seconds=reading.offset)
+        reading.offset = None
+    # Коллектору всегда уходит время локальной записи: иначе он поставит своё
+    # время приёма, и повтор из outbox после потерянного ответа не совпадёт
+    # с уже принятой строкой по ключу (puid, timestamp)
+    reading.timestamp = timestamp.isoformat()
+
+    values = {
+        "timestamp": timestamp,
+        "sensor_id": reading.sensor_id,
+        "temperature": reading.temperature,
+        "humidity": reading.humidity,
+        "voltage": reading.voltage,
+        "ip_address": source_ip,
+        "puid": reading.puid
+    }
+    # Пересылается уже проверенное показание с приведёнными типами
+    return values, reading.to_wire()
+
+
+def prepare_batch(readings, timestamp, source_ip, destination_ip):
+    """Проверяет пакет целиком: ошибка в любом показании отклоняет весь пакет"""
+    if not readings:
+        raise ReadingError("Empty batch")
+    if len(readings) > MAX_BATCH_READINGS:
+        raise ReadingError(f"Batch too large (max {MAX_BATCH_READINGS})")
+    prepared = []
+    for i, item in enumerate(readings):
+        try:
+            prepared.append(prepare_reading(item, timestamp, source_ip, destination_ip))
+        except ValueError as e:
+            raise ReadingError(f"Reading {i}: {e}")
+    return prepared
+
+
+class DeadbandCompressor:
+    """Последнее сохранённое показание по каждому датчику и решение, сохранять ли новое"""
+
+    def __init__(self, temperature, humidity, max_interval):
+        self.tolerance = {"temperature": temperature, "humidity": humidity}
+        self.max_interval = timedelta(seconds=max_interval)
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def _changed(self, last, values):
+        for key, tolerance in self.tolerance.items():
+            old, new = last[key], values[key]
+            if (old is None) != (new is None):
+                return True
+            if new is not None and abs(new - old) > tolerance:
+                return True
+        return False
+
+    def keep(self, values, pending):
+        """
+        True — показание нужно сохранить. Опорным оно становится только после
+        записи (confirm): иначе неудавшаяся запись подавляла бы следующие показания
+        относительно значения, которого нет в БД. pending — опорные значения
+        внутри текущей пачки (буфер датчика приходит пачкой).
+        """
+        sensor_id = values["sensor_id"]
+        with self._lock:
+            last = pending[sensor_id] if sensor_id in pending else self._last.get(sensor_id)
+        # Буферизованные показания из прошлого не сжимаем: порядок уже нарушен
+        if (last is not None and values["timestamp"] >= last["timestamp"]
+                and values["timestamp"] - last["timestamp"] < self.max_interval
+                and not self._changed(last, values)):
+            return False
+        pending[sensor_id] = values
+        return True
+
+    def confirm(self, values):
+        """Записанное показание становится опорным для датчика"""
+        with self._lock:
+            self._last[values["sensor_id"]] = values
+
+
+compressor = DeadbandCompressor(COMPRESS_TEMPERATURE, COMPRESS_HUMIDITY, COMPRESS_MAX_INTERVAL)
+
+
+def compress_readings(prepared):
+    """
+    Отбрасывает показания внутри мёртвой зоны; без COMPRESS_ENABLED — ничего.
+    Контур увлажнения видит каждое принятое показание — до сжатия, а не только записанные
+    """
+    if CONTROL_ENABLED:
+        for values, _ in prepared:
+            humidity_control.observe(values)
+    if not COMPRESS_ENABLED:
+        return prepared
+    pending = {}
+    kept = [item for item in prepared if compressor.keep(item[0], pending)]
+    if len(kept) < len(prepared):
+        READINGS_COMPRESSED.inc(len(prepared) - len(kept))
+    return kept
+
+
+def compressed_response(values):
+    """Ответ на одиночное показание, отброшенное сжатием"""
+    return {
+        "status": "ok",
+        "id": None,
+        "compressed": True,
+        "timestamp": values["timestamp"].isoformat(),
+        "sensor_id": values["sensor_id"]
+    }
+
+
+def batch_response(prepared, results, timestamp, compressed=0):
+    """Ответ на пакет: id и время каждого сохранённого показания в исходном порядке"""
+    return {
+        "status": "ok",
+        "count": len(prepared),
+        "compressed": compressed,
+        "timestamp": timestamp.isoformat(),
+        "readings": [
+            {
+                "id": record_id,
+                "timestamp": values["timestamp"].isoformat(),
+                "sensor_id": values["sensor_id"],
+                "puid": values["puid"]
+            }
+            for (values, _), (record_id, _) in zip(prepared, results)
+        ]
+    }
+
+
+def receive_batch(readings, timestamp, source_ip, destination_ip):
+    """Пакет показаний: одна транзакция на весь пакет"""
+    prepared = prepare_batch(readings, timestamp, source_ip, destination_ip)
+    shed = shed_sensors(prepared)
+    if shed:
+        return shed_response(shed)
+    logger.info("📦 %s -> %s : пакет из %d показаний", source_ip, destination_ip, len(prepared),
+                extra={"sensor_id": prepared[0][0]["sensor_id"]})
+
+    kept = compress_readings(prepared)
+    results = write_readings([(values, payload if FORWARD_URL else None) for values, payload in kept]) if kept else []
+
+    for (_, payload), (_, outbox_ids) in zip(kept, results):
+        if outbox_ids is not None and not enqueue_forward(outbox_ids, payload):
+            logger.warning("⚠️ Очередь пересылки заполнена, ID=%s остаётся в outbox", outbox_ids)
+
+    return jsonify(batch_response(kept, results, timestamp, len(prepared) - len(kept))), 200
+
+
 @app.route('/data', methods=['POST'])
 def receive_data():
     """Приём данных от датчиков"""
     
     try:
+        # Сброс до разбора тела и до обращения к БД
+        shed = shed_request(request.remote_addr, pool_exhausted())
+        if shed:
+            return shed_response(shed)
+
         data = request.get_json()
         timestamp = datetime.now()
         
 
         source_ip = request.remote_addr
-        destination_ip = request.environ.get('SERVER_ADDR') or socket.gethostbyname(request.host.split(':')[0])
-        
-        print(f"📡 [{timestamp}] {source_ip} -> {destination_ip} : {data}")
+        destination_ip = request.environ.get('SERVER_ADDR') or resolve_host(request.host.split(':')[0])
         
+        # Пакет показаний (массив или колоночный формат)
+        readings = expand_payload(data)
+        if readings is not None:
+            return receive_batch(readings, timestamp, source_ip, destination_ip)
+
         # Валидация данных
-        if not isinstance(data, dict):
-            return jsonify({"status": "error", "message": "Invalid JSON format"}), 400
-        
-        sensor_id = data.get('sensor_id')
-        if sensor_id is None:
-            return jsonify({"status": "error", "message": "Missing sensor_id"}), 400
-        
-        # Запись в БД
-        session = Session()
-        try:
-            db_record = SensorReading(
-                timestamp=timestamp,
-                sensor_id=int(sensor_id),
-                temperature=float(data.get('temperature')) if data.get('temperature') is not None else None,
-                humidity=float(data.get('humidity')) if data.get('humidity') is not None else None,
-                voltage=float(data.get('voltage')) if data.get('voltage') is not None else None,
-                ip_address=source_ip
-            )
-            session.add(db_record)
-            session.commit()
-            record_id = db_record.id
-            print(f"💾 Записано в БД: ID={record_id}")
-        except Exception as e:
-            session.rollback()
-            raise e
-        finally:
-            session.close()
-        if data.get("puid") is None:
-            data = {**data, "puid": generate_puid()}
+        values, data_with_ip = prepare_reading(data, timestamp, source_ip, destination_ip)
+        log_extra = {"sensor_id": values["sensor_id"]}
+        logger.info("📡 %s -> %s : %s", source_ip, destination_ip, data_with_ip, extra=log_extra)
+
+        shed = shed_sensors([(values, data_with_ip)])
+        if shed:
+            return shed_response(shed)
+
+        # Внутри мёртвой зоны: датчику отвечаем 200, но не пишем и не пересылаем
+        if not compress_readings([(values, data_with_ip)]):
+            logger.debug("🗜️ Сжато: %s", values["puid"], extra=log_extra)
+            return jsonify(compressed_response(values)), 200
 
-        data_with_ip = {**data, "source_ip": source_ip, "destination_ip": destination_ip}
-        print(data_with_ip)
-        threading.Thread(target=forward_data, args=(data_with_ip,), daemon=True).start()
+        # Запись в БД (вместе с outbox — в одной транзакции)
+        record_id, outbox_ids = store_reading(values, data_with_ip if FORWARD_URL else None)
+        logger.debug("💾 Записано в БД: ID=%s", record_id, extra=log_extra)
+
+        # Backpressure: ждём место в очереди не дольше FORWARD_ENQUEUE_TIMEOUT,
+        # иначе запись дождётся sweeper'а в outbox
+        if outbox_ids is not None and not enqueue_forward(outbox_ids, data_with_ip):
+            logger.warning("⚠️ Очередь пересылки заполнена, ID=%s остаётся в outbox", outbox_ids)
         
         return jsonify({
             "status": "ok",
             "id": record_id,
-            "timestamp": timestamp.isoformat(),
-            "sensor_id": sensor_id
+            "timestamp": values["timestamp"].isoformat(),
+            "sensor_id": data["sensor_id"]
         }), 200
         
+    except ReadingError as e:
+        logger.warning("⚠️ Отклонено показание от %s: %s", request.remote_addr, e)
+        return jsonify({"status": "error", "message": str(e)}), 400
     except ValueError as e:
-        print(f"❌ Ошибка валидации: {e}")
+        logger.warning("❌ Ошибка валидации: %s", e)
         return jsonify({"status": "error", "message": f"Invalid data type: {str(e)}"}), 400
     except Exception as e:
-        print(f"❌ Ошибка: {e}")
+        logger.error("❌ Ошибка: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# === UDP ===
+# Облегчённый приём для частых датчиков: датаграмма — одна или несколько строк
+# "sensor_id,puid,temperature,humidity[,voltage]". Показания идут тем же путём,
+# что и /data: запись в БД вместе с outbox и постановка в очередь пересылки.
+# Все строки, пришедшие пачкой, пишутся одной транзакцией.
+
+class PuidDeduplicator:
+    """
+    Помнит puid последних записанных показаний и отсекает повторы.
+    Запоминается только то, что уже в БД: показание из неудавшейся записи
+    датчик пришлёт снова, и повтор не должен потеряться.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._seen = OrderedDict()
+
+    def seen(self, puid):
+        """True, если показание с этим puid уже записано"""
+        if puid in self._seen:
+            self._seen.move_to_end(puid)
+            return True
+        return False
+
+    def add(self, puids):
+        """Запоминает puid записанных показаний"""
+        for puid in puids:
+            self._seen[puid] = None
+            self._seen.move_to_end(puid)
+        while len(self._seen) > self.size:
+            self._seen.popitem(last=False)
+
+
+def parse_udp_line(line):
+    """Строка UDP-протокола -> словарь показания как у /data"""
+    parts = line.split(',')
+    if len(parts) not in (4, 5):
+        raise ReadingError(f"Expected 4 or 5 fields, got {len(parts)}")
+    parts = [value.strip() or None for value in parts]
+    data = {"sensor_id": int(parts[0]) if parts[0] is not None else None, "puid": parts[1]}
+    # Пустое поле — отсутствующее значение; в payload уходят числа, как из JSON
+    for key, value in zip(('temperature', 'humidity', 'voltage'), parts[2:]):
+        data[key] = float(value) if value is not None else None
+    return data
+
+
+def udp_listener(sock, destination_ip):
+    """Читает датаграммы, разбирает строки и пишет их пачками"""
+    dedup = PuidDeduplicator(UDP_DEDUP_SIZE)
+    while not forward_stop.is_set():
+        try:
+            sock.settimeout(1)
+            datagrams = [sock.recvfrom(65535)]
+            # Добираем всё, что уже пришло, не дожидаясь новых датаграмм
+            sock.setblocking(False)
+            while len(datagrams) < UDP_MAX_ROWS:
+                try:
+                    datagrams.append(sock.recvfrom(65535))
+                except BlockingIOError:
+                    break
+        except socket.timeout:
+            continue
+        except OSError as e:
+            logger.error("❌ Ошибка чтения UDP: %s", e)
+            continue
+
+        timestamp = datetime.now()
+        prepared = []
+        # puid этой пачки: повтор внутри неё — тоже дубликат
+        batch_puids = set()
+        for payload, (source_ip, _) in datagrams:
+            for line in payload.decode('utf-8', errors='replace').splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    values, data_with_ip = prepare_reading(
+                        parse_udp_line(line), timestamp, source_ip, destination_ip
+                    )
+                except ValueError as e:
+                    UDP_LINES.labels(result='invalid').inc()
+                    logger.warning("⚠️ Некорректная UDP-строка от %s: %r (%s)", source_ip, line, e)
+                    continue
+                if values["puid"] in batch_puids or dedup.seen(values["puid"]):
+                    UDP_LINES.labels(result='duplicate').inc()
+                    continue
+                if not sensor_limiter.allow(values["sensor_id"]):
+                    UDP_LINES.labels(result='rate_limited').inc()
+                    continue
+                UDP_LINES.labels(result='accepted').inc()
+                logger.info("📡 udp %s : %s", source_ip, line, extra={"sensor_id": values["sensor_id"]})
+                batch_puids.add(values["puid"])
+                prepared.append((values, data_with_ip))
+
+        prepared = compress_readings(prepared)
+        if not prepared:
+            dedup.add(batch_puids)
+            continue
+        try:
+            results = write_readings([(values, payload if FORWARD_URL else None) for values, payload in prepared])
+        except Exception as e:
+            logger.error("❌ Ошибка записи UDP-показаний (%d): %s", len(prepared), e)
+            continue
+        dedup.add(batch_puids)
+        for (_, payload), (_, outbox_ids) in zip(prepared, results):
+            if outbox_ids is not None and not enqueue_forward(outbox_ids, payload, timeout=0):
+                logger.warning("⚠️ Очередь пересылки заполнена, ID=%s остаётся в outbox", outbox_ids)
+
+
+def start_udp_listener():
+    """Открывает UDP-порт, если он задан"""
+    if not UDP_PORT:
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((UDP_HOST, UDP_PORT))
+    destination_ip = UDP_HOST if UDP_HOST != '0.0.0.0' else resolve_host(socket.gethostname())
+    threading.Thread(target=udp_listener, args=(sock, destination_ip), name="udp", daemon=True).start()
+    logger.warning("📡 UDP-приём на %s:%s", UDP_HOST, UDP_PORT)
+
+
+@app.before_request
+def start_request_timer():
+    """Засекает время запроса для метрик"""
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """Гистограмма задержек по маршруту"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.labels(route, request.method, response.status_code).observe(time.perf_counter() - started)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Метрики в формате Prometheus"""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Проверка работоспособности"""
@@ -143,49 +1726,49 @@ def health_check():
         session.close()
         return jsonify({
             "status": "healthy",
-            "db": f"{DB_HOST}:{DB_PORT}/{DB_NAME}",
-            "forward_url": FORWARD_URL if FORWARD_URL else "disabled"
+            "db": DB_LABEL,
+            "forward_url": FORWARD_URL if FORWARD_URL else "disabled",
+            "forward_queue": sum(forward_queue_depth().values()),
+            "forward_targets": forward_queue_depth()
         }), 200
     except Exception as e:
         return jsonify({"status": "unhealthy", "error": str(e)}), 500
 
-# @app.route('/stats', methods=['GET'])
-# def stats():
-#     """Статистика по датчикам"""
-#     try:
-#         session = Session()
-#         result = session.execute("""
-#             SELECT 
-#                 sensor_id,
-#                 COUNT(*) as readings_count,
-#                 ROUND(AVG(temperature), 2) as avg_temp,
-#                 ROUND(AVG(humidity), 2) as avg_humidity,
-#                 ROUND(AVG(voltage), 2) as avg_voltage,
-#                 MAX(timestamp) as last_reading
-#             FROM sensor_readings
-#             GROUP BY sensor_id
-#             ORDER BY sensor_id
-#         """)
-#         stats_data = []
-#         for row in result:
-#             stats_data.append({
-#                 "sensor_id": row[0],
-#                 "readings_count": row[1],
-#                 "avg_temperature": row[2],
-#                 "avg_humidity": row[3],
-#                 "avg_voltage": row[4],
-#                 "last_reading": row[5].isoformat() if row[5] else None
-#             })
-#         session.close()
-        
-#         return jsonify(stats_data), 200
-#     except Exception as e:
-#         return jsonify({"status": "error", "message": str(e)}), 500
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Статистика по датчикам"""
+    return jsonify(sensor_stats.stats()), 200
+
+
+@app.route('/latest', methods=['GET'])
+def latest():
+    """Последнее показание каждого датчика"""
+    return jsonify(sensor_stats.latest()), 200
 
 if __name__ == '__main__':
     print(f"🚀 Запуск сервера на {APP_HOST}:{APP_PORT}")
-    print(f"🗄️  База данных: {DB_HOST}:{DB_PORT}/{DB_NAME}")
+    print(f"🗄️  База данных: {DB_LABEL}")
     print(f"📤 Пересылка: {FORWARD_URL if FORWARD_URL else 'отключена'}")
+    if FORWARD_URL and FORWARD_BATCH_SIZE > 1:
+        print(f"📦 Пакеты: до {FORWARD_BATCH_SIZE} шт. / {FORWARD_BATCH_MAX_AGE} с -> {FORWARD_BATCH_URL}")
+    for target in forward_targets[1:]:
+        print(f"📤 Доп. получатель {target.name}: {target.url} ({target.workers} воркеров)")
     print(f"🐛 Debug: {DEBUG}")
+    print(f"📝 Логи: {LOG_LEVEL}, каждое {LOG_SAMPLE_EVERY}-е, до {LOG_RATE_PER_SENSOR}/мин на датчик")
+
+    if GROUP_COMMIT:
+        print(f"🧺 Group commit: {GROUP_COMMIT_INTERVAL_MS} мс / {GROUP_COMMIT_MAX_ROWS} строк")
+    if CONTROL_ENABLED:
+        print(f"💧 Локальное управление: {CONTROL_MODE} -> {CONTROL_URL}")
+    if COMPRESS_ENABLED:
+        print(f"🗜️ Сжатие: ±{COMPRESS_TEMPERATURE}°C / ±{COMPRESS_HUMIDITY}%, heartbeat {COMPRESS_MAX_INTERVAL} с")
+
+    start_partition_maintenance()
+    sensor_stats.load()
+    start_group_commit()
+    start_forwarders()
+    start_humidity_control()
+    start_udp_listener()
+    signal.signal(signal.SIGTERM, handle_sigterm)
     
     app.run(host=APP_HOST, port=APP_PORT, threaded=True, debug=DEBUG)
\ No newline at end of file
@@ -0,0 +1,257 @@
+# korobochka_async.py
+# Асинхронный режим korobochka: aiohttp + asyncpg вместо dev-сервера Flask.
+# Контракт /data и /health тот же, что в korobochka.py; пересылка идёт через
+# тот же outbox и пул воркеров, но постановка в очередь не блокирует event loop.
+import asyncio
+import os
+import socket
+import sys
+import time
+from datetime import datetime
+from aiohttp import web
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import korobochka
+from korobochka import (
+    ReadingError, prepare_reading, enqueue_forward, INSERT_READINGS, INSERT_OUTBOX,
+    build_outbox_rows, pair_outbox_ids,
+    expand_payload, prepare_batch, batch_response, compress_readings, compressed_response,
+    compressor, COMPRESS_ENABLED,
+    shed_request, shed_sensors, start_humidity_control,
+    start_forwarders, stop_forwarders, start_partition_maintenance, start_udp_listener,
+    forward_queue_depth, sensor_stats, logger, access_logger, LOG_ACCESS,
+    REQUEST_SECONDS, DB_COMMIT_SECONDS, READINGS_INSERTED,
+    DB_LABEL, USE_SQLITE, FORWARD_URL, APP_HOST, APP_PORT,
+)
+
+# Размер пула asyncpg и keep-alive для ESP32
+ASYNC_POOL_SIZE = int(os.getenv('ASYNC_POOL_SIZE', '10'))
+ASYNC_MAX_OVERFLOW = int(os.getenv('ASYNC_MAX_OVERFLOW', '10'))
+KEEPALIVE_TIMEOUT = float(os.getenv('KEEPALIVE_TIMEOUT', '75'))
+
+# Встроенная SQLite рассчитана на Flask-режим и group commit
+if USE_SQLITE:
+    sys.exit("❌ Async-режим работает только с Postgres (STORAGE_BACKEND=postgres)")
+
+ASYNC_DATABASE_URL = korobochka.DATABASE_URL.replace('postgresql://', 'postgresql+asyncpg://', 1)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=ASYNC_POOL_SIZE, max_overflow=ASYNC_MAX_OVERFLOW)
+
+# Адрес этого хоста, резолвится один раз при старте
+LOCAL_IP = None
+
+
+def resolve_local_ip():
+    """Определяет адрес хоста один раз при старте"""
+    try:
+        return socket.gethostbyname(socket.gethostname())
+    except OSError:
+        return None
+
+
+async def write_readings(rows):
+    """
+    Пишет показания и их записи outbox в одной транзакции.
+    rows — список пар (значения SensorReading, payload для outbox или None).
+    """
+    async with async_engine.connect() as conn:
+        reading_ids = (await conn.execute(
+            INSERT_READINGS,
+            [{**values, "forward_queued": payload is not None} for values, payload in rows]
+        )).scalars().all()
+        outbox_rows = build_outbox_rows(rows)
+        outbox_ids = (await conn.execute(
+            INSERT_OUTBOX,
+            outbox_rows
+        )).scalars().all() if outbox_rows else []
+        started = time.perf_counter()
+        await conn.commit()
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+    READINGS_INSERTED.inc(len(rows))
+    for reading_id, (values, _) in zip(reading_ids, rows):
+        sensor_stats.add(values, reading_id)
+        if COMPRESS_ENABLED:
+            compressor.confirm(values)
+    return pair_outbox_ids(reading_ids, rows, outbox_ids)
+
+
+def pool_exhausted():
+    """Все соединения пула asyncpg заняты"""
+    return async_engine.pool.checkedout() >= ASYNC_POOL_SIZE + ASYNC_MAX_OVERFLOW
+
+
+def shed_response(shed):
+    """Ответ на сброшенный запрос; Retry-After подсказывает паузу"""
+    status, message = shed
+    return web.json_response({"status": "error", "message": message}, status=status,
+                             headers={"Retry-After": "1"})
+
+
+def enqueue_all(prepared, results):
+    """Ставит записи outbox в очередь пересылки без ожидания"""
+    for (_, payload), (_, outbox_ids) in zip(prepared, results):
+        # Если очередь полна, запись подхватит sweeper из outbox
+        if outbox_ids is not None and not enqueue_forward(outbox_ids, payload, timeout=0):
+            logger.warning("⚠️ Очередь пересылки заполнена, ID=%s остаётся в outbox", outbox_ids)
+
+
+async def receive_data(request):
+    """Приём данных от датчиков (одиночное показание или пакет)"""
+    try:
+        # Сброс до разбора тела и до обращения к БД
+        shed = shed_request(request.remote, pool_exhausted())
+        if shed:
+            return shed_response(shed)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        timestamp = datetime.now()
+
+        source_ip = request.remote
+        sockname = request.transport.get_extra_info('sockname') if request.transport else None
+        destination_ip = sockname[0] if sockname else LOCAL_IP
+
+        readings = expand_payload(data)
+        if readings is not None:
+            prepared = prepare_batch(readings, timestamp, source_ip, destination_ip)
+            shed = shed_sensors(prepared)
+            if shed:
+                return shed_response(shed)
+            logger.info("📦 %s -> %s : пакет из %d показаний", source_ip, destination_ip, len(prepared),
+                        extra={"sensor_id": prepared[0][0]["sensor_id"]})
+            kept = compress_readings(prepared)
+            results = await write_readings(
+                [(values, payload if FORWARD_URL else None) for values, payload in kept]
+            ) if kept else []
+            enqueue_all(kept, results)
+            return web.json_response(
+                batch_response(kept, results, timestamp, len(prepared) - len(kept)), status=200
+            )
+
+        values, data_with_ip = prepare_reading(data, timestamp, source_ip, destination_ip)
+        log_extra = {"sensor_id": values["sensor_id"]}
+        logger.info("📡 %s -> %s : %s", source_ip, destination_ip, data_with_ip, extra=log_extra)
+
+        shed = shed_sensors([(values, data_with_ip)])
+        if shed:
+            return shed_response(shed)
+
+        if not compress_readings([(values, data_with_ip)]):
+            logger.debug("🗜️ Сжато: %s", values["puid"], extra=log_extra)
+            return web.json_response(compressed_response(values), status=200)
+
+        results = await write_readings([(values, data_with_ip if FORWARD_URL else None)])
+        record_id = results[0][0]
+        logger.debug("💾 Записано в БД: ID=%s", record_id, extra=log_extra)
+        enqueue_all([(values, data_with_ip)], results)
+
+        return web.json_response({
+            "status": "ok",
+            "id": record_id,
+            "timestamp": values["timestamp"].isoformat(),
+            "sensor_id": data["sensor_id"]
+        }, status=200)
+
+    except ReadingError as e:
+        logger.warning("⚠️ Отклонено показание от %s: %s", request.remote, e)
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    except ValueError as e:
+        logger.warning("❌ Ошибка валидации: %s", e)
+        return web.json_response({"status": "error", "message": f"Invalid data type: {str(e)}"}, status=400)
+    except Exception as e:
+        logger.error("❌ Ошибка: %s", e)
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+
+async def health_check(request):
+    """Проверка работоспособности"""
+    try:
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        return web.json_response({
+            "status": "healthy",
+            "db": DB_LABEL,
+            "forward_url": FORWARD_URL if FORWARD_URL else "disabled",
+            "forward_queue": sum(forward_queue_depth().values()),
+            "forward_targets": forward_queue_depth()
+        }, status=200)
+    except Exception as e:
+        return web.json_response({"status": "unhealthy", "error": str(e)}, status=500)
+
+
+async def stats(request):
+    """Статистика по датчикам"""
+    return web.json_response(sensor_stats.stats(), status=200)
+
+
+async def latest(request):
+    """Последнее показание каждого датчика"""
+    return web.json_response(sensor_stats.latest(), status=200)
+
+
+async def metrics(request):
+    """Метрики в формате Prometheus"""
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """Гистограмма задержек по маршруту"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        resource = request.match_info.route.resource
+        route = resource.canonical if resource is not None else 'unmatched'
+        REQUEST_SECONDS.labels(route, request.method, status).observe(time.perf_counter() - started)
+
+
+async def on_startup(app):
+    """Запуск обслуживания партиций и пула пересылки вместе с сервером"""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, start_partition_maintenance)
+    await loop.run_in_executor(None, sensor_stats.load)
+    start_forwarders()
+    start_humidity_control()
+    start_udp_listener()
+
+
+async def on_cleanup(app):
+    """Остановка: дренаж пересылки и закрытие пула соединений"""
+    # Дренаж очереди пересылки блокирующий — уводим его из event loop
+    await asyncio.get_running_loop().run_in_executor(None, stop_forwarders)
+    await async_engine.dispose()
+
+
+def create_app():
+    """Собирает aiohttp-приложение с маршрутами /data, /health, /stats, /latest и /metrics"""
+    app = web.Application(middlewares=[metrics_middleware])
+    app.router.add_post('/data', receive_data)
+    app.router.add_get('/health', health_check)
+    app.router.add_get('/stats', stats)
+    app.router.add_get('/latest', latest)
+    app.router.add_get('/metrics', metrics)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    LOCAL_IP = resolve_local_ip()
+    print(f"🚀 Запуск async-сервера на {APP_HOST}:{APP_PORT}")
+    print(f"🗄️  База данных: {DB_LABEL} (asyncpg)")
+    print(f"📤 Пересылка: {FORWARD_URL if FORWARD_URL else 'отключена'}")
+    print(f"🌐 Адрес хоста: {LOCAL_IP}")
+
+    # run_app сам обрабатывает SIGTERM и вызывает on_cleanup
+    web.run_app(create_app(), host=APP_HOST, port=APP_PORT, keepalive_timeout=KEEPALIVE_TIMEOUT,
+                access_log=access_logger if LOG_ACCESS else None, print=None)
@@ -1,13 +1,27 @@
 # server.py
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g, Response
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo  # Python 3.9+ (или pip install backports.zoneinfo)
-from sqlalchemy import text, create_engine, Column, Integer, String, DateTime, Float, UniqueConstraint
+from sqlalchemy import text, create_engine, Column, Integer, String, DateTime, Float, Index, UniqueConstraint, Table
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import declarative_base, sessionmaker
 import os
 from dotenv import load_dotenv
-import math
+import time
+import json
+import hashlib
+import select as select_io
+import psycopg2
+import io
+import queue
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from humidity import DEFAULT_PRESSURE_KPA, humidity_ratio_list, humidity_ratio_scalar
+from reading_codec import Reading, ReadingError, parse_reading, expand_payload
+from service_common import TokenBucketLimiter, setup_logging
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
 load_dotenv()
 
@@ -24,26 +38,152 @@ APP_HOST = os.getenv('APP_HOST', '0.0.0.0')
 APP_PORT = int(os.getenv('APP_PORT', '5000'))
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 
+# Максимальный размер пакета для /data/batch
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '1000'))
+
+# Кэш недавно принятых puid -> id: повтор от korobochka (ретрай, досинхронизация)
+# отвечается без обращения к Postgres
+PUID_CACHE_SIZE = int(os.getenv('PUID_CACHE_SIZE', '100000'))
+PUID_CACHE_TTL = int(os.getenv('PUID_CACHE_TTL', '3600'))
+
+# Пул соединений с БД
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+
+# Ограничение частоты (token bucket): запросов в секунду и запас на всплеск; 0 — без ограничения.
+# По датчику — только одиночный /data (пакеты korobochka несут досинхронизацию);
+# sensor_id уникален лишь в пределах площадки, поэтому ключ — (IP источника, sensor_id).
+# По IP: все датчики площадки приходят с одного адреса korobochka.
+# По умолчанию оба выключены — прошивки не умеют отступать на 429.
+# Сверх лимита — 429, при исчерпанном пуле БД — сразу 503
+RATE_LIMIT_SENSOR = float(os.getenv('RATE_LIMIT_SENSOR', '0'))
+RATE_LIMIT_SENSOR_BURST = int(os.getenv('RATE_LIMIT_SENSOR_BURST', '10'))
+RATE_LIMIT_IP = float(os.getenv('RATE_LIMIT_IP', '0'))
+RATE_LIMIT_IP_BURST = int(os.getenv('RATE_LIMIT_IP_BURST', '100'))
+
+# Staging-загрузка: показания копятся в памяти, поток-загрузчик раз в
+# STAGING_FLUSH_INTERVAL_MS мс (или по STAGING_MAX_ROWS строк) льёт их COPY в
+# нежурналируемую sensor_readings_staging и переносит в sensor_readings одним
+# INSERT ... SELECT. Ответ синхронный намеренно: он уходит после commit переноса,
+# с id и статусом каждого показания — korobochka по нему закрывает записи outbox.
+# Ожидание ограничено STAGING_WAIT_TIMEOUT — ниже таймаута клиента (FORWARD_TIMEOUT
+# korobochka, 5 с): не дождавшись, отвечаем 503 с Retry-After, и клиент повторяет
+# по тому же puid, а не обрывает соединение сам
+STAGING_LOADER = os.getenv('STAGING_LOADER', 'False').lower() == 'true'
+STAGING_FLUSH_INTERVAL_MS = int(os.getenv('STAGING_FLUSH_INTERVAL_MS', '200'))
+STAGING_MAX_ROWS = int(os.getenv('STAGING_MAX_ROWS', '5000'))
+STAGING_WAIT_TIMEOUT = float(os.getenv('STAGING_WAIT_TIMEOUT', '4'))
+
+# Режим as-of в /api/sensor-readings-by-time: моментов времени за один запрос
+ASOF_MAX_TIMES = int(os.getenv('ASOF_MAX_TIMES', '100'))
+
+# Роллапы 1 мин / 1 ч / 1 сутки (миграция 014): триггер отмечает затронутые
+# минуты в rollup_dirty, фоновый поток пересчитывает их. Поток просыпается по
+# приёму данных, но не чаще раза в ROLLUP_MIN_INTERVAL секунд, и в любом
+# случае раз в ROLLUP_INTERVAL; за проход — не больше ROLLUP_BATCH минут
+ROLLUP_ENABLED = os.getenv('ROLLUP_ENABLED', 'True').lower() == 'true'
+ROLLUP_INTERVAL = int(os.getenv('ROLLUP_INTERVAL', '60'))
+ROLLUP_MIN_INTERVAL = float(os.getenv('ROLLUP_MIN_INTERVAL', '5'))
+ROLLUP_BATCH = int(os.getenv('ROLLUP_BATCH', '5000'))
+# Границы суток в роллапах — по местному времени площадки
+ROLLUP_TZ = ZoneInfo(os.getenv('ROLLUP_TIMEZONE', 'Asia/Novosibirsk'))
+
+# Кэш недельных расписаний: сбрасывается по NOTIFY от front, TTL — страховка
+# на случай потерянного уведомления
+SCHEDULE_CHANNEL = 'settings_changed'
+SCHEDULE_CACHE_TTL = int(os.getenv('SCHEDULE_CACHE_TTL', '3600'))
+
+# === ЛОГИРОВАНИЕ ===
+# Запись в stdout (драйвер логов docker) идёт из отдельного потока через очередь:
+# запросы только кладут запись в очередь и никогда не ждут stdout. Записи с
+# sensor_id ниже WARNING сэмплируются и ограничиваются по частоте на датчик;
+# предупреждения и ошибки пропускаются всегда.
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# В лог попадает каждое LOG_SAMPLE_EVERY-е сообщение датчика (1 — все)
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '1'))
+# Не больше LOG_RATE_PER_SENSOR сообщений в минуту на датчик (0 — без ограничения)
+LOG_RATE_PER_SENSOR = int(os.getenv('LOG_RATE_PER_SENSOR', '30'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Access-лог HTTP-сервера (по строке на запрос); по умолчанию выключен
+LOG_ACCESS = os.getenv('LOG_ACCESS', 'False').lower() == 'true'
+
+
+logger = setup_logging('collector', LOG_LEVEL, LOG_SAMPLE_EVERY, LOG_RATE_PER_SENSOR, LOG_QUEUE_SIZE)
+# Access-лог werkzeug — через ту же очередь
+access_logger = logging.getLogger('werkzeug')
+access_logger.setLevel(logging.INFO if LOG_ACCESS else logging.WARNING)
+for _handler in logger.handlers:
+    access_logger.addHandler(_handler)
+access_logger.propagate = False
+
+# === МЕТРИКИ ===
+# Prometheus-метрики для /metrics: задержки запросов и commit, исходы записи.
+
+REQUEST_SECONDS = Histogram(
+    'collector_request_duration_seconds', 'Время обработки HTTP-запроса', ['route', 'method', 'status']
+)
+DB_COMMIT_SECONDS = Histogram('collector_db_commit_seconds', 'Время commit транзакции записи показаний')
+READINGS_TOTAL = Counter('collector_readings_total', 'Показания по исходу записи', ['result'])
+PUID_CACHE = Counter('collector_puid_cache_total', 'Обращения к кэшу puid', ['result'])
+REQUESTS_SHED = Counter('collector_requests_shed_total', 'Запросы, сброшенные без записи', ['reason'])
+STAGING_FLUSH_ROWS = Histogram(
+    'collector_staging_flush_rows', 'Строк в одном переносе из staging',
+    buckets=(1, 10, 50, 100, 500, 1000, 2500, 5000, 10000)
+)
+ROLLUP_MINUTES = Counter('collector_rollup_minutes_total', 'Пересчитанные минутные бакеты роллапов')
+SCHEDULE_CACHE = Counter('collector_schedule_cache_total', 'Обращения к кэшу расписаний', ['result'])
+BATCH_SIZE = Histogram(
+    'collector_batch_size', 'Размер пакета /data/batch', buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+
 DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-engine = create_engine(DATABASE_URL, pool_size=5, max_overflow=10)
+engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
 Base = declarative_base()
 
 class SensorReading(Base):
     __tablename__ = 'sensor_readings'
-    __table_args__ = (UniqueConstraint('timestamp', 'sensor_id', name='uq_sensor_time'),)
+    # Помесячные партиции по timestamp (миграция 013): ключ партиции входит
+    # во все уникальные индексы, партиции вперёд создаёт планировщик front.
+    # Глобальную уникальность puid держит reading_puids (миграция 016)
+    __table_args__ = (
+        UniqueConstraint('timestamp', 'sensor_id', name='uq_sensor_time'),
+        Index('idx_puid_timestamp', 'puid', 'timestamp', unique=True),
+        Index('idx_sensor_id_timestamp', 'sensor_id', 'timestamp'),
+        Index('idx_sensor_readings_timestamp_brin', 'timestamp', postgresql_using='brin'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
     
-    id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime(timezone=True), nullable=False)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    timestamp = Column(DateTime(timezone=True), primary_key=True, nullable=False)
     sensor_id = Column(Integer, nullable=False)
     temperature = Column(Float)
     humidity = Column(Float)
     humidity_ratio = Column(Float)
     source_ip = Column(String(50))
     destination_ip = Column(String(50))
-    puid = Column(String(20))
+    puid = Column(String(64))
+
+# Буфер COPY-загрузки: без WAL и без индексов, живёт в пределах одной транзакции переноса
+staging_table = Table(
+    'sensor_readings_staging', Base.metadata,
+    Column('seq', Integer),
+    Column('timestamp', DateTime(timezone=True)),
+    Column('sensor_id', Integer),
+    Column('temperature', Float),
+    Column('humidity', Float),
+    Column('humidity_ratio', Float),
+    Column('source_ip', String(50)),
+    Column('destination_ip', String(50)),
+    Column('puid', String(64)),
+    prefixes=['UNLOGGED'],
+)
 
-Base.metadata.create_all(engine)
+# sensor_readings создают и меняют только миграции (001 … 013): create_all на
+# чистой базе создал бы её партиционированной, но без единой партиции, — вставки
+# падали бы, а старые миграции (006, 009, 012) не применились бы
+Base.metadata.create_all(engine, tables=[staging_table])
 Session = sessionmaker(bind=engine)
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
@@ -64,122 +204,875 @@ def utc_to_gmt7(utc_dt: datetime) -> datetime:
         utc_dt = utc_dt.replace(tzinfo=timezone.utc)
     return utc_dt.astimezone(timezone(timedelta(hours=7)))
 
-def calculate_absolute_humidity(T, RH, pressure_kpa=99):
+def calculate_absolute_humidity(T, RH, pressure_kpa=DEFAULT_PRESSURE_KPA):
     """
-    Влажность в г/кг сухого воздуха.
-    Формула Тетенса (Монтейт и Ансуорт, 2008).
-    T: температура, °C
-    RH: относительная влажность, %
-    pressure_kpa: атмосферное давление, кПа (по умолчанию 101.325)
+    Влажность в г/кг сухого воздуха для одного показания.
+    Формула Тетенса — скалярная реализация из humidity.py, без массивов NumPy.
     """
-    if T is None or RH is None:
-        return None
+    return humidity_ratio_scalar(T, RH, pressure_kpa)
+
+def build_reading_values(reading: Reading, timestamp_utc: datetime = None, with_ratio: bool = True) -> dict:
+    """
+    Готовит значения строки sensor_readings из разобранного показания.
+    Время — timestamp показания или текущее, сдвинутое на offset (буфер датчика).
+    with_ratio=False — humidity_ratio посчитает вызывающий (пакетом).
+    Бросает ValueError, если время некорректно.
+    """
+    if timestamp_utc is None:
+        if reading.timestamp:
+            timestamp_utc = parse_iso_to_utc(reading.timestamp)
+        else:
+            timestamp_utc = datetime.now(timezone.utc)
+        if reading.offset is not None:
+            try:
+                timestamp_utc += timedelta(seconds=reading.offset)
+            except OverflowError:
+                raise ValueError("timestamp out of range")
+    return {
+        "timestamp": timestamp_utc,  # <-- Сохраняем в UTC (aware)
+        "sensor_id": reading.sensor_id,
+        "humidity_ratio": calculate_absolute_humidity(reading.temperature, reading.humidity) if with_ratio else None,
+        "temperature": reading.temperature,
+        "humidity": reading.humidity,
+        "source_ip": reading.source_ip,
+        "destination_ip": reading.destination_ip,
+        "puid": reading.puid,
+    }
+
+# === ДУБЛИКАТЫ ===
+
+class PuidCache:
+    """LRU-кэш puid -> (id, timestamp записи) с ограничением по времени жизни записи"""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, puid):
+        """(id, timestamp) записи с этим puid или None, если не встречался или устарел"""
+        if puid is None:
+            return None
+        with self._lock:
+            item = self._items.get(puid)
+            if item is None or time.monotonic() - item[2] > self.ttl:
+                PUID_CACHE.labels(result='miss').inc()
+                return None
+            self._items.move_to_end(puid)
+        PUID_CACHE.labels(result='hit').inc()
+        return item[0], item[1]
+
+    def put(self, puid, record_id, timestamp):
+        if puid is None or record_id is None:
+            return
+        with self._lock:
+            self._items[puid] = (record_id, timestamp, time.monotonic())
+            self._items.move_to_end(puid)
+            if len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+
+puid_cache = PuidCache(PUID_CACHE_SIZE, PUID_CACHE_TTL)
+
+
+# Запросы вставки собираются один раз: SQLAlchemy кэширует их компиляцию, а
+# multi-row .values(rows) компилировался заново на каждый пакет (свой набор
+# параметров на каждый размер пакета)
+INSERT_COLUMNS = [column.name for column in SensorReading.__table__.columns if column.name != 'id']
+
+UPSERT_READING = text(f"""
+    WITH ins AS (
+        INSERT INTO sensor_readings ({", ".join(INSERT_COLUMNS)})
+        VALUES ({", ".join(f":{name}" for name in INSERT_COLUMNS)})
+        ON CONFLICT DO NOTHING
+        RETURNING id, timestamp
+    )
+    SELECT id, true, timestamp FROM ins
+    UNION ALL
+    SELECT reading_id, false, timestamp FROM reading_puids
+    WHERE puid = :puid AND NOT EXISTS (SELECT 1 FROM ins)
+""")
+
+LOOKUP_PUID = text("SELECT reading_id, timestamp FROM reading_puids WHERE puid = :puid")
+
+# executemany: SQLAlchemy сам режет пакет на INSERT ... VALUES страницами (insertmanyvalues)
+INSERT_READINGS = insert(SensorReading.__table__).on_conflict_do_nothing().returning(
+    SensorReading.id, SensorReading.puid, SensorReading.sensor_id, SensorReading.timestamp
+)
+
+
+def upsert_reading(session, values):
+    """
+    Вставка показания одним запросом: (id, True, timestamp) для новой строки,
+    (id, False, timestamp записанной строки) для существующей с тем же puid.
+    Строку с занятым puid пропускает триггер (миграция 016), а тот же запрос
+    возвращает id из reading_puids — без второго обращения к БД, при любом timestamp
+    повтора. Без puid (NULL) вторая ветка ничего не находит.
+    """
+    row = session.execute(UPSERT_READING, values).first()
+    if row is None and values["puid"] is not None:
+        # Тот же puid вставлял параллельный запрос: INSERT дождался его commit,
+        # но CTE видит снимок начала запроса — новый запрос строку уже видит
+        found = session.execute(LOOKUP_PUID, {"puid": values["puid"]}).first()
+        if found is not None:
+            return found[0], False, found[1].astimezone(timezone.utc)
+    # Конфликт по (timestamp, sensor_id) без совпадения puid — id не известен
+    return (row[0], row[1], row[2].astimezone(timezone.utc)) if row else (None, False, values["timestamp"])
+
+
+def lookup_existing(conn, rows, inserted):
+    """
+    puid -> (id, timestamp) уже записанных строк, которые не вставились (дубликаты),
+    одним запросом к reading_puids — повтор может прийти с другим timestamp.
+    """
+    missing = [r["puid"] for r in rows if r["puid"] is not None and r["puid"] not in inserted]
+    if not missing:
+        return {}
+    return {
+        puid: (record_id, timestamp.astimezone(timezone.utc))
+        for puid, record_id, timestamp in conn.execute(
+            text("SELECT puid, reading_id, timestamp FROM reading_puids WHERE puid = ANY(:puids)"),
+            {"puids": missing}
+        )
+    }
+
+
+def match_results(rows, inserted, existing):
+    """
+    (id, вставлена ли, timestamp записанной строки) для каждой строки в исходном порядке.
+    inserted — {puid или (sensor_id, timestamp): id} из RETURNING.
+    """
+    results = []
+    claimed = {}
+    for row in rows:
+        key = row["puid"] if row["puid"] is not None else (row["sensor_id"], row["timestamp"])
+        # pop: повтор того же puid внутри пакета — дубликат с id первой строки
+        record_id = inserted.pop(key, None)
+        if record_id is not None:
+            claimed[key] = (record_id, row["timestamp"])
+            results.append((record_id, True, row["timestamp"]))
+        else:
+            record_id, timestamp = existing.get(row["puid"]) or claimed.get(key) or (None, row["timestamp"])
+            results.append((record_id, False, timestamp))
+    return results
+
+def insert_batch(rows):
+    """Пакет одним INSERT ... ON CONFLICT DO NOTHING; [(id, вставлена ли, timestamp)] в порядке rows"""
+    # ON CONFLICT без index_elements: дубликат по puid или (timestamp, sensor_id)
+    # не должен ронять весь пакет
+    session = Session()
     try:
-        # Давление насыщения, кПа
-        e_s = 0.61078 * math.exp((17.27 * T) / (T + 237.3))
-        # Фактическое давление пара, кПа
-        e = e_s * RH / 100
-        # Массовое отношение, г/кг
-        w = 622 * e / (pressure_kpa - e)
-        return round(w, 2)
-    except:
+        inserted = {
+            puid if puid is not None else (sensor_id, ts): rid
+            for rid, puid, sensor_id, ts in session.execute(INSERT_READINGS, rows)
+        }
+        with DB_COMMIT_SECONDS.time():
+            session.commit()
+        existing = lookup_existing(session, rows, inserted)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    return match_results(rows, inserted, existing)
+
+# === STAGING-ЗАГРУЗКА ===
+# Один поток-загрузчик: COPY пачки в sensor_readings_staging, перенос в
+# sensor_readings с ON CONFLICT DO NOTHING и TRUNCATE буфера — всё в одной
+# транзакции, поэтому строки staging не видны никому и не переживают сбой.
+# Запросы ждут Future со своими результатами по каждому puid.
+
+STAGING_COLUMNS = [column.name for column in staging_table.columns]
+READING_COLUMNS = [name for name in STAGING_COLUMNS if name != 'seq']
+
+MERGE_STAGING = text(f"""
+    INSERT INTO sensor_readings ({", ".join(READING_COLUMNS)})
+    SELECT {", ".join(READING_COLUMNS)} FROM sensor_readings_staging ORDER BY seq
+    ON CONFLICT DO NOTHING
+    RETURNING id, puid, sensor_id, timestamp
+""")
+
+
+def _copy_value(value):
+    """Значение в текстовом формате COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_merge(rows):
+    """COPY строк в staging и перенос одной командой; [(id, вставлена ли, timestamp)] в порядке rows"""
+    buffer = io.StringIO()
+    for seq, row in enumerate(rows):
+        buffer.write('\t'.join(_copy_value(seq if name == 'seq' else row[name]) for name in STAGING_COLUMNS))
+        buffer.write('\n')
+    buffer.seek(0)
+    with engine.connect() as conn:
+        try:
+            cursor = conn.connection.cursor()
+            cursor.copy_expert(f"COPY sensor_readings_staging ({', '.join(STAGING_COLUMNS)}) FROM STDIN", buffer)
+            inserted = {
+                puid if puid is not None else (sensor_id, ts): rid
+                for rid, puid, sensor_id, ts in conn.execute(MERGE_STAGING)
+            }
+            conn.execute(text("TRUNCATE sensor_readings_staging"))
+            existing = lookup_existing(conn, rows, inserted)
+            with DB_COMMIT_SECONDS.time():
+                conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    STAGING_FLUSH_ROWS.observe(len(rows))
+    return match_results(rows, inserted, existing)
+
+
+staging_queue = queue.Queue()
+staging_thread = None
+
+
+def staging_loader():
+    """Поток-загрузчик: копит запросы до интервала или лимита строк и переносит их разом"""
+    while True:
+        batch = [staging_queue.get()]
+        size = len(batch[0][0])
+        flush_at = time.monotonic() + STAGING_FLUSH_INTERVAL_MS / 1000
+        while size < STAGING_MAX_ROWS:
+            remaining = flush_at - time.monotonic()
+            try:
+                item = staging_queue.get(timeout=remaining) if remaining > 0 else staging_queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[0])
+        try:
+            results = copy_merge([row for rows, _ in batch for row in rows])
+            offset = 0
+            for rows, fut in batch:
+                fut.set_result(results[offset:offset + len(rows)])
+                offset += len(rows)
+        except Exception as e:
+            logger.error("❌ Ошибка переноса из staging (%d строк): %s", size, e)
+            for _, fut in batch:
+                fut.set_exception(e)
+
+
+def stage_rows(rows):
+    """
+    Ставит строки в staging-загрузку и ждёт переноса; [(id, вставлена ли, timestamp)]
+    в порядке rows. Не дождавшись за STAGING_WAIT_TIMEOUT — FutureTimeoutError
+    (строки ещё могут записаться: повтор по puid это учтёт)
+    """
+    fut = Future()
+    staging_queue.put((rows, fut))
+    return fut.result(timeout=STAGING_WAIT_TIMEOUT)
+
+
+def start_staging_loader():
+    """Запускает поток-загрузчик, если режим включён"""
+    global staging_thread
+    if not STAGING_LOADER:
+        return
+    staging_thread = threading.Thread(target=staging_loader, name="staging-loader", daemon=True)
+    staging_thread.start()
+
+# === ОГРАНИЧЕНИЕ НАГРУЗКИ ===
+
+sensor_limiter = TokenBucketLimiter(RATE_LIMIT_SENSOR, RATE_LIMIT_SENSOR_BURST)
+ip_limiter = TokenBucketLimiter(RATE_LIMIT_IP, RATE_LIMIT_IP_BURST)
+
+
+def client_ip():
+    """Адрес клиента: за nginx — из X-Real-IP"""
+    return request.headers.get('X-Real-IP') or request.remote_addr
+
+
+def shed_request():
+    """
+    Дешёвая проверка до разбора тела: пул БД и лимит по IP.
+    None — принимаем, иначе готовый ответ 503/429.
+    """
+    if engine.pool.checkedout() >= DB_POOL_SIZE + DB_MAX_OVERFLOW:
+        REQUESTS_SHED.labels(reason='pool').inc()
+        return shed_response(503, "Database busy")
+    if not ip_limiter.allow(client_ip()):
+        REQUESTS_SHED.labels(reason='ip').inc()
+        return shed_response(429, "Rate limit exceeded for source IP")
+    return None
+
+
+def shed_response(status, message):
+    """Ответ на сброшенный запрос; Retry-After подсказывает паузу"""
+    return jsonify({"status": "error", "message": message}), status, {"Retry-After": "1"}
+
+# === РОЛЛАПЫ ===
+# Минута пересчитывается целиком из сырых строк, час — из минут, сутки — из
+# часов, и результат заменяет прежний (ON CONFLICT DO UPDATE). Поэтому
+# поздняя строка или повторный проход дают тот же итог, что и один точный.
+
+ROLLUP_METRICS = ('temperature', 'humidity', 'humidity_ratio')
+ROLLUP_COLUMNS = [f"{m}_{part}" for m in ROLLUP_METRICS for part in ('count', 'sum', 'sumsq', 'min', 'max')]
+
+# Минуты из очереди; SKIP LOCKED — второй экземпляр коллектора не ждёт первый,
+# а пересчёт не забирает минуту, которую сейчас отмечает незакоммиченная вставка
+CLAIM_DIRTY = text("""
+    SELECT sensor_id, bucket, marked_at FROM rollup_dirty
+    ORDER BY bucket
+    LIMIT :limit
+    FOR UPDATE SKIP LOCKED
+""")
+
+# После пересчёта — только отметки не новее прочитанных при захвате (миграция 017)
+RELEASE_DIRTY = text("""
+    DELETE FROM rollup_dirty d
+    USING unnest(
+        CAST(:sensor_ids AS integer[]), CAST(:buckets AS timestamptz[]), CAST(:marked AS timestamptz[])
+    ) AS c(sensor_id, bucket, marked_at)
+    WHERE d.sensor_id = c.sensor_id
+      AND d.bucket = c.bucket
+      AND d.marked_at <= c.marked_at
+""")
+
+
+def _rollup_sql(table, source, time_column, aggregates):
+    """Пересчёт бакетов table по строкам source с time_column в [bucket_start, bucket_end)"""
+    return text(f"""
+        INSERT INTO {table} (sensor_id, bucket, {", ".join(ROLLUP_COLUMNS)})
+        SELECT b.sensor_id, b.bucket_start, {aggregates}
+        FROM unnest(
+            CAST(:sensor_ids AS integer[]), CAST(:starts AS timestamptz[]), CAST(:ends AS timestamptz[])
+        ) AS b(sensor_id, bucket_start, bucket_end)
+        JOIN {source} x ON x.sensor_id = b.sensor_id
+                       AND x.{time_column} >= b.bucket_start
+                       AND x.{time_column} < b.bucket_end
+        GROUP BY b.sensor_id, b.bucket_start
+        ON CONFLICT (sensor_id, bucket) DO UPDATE SET
+            {", ".join(f"{c} = excluded.{c}" for c in ROLLUP_COLUMNS)}
+    """)
+
+
+def _prune_sql(table, source, time_column):
+    """Удаление бакетов table, для которых в source не осталось строк (удалены или перенесены)"""
+    return text(f"""
+        DELETE FROM {table} t
+        USING unnest(
+            CAST(:sensor_ids AS integer[]), CAST(:starts AS timestamptz[]), CAST(:ends AS timestamptz[])
+        ) AS b(sensor_id, bucket_start, bucket_end)
+        WHERE t.sensor_id = b.sensor_id
+          AND t.bucket = b.bucket_start
+          AND NOT EXISTS (
+              SELECT 1 FROM {source} x
+              WHERE x.sensor_id = b.sensor_id
+                AND x.{time_column} >= b.bucket_start
+                AND x.{time_column} < b.bucket_end
+          )
+    """)
+
+
+ROLLUP_1M = _rollup_sql('sensor_readings_1m', 'sensor_readings', 'timestamp', ", ".join(
+    f"count(x.{m}), sum(CAST(x.{m} AS double precision)), "
+    f"sum(CAST(x.{m} AS double precision) * CAST(x.{m} AS double precision)), min(x.{m}), max(x.{m})"
+    for m in ROLLUP_METRICS
+))
+MERGE_AGGREGATES = ", ".join(
+    f"sum(x.{m}_count), sum(x.{m}_sum), sum(x.{m}_sumsq), min(x.{m}_min), max(x.{m}_max)"
+    for m in ROLLUP_METRICS
+)
+ROLLUP_1H = _rollup_sql('sensor_readings_1h', 'sensor_readings_1m', 'bucket', MERGE_AGGREGATES)
+ROLLUP_1D = _rollup_sql('sensor_readings_1d', 'sensor_readings_1h', 'bucket', MERGE_AGGREGATES)
+PRUNE_1M = _prune_sql('sensor_readings_1m', 'sensor_readings', 'timestamp')
+PRUNE_1H = _prune_sql('sensor_readings_1h', 'sensor_readings_1m', 'bucket')
+PRUNE_1D = _prune_sql('sensor_readings_1d', 'sensor_readings_1h', 'bucket')
+
+
+def _bucket_params(buckets):
+    """[(sensor_id, начало, конец)] -> параметры unnest"""
+    return {
+        "sensor_ids": [sensor_id for sensor_id, _, _ in buckets],
+        "starts": [start for _, start, _ in buckets],
+        "ends": [end for _, _, end in buckets],
+    }
+
+
+def refresh_rollups():
+    """Один проход: забирает до ROLLUP_BATCH минут из очереди и пересчитывает их часы и сутки"""
+    with engine.begin() as conn:
+        dirty = conn.execute(CLAIM_DIRTY, {"limit": ROLLUP_BATCH}).fetchall()
+        if not dirty:
+            return 0
+        minutes = sorted({
+            (sensor_id, bucket.astimezone(timezone.utc)) for sensor_id, bucket, _ in dirty
+        })
+        hours = sorted({(sensor_id, bucket.replace(minute=0)) for sensor_id, bucket in minutes})
+        days = sorted({
+            (sensor_id, bucket.astimezone(ROLLUP_TZ).replace(hour=0)) for sensor_id, bucket in hours
+        })
+        # Пересчёт ничего не вставит, если строк бакета больше нет, — такой бакет
+        # удаляется, и следом за ним часы и сутки, собранные из него
+        params = _bucket_params([(s, b, b + timedelta(minutes=1)) for s, b in minutes])
+        conn.execute(PRUNE_1M, params)
+        conn.execute(ROLLUP_1M, params)
+        params = _bucket_params([(s, b, b + timedelta(hours=1)) for s, b in hours])
+        conn.execute(PRUNE_1H, params)
+        conn.execute(ROLLUP_1H, params)
+        # Местные сутки: прибавление дня к aware-времени идёт по календарю зоны
+        params = _bucket_params([(s, b, b + timedelta(days=1)) for s, b in days])
+        conn.execute(PRUNE_1D, params)
+        conn.execute(ROLLUP_1D, params)
+        conn.execute(RELEASE_DIRTY, {
+            "sensor_ids": [sensor_id for sensor_id, _, _ in dirty],
+            "buckets": [bucket for _, bucket, _ in dirty],
+            "marked": [marked_at for _, _, marked_at in dirty],
+        })
+    ROLLUP_MINUTES.inc(len(minutes))
+    return len(dirty)
+
+
+rollup_wakeup = threading.Event()
+
+
+def rollup_worker():
+    """Фоновый пересчёт роллапов; хвост больше ROLLUP_BATCH разбирается проходами подряд"""
+    while True:
+        rollup_wakeup.wait(ROLLUP_INTERVAL)
+        rollup_wakeup.clear()
+        try:
+            while refresh_rollups() >= ROLLUP_BATCH:
+                pass
+        except Exception as e:
+            logger.error("❌ Ошибка пересчёта роллапов: %s", e)
+        time.sleep(ROLLUP_MIN_INTERVAL)
+
+
+def start_rollup_worker():
+    if ROLLUP_ENABLED:
+        threading.Thread(target=rollup_worker, name="rollups", daemon=True).start()
+
+# === РАСПИСАНИЯ ===
+# Расписание датчика (7×24 уставки) читается из БД один раз и отдаётся из памяти
+# с ETag. Front при сохранении /settings шлёт NOTIFY settings_changed с sensor_id,
+# фоновый поток слушает канал и сбрасывает запись. Пока слушатель переподключается,
+# уведомления теряются — после подключения кэш сбрасывается целиком.
+
+def load_schedule(sensor_id):
+    """Матрица 7×24 из settings (день 0=Пн, час по UTC) или None, если настроек нет"""
+    session = Session()
+    try:
+        rows = session.execute(text("""
+            SELECT day_of_week, hour_of_day, humidity, histeresys_up, histeresys_down
+            FROM settings
+            WHERE sensor_id = :sensor_id
+        """), {"sensor_id": sensor_id}).fetchall()
+    finally:
+        session.close()
+    if not rows:
         return None
+    schedule = [[None] * 24 for _ in range(7)]
+    for day, hour, humidity, histeresys_up, histeresys_down in rows:
+        schedule[day][hour] = {
+            "humidity": humidity,
+            "histeresys_up": histeresys_up,
+            "histeresys_down": histeresys_down
+        }
+    return schedule
+
+
+class ScheduleCache:
+    """sensor_id -> (расписание, ETag, момент загрузки)"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._items = {}
+        self._lock = threading.Lock()
+        # Загрузка, начатая до сброса, не должна положить в кэш старое расписание
+        self._generation = 0
+
+    def get(self, sensor_id):
+        """(расписание, ETag) или None, если настроек нет"""
+        with self._lock:
+            item = self._items.get(sensor_id)
+            generation = self._generation
+        if item is not None and time.monotonic() - item[2] < self.ttl:
+            SCHEDULE_CACHE.labels(result='hit').inc()
+            return item[0], item[1]
+        SCHEDULE_CACHE.labels(result='miss').inc()
+        schedule = load_schedule(sensor_id)
+        if schedule is None:
+            return None
+        etag = hashlib.sha1(json.dumps(schedule, sort_keys=True).encode()).hexdigest()
+        with self._lock:
+            if self._generation == generation:
+                self._items[sensor_id] = (schedule, etag, time.monotonic())
+        return schedule, etag
+
+    def invalidate(self, sensor_id=None):
+        """Сбрасывает расписание датчика или (None) все"""
+        with self._lock:
+            self._generation += 1
+            if sensor_id is None:
+                self._items.clear()
+            else:
+                self._items.pop(sensor_id, None)
+
+
+schedule_cache = ScheduleCache(SCHEDULE_CACHE_TTL)
+
+
+def schedule_listener():
+    """LISTEN settings_changed на отдельном соединении; при обрыве — переподключение"""
+    while True:
+        conn = None
+        try:
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.autocommit = True
+            cursor = conn.cursor()
+            cursor.execute(f"LISTEN {SCHEDULE_CHANNEL}")
+            schedule_cache.invalidate()
+            logger.info("🗓️ Подписка на %s", SCHEDULE_CHANNEL)
+            while True:
+                if select_io.select([conn], [], [], 60) == ([], [], []):
+                    # Тишина: проверяем, что соединение живо
+                    cursor.execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    payload = conn.notifies.pop(0).payload
+                    schedule_cache.invalidate(int(payload) if payload.isdigit() else None)
+                    logger.info("🗓️ Расписание изменено: датчик %s", payload or "все")
+        except Exception as e:
+            logger.error("❌ Подписка на %s: %s", SCHEDULE_CHANNEL, e)
+        finally:
+            if conn is not None:
+                conn.close()
+        time.sleep(5)
+
+
+def start_schedule_listener():
+    threading.Thread(target=schedule_listener, name="schedule-listener", daemon=True).start()
 
 # === ЭНДПОИНТЫ ===
 
 @app.route('/data', methods=['POST'])
 def receive_data():
     """Приём данных от датчиков — время сохраняется в UTC"""
+    shed = shed_request()
+    if shed:
+        return shed
     try:
         data = request.get_json()
-        if not isinstance(data, dict):
-            return jsonify({"status": "error", "message": "Invalid JSON format"}), 400
-        
-        # Обработка времени: либо от датчика, либо текущее UTC
-        if 'timestamp' in data and data['timestamp']:
-            # Парсим время от датчика и конвертируем в UTC
-            timestamp_utc = parse_iso_to_utc(data['timestamp'])
-        else:
-            # Генерируем текущее время в UTC
-            timestamp_utc = datetime.now(timezone.utc)
+        # Разбор и проверка за один проход: общий контракт с korobochka
+        reading = parse_reading(data)
+
+        # Время: от датчика (со сдвигом offset) либо текущее, в UTC.
+        # Влагосодержание — после проверки кэша и лимита
+        values = build_reading_values(reading, with_ratio=False)
+        timestamp_utc = values["timestamp"]
         
         # Для логирования — конвертируем в локальное время
         timestamp_local = utc_to_gmt7(timestamp_utc)
-        ip_address = data.get('destination_ip')
-        puid = str(data.get('puid'))
-        
-        print(f"[{timestamp_local}] from sensor ip {ip_address} -> {data}")
-        
-        sensor_id = data.get('sensor_id')
-        if sensor_id is None:
-            return jsonify({"status": "error", "message": "Missing sensor_id"}), 400
-        
-        values = {
-            "timestamp": timestamp_utc,  # <-- Сохраняем в UTC (aware)
-            "sensor_id": int(sensor_id),
-            "humidity_ratio": calculate_absolute_humidity(data['temperature'], data['humidity']),
-            "temperature": float(data['temperature']) if data.get('temperature') is not None else None,
-            "humidity": float(data['humidity']) if data.get('humidity') is not None else None,
-            "source_ip": str(data.get('source_ip')) if data.get('source_ip') is not None else None,
-            "destination_ip": str(data.get('destination_ip')) if data.get('destination_ip') is not None else None,
-            "puid": puid if data.get('puid') is not None else None,
-            
-        }
+        ip_address = reading.destination_ip
+        puid = reading.puid
+        sensor_id = reading.sensor_id
 
-        stmt = insert(SensorReading).values(**values)
-        stmt = stmt.on_conflict_do_nothing(index_elements=['puid']).returning(SensorReading.id)
-        
-        session = Session()
-        try:
-            result = session.execute(stmt)
-            fetched = result.fetchone()
-            session.commit()
-            
-            record_id = fetched[0] if fetched else None
-            if record_id is None:
-                existing = session.execute(
-                    text("SELECT id FROM sensor_readings WHERE puid = :puid"),
-                    {"puid": puid}
-                ).fetchone()
-                record_id = existing[0] if existing else None
-        except Exception as e:
-            session.rollback()
-            print(f"❌ DB Error: {e}")
-            return jsonify({"status": "error", "message": str(e)}), 500
-        finally:
-            session.close()
+        # Повтор уже принятого показания — ответ из кэша, без БД и без лимита
+        cached = puid_cache.get(puid)
+        if cached is not None:
+            READINGS_TOTAL.labels(result='duplicate').inc()
+            # Время — записанной строки, а не этого повтора
+            cached_id, cached_timestamp = cached
+            return jsonify({
+                "status": "ok",
+                "puid": puid,
+                "id": cached_id,
+                "timestamp_utc": cached_timestamp.isoformat(),
+                "timestamp_local": utc_to_gmt7(cached_timestamp).isoformat(),
+                "sensor_id": sensor_id,
+                "inserted": False
+            }), 200
+
+        if not sensor_limiter.allow((client_ip(), sensor_id)):
+            REQUESTS_SHED.labels(reason='sensor').inc()
+            return shed_response(429, f"Rate limit exceeded for sensor {sensor_id}")
+
+        values["humidity_ratio"] = calculate_absolute_humidity(reading.temperature, reading.humidity)
+        logger.info("[%s] from sensor ip %s -> %s", timestamp_local, ip_address, data,
+                    extra={"sensor_id": values["sensor_id"]})
+
+        if staging_thread is not None:
+            try:
+                record_id, inserted, stored_timestamp = stage_rows([values])[0]
+            except FutureTimeoutError:
+                REQUESTS_SHED.labels(reason='staging').inc()
+                return shed_response(503, "Staging loader busy")
+            except Exception as e:
+                logger.error("❌ DB Error: %s", e)
+                return jsonify({"status": "error", "message": str(e)}), 500
+        else:
+            session = Session()
+            try:
+                record_id, inserted, stored_timestamp = upsert_reading(session, values)
+                with DB_COMMIT_SECONDS.time():
+                    session.commit()
+            except Exception as e:
+                session.rollback()
+                logger.error("❌ DB Error: %s", e)
+                return jsonify({"status": "error", "message": str(e)}), 500
+            finally:
+                session.close()
+        READINGS_TOTAL.labels(result='inserted' if inserted else 'duplicate').inc()
+        # Время — записанной строки: повтор мог прийти с другим timestamp
+        puid_cache.put(values["puid"], record_id, stored_timestamp)
+        if inserted:
+            rollup_wakeup.set()
         
         return jsonify({
             "status": "ok",
             "puid": puid,
             "id": record_id,
-            "timestamp_utc": timestamp_utc.isoformat(),  # <-- Возвращаем UTC
-            "timestamp_local": timestamp_local.isoformat(),  # <-- И локальное для удобства
+            "timestamp_utc": stored_timestamp.isoformat(),  # <-- Возвращаем UTC
+            "timestamp_local": utc_to_gmt7(stored_timestamp).isoformat(),  # <-- И локальное для удобства
             "sensor_id": sensor_id,
-            "inserted": fetched is not None
+            "inserted": inserted
         }), 200
         
+    except ReadingError as e:
+        logger.warning("⚠️ Отклонено показание от %s: %s", request.remote_addr, e)
+        return jsonify({"status": "error", "message": str(e)}), 400
     except ValueError as e:
-        print(f"❌ Ошибка валидации: {e}")
+        logger.warning("❌ Ошибка валидации: %s", e)
         return jsonify({"status": "error", "message": f"Invalid data type: {str(e)}"}), 400
     except Exception as e:
-        print(f"❌ Ошибка: {e}")
+        logger.error("❌ Ошибка: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@app.route('/data/batch', methods=['POST'])
+def receive_data_batch():
+    """
+    Пакетный приём показаний (от korobochka): один multi-row upsert и один commit.
+    Тело — список показаний, {"readings": [...]} или колоночный пакет korobochka
+    (reading_codec.expand_payload).
+    Ответ содержит результат по каждому элементу в исходном порядке.
+    """
+    shed = shed_request()
+    if shed:
+        return shed
+    try:
+        data = request.get_json()
+        if isinstance(data, dict) and 'readings' in data:
+            data = data['readings']
+        try:
+            data = expand_payload(data)
+        except ReadingError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        if not isinstance(data, list):
+            return jsonify({"status": "error", "message": "Expected a list of readings"}), 400
+        if len(data) > BATCH_MAX_ITEMS:
+            return jsonify({"status": "error", "message": f"Batch too large (max {BATCH_MAX_ITEMS})"}), 413
+
+        results = [None] * len(data)
+        rows = []
+        row_index = []
+        for i, item in enumerate(data):
+            try:
+                row = build_reading_values(parse_reading(item), with_ratio=False)
+            except ValueError as e:
+                results[i] = {"index": i, "status": "error", "message": str(e)}
+                continue
+            cached = puid_cache.get(row["puid"])
+            if cached is not None:
+                results[i] = {
+                    "index": i,
+                    "status": "duplicate",
+                    "puid": row["puid"],
+                    "id": cached[0],
+                    "sensor_id": row["sensor_id"],
+                    "timestamp_utc": cached[1].isoformat(),
+                }
+                continue
+            rows.append(row)
+            row_index.append(i)
+
+        logger.info("batch: %d items, %d valid", len(data), len(rows))
+
+        # Влагосодержание — одним векторным расчётом на весь пакет
+        ratios = humidity_ratio_list([r["temperature"] for r in rows], [r["humidity"] for r in rows])
+        for row, ratio in zip(rows, ratios):
+            row["humidity_ratio"] = ratio
+
+        if rows:
+            try:
+                if staging_thread is not None:
+                    outcomes = stage_rows(rows)
+                else:
+                    outcomes = insert_batch(rows)
+            except FutureTimeoutError:
+                REQUESTS_SHED.labels(reason='staging').inc()
+                return shed_response(503, "Staging loader busy")
+            except Exception as e:
+                logger.error("❌ DB Error: %s", e)
+                return jsonify({"status": "error", "message": str(e)}), 500
+
+            for i, row, (record_id, was_inserted, stored_timestamp) in zip(row_index, rows, outcomes):
+                puid_cache.put(row["puid"], record_id, stored_timestamp)
+                results[i] = {
+                    "index": i,
+                    "status": "inserted" if was_inserted else "duplicate",
+                    "puid": row["puid"],
+                    "id": record_id,
+                    "sensor_id": row["sensor_id"],
+                    "timestamp_utc": stored_timestamp.isoformat(),
+                }
+
+        counts = {"inserted": 0, "duplicate": 0, "error": 0}
+        for r in results:
+            counts[r["status"]] += 1
+        for result, count in counts.items():
+            if count:
+                READINGS_TOTAL.labels(result=result).inc(count)
+        if counts["inserted"]:
+            rollup_wakeup.set()
+        BATCH_SIZE.observe(len(results))
+
+        return jsonify({
+            "status": "ok",
+            "count": len(results),
+            "inserted": counts["inserted"],
+            "duplicates": counts["duplicate"],
+            "errors": counts["error"],
+            "results": results
+        }), 200
+
+    except Exception as e:
+        logger.error("❌ Ошибка: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+def reading_to_dict(row):
+    """Строка (sensor_id, temperature, humidity, source_ip, destination_ip, puid, timestamp) для фронтенда"""
+    # Конвертируем время из БД (UTC) в GMT+7 для фронтенда
+    ts_local = utc_to_gmt7(row[6]) if row[6] else None
+    return {
+        "sensor_id": row[0],
+        "temperature": row[1],
+        "humidity": row[2],
+        "source_ip": row[3],
+        "destination_ip": row[4],
+        "puid": row[5],
+        "timestamp_utc": row[6].isoformat() if row[6] else None,
+        "timestamp_local": ts_local.isoformat() if ts_local else None,
+        # Позиции для отображения на схеме (заглушки — подставьте свои координаты)
+        "x": 10 + row[0] * 5,  # пример расчёта
+        "y": 20 + row[0] * 3,
+        "description": f"Sensor {row[0]}"
+    }
+
+
+# Список датчиков без полного прохода: рекурсивный «скачок» по индексу
+# (sensor_id, timestamp) — по одному поиску в индексе на датчик
+SENSOR_IDS_CTE = """
+    WITH RECURSIVE sensors AS (
+        (SELECT sensor_id FROM sensor_readings ORDER BY sensor_id LIMIT 1)
+        UNION ALL
+        SELECT (SELECT r.sensor_id FROM sensor_readings r
+                WHERE r.sensor_id > s.sensor_id ORDER BY r.sensor_id LIMIT 1)
+        FROM sensors s
+        WHERE s.sensor_id IS NOT NULL
+    )
+"""
+
+
+def readings_as_of(session, query_times, max_age=None, sensor_ids=None):
+    """
+    Последнее показание каждого датчика не позже каждого из query_times:
+    LATERAL-поиск по индексу (sensor_id, timestamp DESC), ровно одна строка
+    на датчик и момент. max_age (секунды) — не старше этого, иначе датчик
+    в ответ не попадает. Возвращает {момент: [строки]} в порядке query_times.
+    """
+    if sensor_ids:
+        sensors_sql = "WITH sensors AS (SELECT unnest(CAST(:sensor_ids AS integer[])) AS sensor_id)"
+    else:
+        sensors_sql = SENSOR_IDS_CTE
+    # Нижняя граница — условием индекса, а не фильтром: иначе для молчащего
+    # датчика поиск дошёл бы до начала его истории
+    age_sql = "AND r.timestamp >= q.t - make_interval(secs => :max_age)" if max_age is not None else ""
+    result = session.execute(text(f"""
+        {sensors_sql}
+        SELECT q.t, r.sensor_id, r.temperature, r.humidity, r.source_ip, r.destination_ip, r.puid, r.timestamp
+        FROM unnest(CAST(:times AS timestamptz[])) AS q(t)
+        CROSS JOIN sensors s
+        CROSS JOIN LATERAL (
+            SELECT sensor_id, temperature, humidity, source_ip, destination_ip, puid, timestamp
+            FROM sensor_readings r
+            WHERE r.sensor_id = s.sensor_id
+              AND r.timestamp <= q.t
+              {age_sql}
+            ORDER BY r.timestamp DESC
+            LIMIT 1
+        ) r
+        WHERE s.sensor_id IS NOT NULL
+        ORDER BY q.t, r.sensor_id
+    """), {"times": list(dict.fromkeys(query_times)), "max_age": max_age, "sensor_ids": sensor_ids})
+    by_time = {t: [] for t in query_times}
+    for row in result:
+        by_time[row[0]].append(row[1:])
+    return by_time
+
+
+def as_of_response(query_time_utc, rows):
+    """Ответ на один момент времени — в том же виде, что и оконный режим"""
+    sensors = [reading_to_dict(row) for row in rows]
+    for sensor, row in zip(sensors, rows):
+        sensor["age_seconds"] = round((query_time_utc - row[6]).total_seconds(), 3)
+    return {
+        "query_time_utc": query_time_utc.isoformat(),
+        "query_time_local": utc_to_gmt7(query_time_utc).isoformat(),
+        "count": len(sensors),
+        "sensors": sensors
+    }
+
+
 @app.route('/api/sensor-readings-by-time', methods=['GET'])
 def get_sensor_readings_by_time():
     """
     Возвращает данные сенсоров на момент времени.
     Принимает время с таймзоной (например, +07:00), конвертирует в UTC для поиска.
+    mode=window (по умолчанию) — все показания в окне ±30 с.
+    mode=asof — последнее показание каждого датчика не позже time; дополнительно
+    max_age (с), sensor_id (можно несколько) и несколько time за один запрос.
     """
     try:
-        time_str = request.args.get('time')
-        if not time_str:
+        time_args = [t for value in request.args.getlist('time') for t in value.split(',') if t]
+        if not time_args:
             return jsonify({"status": "error", "message": "Missing 'time' parameter"}), 400
-        
+
+        mode = request.args.get('mode', 'window')
+        if mode == 'asof':
+            if len(time_args) > ASOF_MAX_TIMES:
+                return jsonify({"status": "error", "message": f"Too many time values (max {ASOF_MAX_TIMES})"}), 400
+            query_times = [parse_iso_to_utc(t) for t in time_args]
+            max_age = request.args.get('max_age', type=float)
+            sensor_ids = [int(v) for v in request.args.getlist('sensor_id')] or None
+
+            session = Session()
+            try:
+                by_time = readings_as_of(session, query_times, max_age, sensor_ids)
+            finally:
+                session.close()
+
+            if len(query_times) == 1:
+                return jsonify({"status": "ok", **as_of_response(query_times[0], by_time[query_times[0]])}), 200
+            return jsonify({
+                "status": "ok",
+                "results": [as_of_response(t, by_time[t]) for t in query_times]
+            }), 200
+        if mode != 'window':
+            return jsonify({"status": "error", "message": "mode must be 'window' or 'asof'"}), 400
+
         # Конвертируем входное время в UTC для запроса к БД
-        query_time_utc = parse_iso_to_utc(time_str)
+        query_time_utc = parse_iso_to_utc(time_args[0])
         
         # Допуск ±30 секунд для поиска (так как точность до миллисекунд)
         time_window = timedelta(seconds=30)
@@ -195,25 +1088,7 @@ def get_sensor_readings_by_time():
             "end_time": query_time_utc + time_window
         })
         
-        sensors = []
-        for row in result:
-            # Конвертируем время из БД (UTC) в GMT+7 для фронтенда
-            ts_local = utc_to_gmt7(row[6]) if row[6] else None
-            
-            sensors.append({
-                "sensor_id": row[0],
-                "temperature": row[1],
-                "humidity": row[2],
-                "source_ip": row[3],
-                "destination_ip": row[4],
-                "puid": row[5],
-                "timestamp_utc": row[6].isoformat() if row[6] else None,
-                "timestamp_local": ts_local.isoformat() if ts_local else None,
-                # Позиции для отображения на схеме (заглушки — подставьте свои координаты)
-                "x": 10 + row[0] * 5,  # пример расчёта
-                "y": 20 + row[0] * 3,
-                "description": f"Sensor {row[0]}"
-            })
+        sensors = [reading_to_dict(row) for row in result]
         
         session.close()
         
@@ -225,11 +1100,35 @@ def get_sensor_readings_by_time():
             "sensors": sensors
         }), 200
         
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"Invalid parameter: {str(e)}"}), 400
     except Exception as e:
-        print(f"❌ Error fetching readings: {e}")
+        logger.error("❌ Error fetching readings: %s", e)
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+@app.before_request
+def start_request_timer():
+    """Засекает время запроса для метрик"""
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    """Гистограмма задержек по маршруту"""
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.labels(route, request.method, response.status_code).observe(time.perf_counter() - started)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Метрики в формате Prometheus"""
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     try:
@@ -243,43 +1142,64 @@ def health_check():
 
 @app.route('/settings/<int:sensor_id>/<int:hour>', methods=['GET'])
 def get_settings_for_hour(sensor_id, hour):
+    """Уставка на час текущего дня недели (по UTC) из кэша расписаний"""
     try:
         if hour < 0 or hour > 23:
             return jsonify({"status": "error", "message": "Hour must be between 0 and 23"}), 400
 
-        session = Session()
-        result = session.execute(text("""
-            SELECT humidity, histeresys_up, histeresys_down
-            FROM settings
-            WHERE sensor_id = :sensor_id AND hour_of_day = :hour
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """), {"sensor_id": sensor_id, "hour": hour})
-        
-        row = result.fetchone()
-        session.close()
-        
-        if not row:
+        day_of_week = datetime.now(timezone.utc).weekday()
+        cached = schedule_cache.get(sensor_id)
+        setting = cached[0][day_of_week][hour] if cached else None
+        if not setting:
             return jsonify({"status": "error", "message": "No settings found"}), 404
-        
+
         return jsonify({
             "sensor_id": sensor_id,
+            "day_of_week": day_of_week,
             "hour": hour,
-            "humidity": row[0],
-            "histeresys_up": row[1],
-            "histeresys_down": row[2]
+            **setting
         }), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+@app.route('/settings/<int:sensor_id>/schedule', methods=['GET'])
+def get_settings_schedule(sensor_id):
+    """
+    Недельное расписание уставок датчика (для локального контура korobochka):
+    матрица 7×24, день 0=Пн, час по UTC — как в control_humidifier_job.
+    С If-None-Match и неизменившимся расписанием — 304 без тела.
+    """
+    try:
+        cached = schedule_cache.get(sensor_id)
+        if cached is None:
+            return jsonify({"status": "error", "message": "No settings found"}), 404
+
+        schedule, etag = cached
+        response = jsonify({"sensor_id": sensor_id, "schedule": schedule})
+        response.set_etag(etag)
+        # Кэшировать можно, но каждый раз сверяясь по ETag
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
 if __name__ == '__main__':
     print(f"🚀 Запуск сервера на {APP_HOST}:{APP_PORT}")
     print(f"🗄️  База данных: {DB_HOST}:{DB_PORT}/{DB_NAME} (время хранится в UTC)")
+    print(f"📥 Запись: {'COPY через staging' if STAGING_LOADER else 'INSERT ... ON CONFLICT'}")
     print(f"📊 Эндпоинты:")
     print(f"   POST /data - приём данных (время → UTC)")
+    print(f"   POST /data/batch - пакетный приём данных")
     print(f"   GET  /api/sensor-readings-by-time?time=... - запрос по времени (принимает +07:00)")
+    print(f"   GET  /api/sensor-readings-by-time?mode=asof&time=...&max_age=... - последнее на момент")
     print(f"   GET  /health - проверка работоспособности")
+    print(f"   GET  /metrics - метрики Prometheus")
     print(f"   GET  /settings/<sensor_id>/<hour> - настройки")
+    print(f"   GET  /settings/<sensor_id>/schedule - расписание на неделю")
     
+    start_schedule_listener()
+    start_staging_loader()
+    start_rollup_worker()
     app.run(host=APP_HOST, port=APP_PORT, threaded=True, debug=DEBUG)
\ No newline at end of file
@@ -0,0 +1,82 @@
+# backfill_humidity_ratio.py
+# Досчитывает humidity_ratio для старых показаний (до миграции 011 и строк,
+# где его не было). Идёт по id пачками: чтение пачки, векторный расчёт,
+# одно UPDATE ... FROM unnest(...) и commit — длинных блокировок нет,
+# прерванный запуск просто продолжается со следующего.
+#
+#   docker compose run --rm collector python backfill_humidity_ratio.py
+#   docker compose run --rm collector python backfill_humidity_ratio.py --all --chunk-size 20000
+import argparse
+import os
+import time
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+
+from humidity import humidity_ratio_list
+
+load_dotenv()
+
+DB_HOST = os.getenv('DB_HOST', 'db')
+DB_PORT = os.getenv('DB_PORT', '5432')
+DB_NAME = os.getenv('DB_NAME', 'sensor_data')
+DB_USER = os.getenv('DB_USER', 'postgres')
+DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
+
+DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+
+SELECT_CHUNK = """
+    SELECT id, temperature, humidity
+    FROM sensor_readings
+    WHERE id > :last_id
+      AND temperature IS NOT NULL
+      AND humidity IS NOT NULL
+      {only_missing}
+    ORDER BY id
+    LIMIT :limit
+"""
+
+UPDATE_CHUNK = text("""
+    UPDATE sensor_readings AS s
+    SET humidity_ratio = v.humidity_ratio
+    FROM unnest(CAST(:ids AS integer[]), CAST(:ratios AS double precision[])) AS v(id, humidity_ratio)
+    WHERE s.id = v.id
+""")
+
+
+def backfill(engine, chunk_size, pause, recompute_all, start_id):
+    """Проходит таблицу по id пачками; возвращает число обновлённых строк"""
+    select_chunk = text(SELECT_CHUNK.format(only_missing="" if recompute_all else "AND humidity_ratio IS NULL"))
+    last_id = start_id
+    updated = 0
+    started = time.monotonic()
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(select_chunk, {"last_id": last_id, "limit": chunk_size}).fetchall()
+            if not rows:
+                break
+            ids = [row[0] for row in rows]
+            ratios = humidity_ratio_list([row[1] for row in rows], [row[2] for row in rows])
+            pairs = [(i, r) for i, r in zip(ids, ratios) if r is not None]
+            if pairs:
+                conn.execute(UPDATE_CHUNK, {"ids": [i for i, _ in pairs], "ratios": [r for _, r in pairs]})
+        updated += len(pairs)
+        last_id = ids[-1]
+        rate = updated / max(time.monotonic() - started, 1e-6)
+        print(f"🔁 id до {last_id}: обновлено {updated} ({rate:.0f} строк/с)")
+        if pause:
+            time.sleep(pause)
+    return updated
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Досчёт humidity_ratio для старых показаний")
+    parser.add_argument('--chunk-size', type=int, default=5000, help="строк в одной транзакции")
+    parser.add_argument('--pause', type=float, default=0.0, help="пауза между пачками, с")
+    parser.add_argument('--all', action='store_true', help="пересчитать и уже заполненные строки")
+    parser.add_argument('--start-id', type=int, default=0, help="продолжить с id больше этого")
+    args = parser.parse_args()
+
+    print(f"🗄️  База данных: {DB_HOST}:{DB_PORT}/{DB_NAME}")
+    engine = create_engine(DATABASE_URL)
+    total = backfill(engine, args.chunk_size, args.pause, args.all, args.start_id)
+    print(f"✅ Готово, обновлено строк: {total}")
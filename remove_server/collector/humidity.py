@@ -0,0 +1,56 @@
+# humidity.py
+# Влагосодержание (г/кг сухого воздуха) по формуле Тетенса (Монтейт и Ансуорт, 2008).
+# Векторная версия на NumPy считает пакет /data/batch и историю в
+# backfill_humidity_ratio.py; одиночное показание при приёме — скалярная на math:
+# для одного числа массивы NumPy только добавляют накладные расходы.
+import math
+
+import numpy as np
+
+# Давление по умолчанию, кПа — то же, что исторически использовал приём
+DEFAULT_PRESSURE_KPA = 99
+
+
+def humidity_ratio_scalar(temperature, humidity, pressure_kpa=DEFAULT_PRESSURE_KPA):
+    """Одно показание: T (°C), RH (%) -> г/кг, округлённое до 0.01; None, если посчитать нельзя"""
+    if temperature is None or humidity is None:
+        return None
+    try:
+        # Давление насыщения, кПа
+        e_s = 0.61078 * math.exp((17.27 * temperature) / (temperature + 237.3))
+        # Фактическое давление пара, кПа
+        e = e_s * humidity / 100
+        # Массовое отношение, г/кг
+        w = 622 * e / (pressure_kpa - e)
+    except (ArithmeticError, ValueError):
+        return None
+    return round(w, 2) if math.isfinite(w) else None
+
+
+def humidity_ratio(temperature, humidity, pressure_kpa=DEFAULT_PRESSURE_KPA):
+    """
+    Массивы T (°C) и RH (%) -> массив влагосодержания, г/кг, округлённого до 0.01.
+    None/NaN на входе и невозможные значения дают NaN.
+    """
+    t = np.asarray(temperature, dtype=np.float64)
+    rh = np.asarray(humidity, dtype=np.float64)
+    with np.errstate(all='ignore'):
+        # Давление насыщения, кПа
+        e_s = 0.61078 * np.exp((17.27 * t) / (t + 237.3))
+        # Фактическое давление пара, кПа
+        e = e_s * rh / 100
+        # Массовое отношение, г/кг
+        w = 622 * e / (pressure_kpa - e)
+    return np.round(w, 2)
+
+
+def humidity_ratio_list(temperatures, humidities, pressure_kpa=DEFAULT_PRESSURE_KPA):
+    """То же для списков Python: float или None там, где посчитать нельзя"""
+    if not len(temperatures):
+        return []
+    w = humidity_ratio(
+        [np.nan if t is None else t for t in temperatures],
+        [np.nan if h is None else h for h in humidities],
+        pressure_kpa
+    )
+    return [float(x) if np.isfinite(x) else None for x in w]
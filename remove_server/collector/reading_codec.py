@@ -0,0 +1,176 @@
+# reading_codec.py
+# Общий контракт показания для korobochka и коллектора: разбор тела /data и
+# /data/batch, приведение типов и тело пересылки. Korobochka берёт модуль из
+# remove_server/collector, поэтому обе стороны проверяют показания одинаково.
+# Показание разбирается за один проход по полям в компактный Reading (__slots__),
+# без промежуточных словарей на каждое поле.
+#
+#   python reading_codec.py   — микробенчмарки разбора
+
+# puid в обеих схемах — String(64): прошивка шлёт sessionPUID|millis,
+# korobochka без puid генерирует свой (33 символа)
+PUID_MAX_LENGTH = 64
+
+# offset — насколько раньше отправки снято показание из буфера датчика, с.
+# Показаний из будущего и старше 30 суток не бывает: такое значение — мусор,
+# а огромное ещё и переполняет timedelta
+OFFSET_MIN_SECONDS = -30 * 24 * 3600
+OFFSET_MAX_SECONDS = 0
+
+
+class ReadingError(ValueError):
+    """Некорректное показание; сообщение уходит клиенту как есть"""
+
+
+class Reading:
+    """
+    Одно показание после проверки: числа приведены к int/float, строки — к str,
+    отсутствующие поля — None. timestamp — ISO-строка как пришла (часовой пояс
+    каждая сторона толкует сама), offset — секунды относительно момента отправки.
+    """
+
+    __slots__ = ('sensor_id', 'timestamp', 'offset', 'temperature', 'humidity', 'voltage',
+                 'puid', 'source_ip', 'destination_ip')
+
+    def __init__(self, sensor_id, timestamp=None, offset=None, temperature=None, humidity=None,
+                 voltage=None, puid=None, source_ip=None, destination_ip=None):
+        self.sensor_id = sensor_id
+        self.timestamp = timestamp
+        self.offset = offset
+        self.temperature = temperature
+        self.humidity = humidity
+        self.voltage = voltage
+        self.puid = puid
+        self.source_ip = source_ip
+        self.destination_ip = destination_ip
+
+    def to_wire(self):
+        """Тело для пересылки: заданные поля контракта, без None"""
+        wire = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                wire[name] = value
+        return wire
+
+    def __repr__(self):
+        return f"Reading({self.to_wire()!r})"
+
+
+def _number(value, name):
+    """float; NaN и бесконечность не пропускаем — в графиках и роллапах они ломают агрегаты"""
+    try:
+        number = float(value)
+    except TypeError:
+        raise ValueError(f"{name}: expected a number, got {type(value).__name__}")
+    # x - x != 0 только для NaN и бесконечности — дешевле math.isfinite
+    if number - number != 0:
+        raise ValueError(f"{name}: expected a finite number")
+    return number
+
+
+def parse_reading(data):
+    """
+    JSON показания -> Reading. Бросает ReadingError (не JSON-объект, нет sensor_id,
+    длинный puid, offset вне окна) или ValueError (типы).
+    """
+    if not isinstance(data, dict):
+        raise ReadingError("Invalid JSON format")
+    get = data.get
+    sensor_id = get('sensor_id')
+    if sensor_id is None:
+        raise ReadingError("Missing sensor_id")
+    try:
+        sensor_id = int(sensor_id)
+    except TypeError:
+        raise ValueError(f"sensor_id: expected an integer, got {type(sensor_id).__name__}")
+
+    puid = get('puid')
+    if puid is not None:
+        puid = str(puid)
+        if len(puid) > PUID_MAX_LENGTH:
+            raise ReadingError(f"puid too long (max {PUID_MAX_LENGTH})")
+
+    # Отсутствующие поля — без вызовов: в типичном показании offset и IP нет
+    offset = get('offset')
+    if offset is not None:
+        offset = _number(offset, 'offset')
+        if not OFFSET_MIN_SECONDS <= offset <= OFFSET_MAX_SECONDS:
+            raise ReadingError(f"offset out of range ({OFFSET_MIN_SECONDS}..{OFFSET_MAX_SECONDS} s)")
+    temperature = get('temperature')
+    if temperature is not None:
+        temperature = _number(temperature, 'temperature')
+    humidity = get('humidity')
+    if humidity is not None:
+        humidity = _number(humidity, 'humidity')
+    voltage = get('voltage')
+    if voltage is not None:
+        voltage = _number(voltage, 'voltage')
+    source_ip = get('source_ip')
+    if source_ip is not None:
+        source_ip = str(source_ip)
+    destination_ip = get('destination_ip')
+    if destination_ip is not None:
+        destination_ip = str(destination_ip)
+
+    timestamp = get('timestamp') or None
+    if timestamp is not None and not isinstance(timestamp, str):
+        raise ValueError("timestamp: expected an ISO 8601 string")
+
+    return Reading(sensor_id, timestamp, offset, temperature, humidity, voltage,
+                   puid, source_ip, destination_ip)
+
+
+def expand_payload(data):
+    """
+    Разворачивает пакетное тело в список показаний; None — одиночное показание.
+    Форматы пакета:
+      [{"sensor_id": 2, "puid": "...", "offset": -60, ...}, ...]
+      {"sensor_id": 2, "offsets": [-60, 0], "puid": [...], "temperature": [...], "humidity": [...]}
+    В колоночном формате списки — значения по показаниям, скаляры общие для всех.
+    """
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict) and isinstance(data.get('offsets'), list):
+        columns = {('offset' if key == 'offsets' else key): value
+                   for key, value in data.items() if isinstance(value, list)}
+        shared = {key: value for key, value in data.items() if not isinstance(value, list)}
+        count = len(data['offsets'])
+        if any(len(value) != count for value in columns.values()):
+            raise ReadingError("Columnar payload: all columns must have the same length")
+        names = list(columns)
+        return [{**shared, **dict(zip(names, row))} for row in zip(*columns.values())]
+    return None
+
+
+if __name__ == '__main__':
+    import timeit
+
+    single = {"sensor_id": 2, "temperature": 23.4, "humidity": 55.1, "voltage": 3.71,
+              "puid": "a1b2c3d4e5f6a7b8|123456789"}
+    columnar = {"sensor_id": 2, "offsets": list(range(-100, 0)), "puid": [f"a1b2c3d4|{i}" for i in range(100)],
+                "temperature": [23.4] * 100, "humidity": [55.1] * 100}
+    reading = parse_reading(single)
+
+    def legacy(data):
+        # Прежний разбор коллектора (build_reading_values): повторные data.get на каждое поле
+        return {
+            "sensor_id": int(data.get('sensor_id')),
+            "timestamp": data.get('timestamp'),
+            "temperature": float(data.get('temperature')) if data.get('temperature') is not None else None,
+            "humidity": float(data.get('humidity')) if data.get('humidity') is not None else None,
+            "voltage": float(data.get('voltage')) if data.get('voltage') is not None else None,
+            "source_ip": str(data.get('source_ip')) if data.get('source_ip') is not None else None,
+            "destination_ip": str(data.get('destination_ip')) if data.get('destination_ip') is not None else None,
+            "puid": str(data['puid']) if data.get('puid') is not None else None,
+        }
+
+    cases = [
+        ("прежний разбор, одно показание", lambda: legacy(single), 100000),
+        ("parse_reading, одно показание", lambda: parse_reading(single), 100000),
+        ("Reading.to_wire", reading.to_wire, 100000),
+        ("expand_payload + parse_reading, 100 колонкой", lambda: [parse_reading(item) for item in expand_payload(columnar)], 1000),
+    ]
+    for name, func, number in cases:
+        best = min(timeit.repeat(func, number=number, repeat=5))
+        print(f"{name:48s} {best / number * 1e6:8.2f} мкс")
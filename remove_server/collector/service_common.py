@@ -0,0 +1,112 @@
+# service_common.py
+# Общая обвязка сервисов приёма (korobochka и коллектор): логирование через
+# очередь и token bucket для ограничения частоты. Korobochka берёт модуль из
+# remove_server/collector, как и reading_codec. Настройки (LOG_*, RATE_LIMIT_*)
+# каждый сервис читает из своего окружения и передаёт сюда.
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class SensorSamplingFilter(logging.Filter):
+    """Сэмплинг и rate limit сообщений по sensor_id (только ниже WARNING)"""
+
+    def __init__(self, sample_every, rate_per_minute):
+        super().__init__()
+        self.sample_every = max(1, sample_every)
+        self.rate_per_minute = rate_per_minute
+        self._lock = threading.Lock()
+        # sensor_id -> [счётчик сообщений, начало минутного окна, пропущено в окне]
+        self._state = {}
+
+    def filter(self, record):
+        sensor_id = getattr(record, 'sensor_id', None)
+        if record.levelno >= logging.WARNING or sensor_id is None:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(sensor_id)
+            if state is None:
+                state = self._state[sensor_id] = [0, now, 0]
+            state[0] += 1
+            if (state[0] - 1) % self.sample_every:
+                return False
+            if self.rate_per_minute:
+                if now - state[1] >= 60:
+                    state[1] = now
+                    state[2] = 0
+                state[2] += 1
+                if state[2] > self.rate_per_minute:
+                    return False
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполнении очереди отбрасывает запись, а не ждёт"""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Ошибки важнее — для них ждём место, но недолго
+            if record.levelno >= logging.ERROR:
+                try:
+                    self.queue.put(record, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+            NonBlockingQueueHandler.dropped += 1
+
+
+def setup_logging(name, level='INFO', sample_every=1, rate_per_minute=0, queue_size=10000):
+    """Логгер с очередью и фоновым писателем в stdout"""
+    log_queue = queue.Queue(maxsize=queue_size)
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(threadName)s %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stream)
+
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(SensorSamplingFilter(sample_every, rate_per_minute))
+
+    log = logging.getLogger(name)
+    log.setLevel(level)
+    log.addHandler(handler)
+    log.propagate = False
+
+    listener.start()
+    # При выходе дописываем всё, что осталось в очереди
+    atexit.register(listener.stop)
+    return log
+
+
+class TokenBucketLimiter:
+    """Token bucket по ключу; давно не встречавшиеся ключи вытесняются"""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Забирает жетон; False — лимит исчерпан"""
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
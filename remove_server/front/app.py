@@ -12,8 +12,8 @@ import subprocess
 import json
 import os
 from statistics import stdev, mean
-from collections import defaultdict
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import text
 import math
 
 # Global scheduler instance
@@ -25,6 +25,8 @@ app.config.from_object(Config)
 db.init_app(app)
 
 SCREEN_DIR = os.getenv('SCREEN_DIR', '/root/screen')
+# Помесячные партиции sensor_readings создаются заранее на столько месяцев вперёд
+PARTITION_PREMAKE_MONTHS = int(os.getenv('PARTITION_PREMAKE_MONTHS', '3'))
 
 target_tz = ZoneInfo("Asia/Novosibirsk")
 
@@ -104,6 +106,30 @@ def get_sensor_status():
 
 # === Роуты ===
 
+# Роллапы коллектора (миграция 014): средние по бакетам вместо сырых строк
+ROLLUP_TABLES = {'1m': 'sensor_readings_1m', '1h': 'sensor_readings_1h', '1d': 'sensor_readings_1d'}
+
+def rollup_points(resolution, start, end, sensors=None):
+    """Средние значения по бакетам роллапа в [start, end], время бакета — местное"""
+    sensor_filter = "AND sensor_id = ANY(:sensors)" if sensors else ""
+    rows = db.session.execute(text(f"""
+        SELECT sensor_id, bucket,
+               temperature_sum / NULLIF(temperature_count, 0),
+               humidity_sum / NULLIF(humidity_count, 0),
+               humidity_ratio_sum / NULLIF(humidity_ratio_count, 0)
+        FROM {ROLLUP_TABLES[resolution]}
+        WHERE bucket >= :start AND bucket <= :end {sensor_filter}
+        ORDER BY bucket, sensor_id
+    """), {"start": start, "end": end, "sensors": sensors})
+    return [{
+        'id': None,
+        'sensor_id': sensor_id,
+        'timestamp': bucket.astimezone(target_tz).isoformat(),
+        'temperature': temperature,
+        'humidity': humidity,
+        'humidity_ratio': humidity_ratio
+    } for sensor_id, bucket, temperature, humidity, humidity_ratio in rows]
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Страница входа для администратора"""
@@ -239,22 +265,11 @@ def charts():
         SensorReading.timestamp < day_ago
     ).order_by(SensorReading.timestamp).all()
 
-    week_readings = SensorReading.query.filter(
-    SensorReading.timestamp >= week_ago
-    ).order_by(SensorReading.timestamp).all()
-
-    prev_week_readings = SensorReading.query.filter(
-        SensorReading.timestamp >= prev_week_start,
-        SensorReading.timestamp < prev_week_end
-    ).order_by(SensorReading.timestamp).all()
-    
-    month_readings = SensorReading.query.filter(
-        SensorReading.timestamp >= month_ago
-    ).order_by(SensorReading.timestamp).all()
-    
-    year_readings = SensorReading.query.filter(
-        SensorReading.timestamp >= year_ago
-    ).order_by(SensorReading.timestamp).all()
+    # Длинные периоды — из роллапов: часовые и суточные средние
+    week_data = rollup_points('1h', week_ago, now)
+    prev_week_data = rollup_points('1h', prev_week_start, prev_week_end)
+    month_data = rollup_points('1h', month_ago, now)
+    year_data = rollup_points('1d', year_ago, now)
     
     # Преобразуем в словари
     day_data = [{
@@ -273,29 +288,6 @@ def charts():
         'timestamp': r.timestamp.isoformat()
     } for r in prev_day_readings]
 
-    week_data = [{'id': r.id, 'sensor_id': int(r.sensor_id), 'temperature': float(r.temperature), 
-              'humidity': float(r.humidity), 'timestamp': r.timestamp.isoformat()} for r in week_readings]
-
-    prev_week_data = [{'id': r.id, 'sensor_id': int(r.sensor_id), 'temperature': float(r.temperature), 
-                    'humidity': float(r.humidity), 'timestamp': r.timestamp.isoformat()} for r in prev_week_readings]
-
-    
-    month_data = [{
-        'id': r.id,
-        'sensor_id': int(r.sensor_id),
-        'temperature': float(r.temperature),
-        'humidity': float(r.humidity),
-        'timestamp': r.timestamp.isoformat()
-    } for r in month_readings]
-    
-    year_data = [{
-        'id': r.id,
-        'sensor_id': int(r.sensor_id),
-        'temperature': float(r.temperature),
-        'humidity': float(r.humidity),
-        'timestamp': r.timestamp.isoformat()
-    } for r in year_readings]
-    
     sensor_ids = sorted(list(set(r['sensor_id'] for r in day_data + month_data + year_data)))
     locations = {loc.sensor_id: loc.description for loc in SensorLocation.query.all()}
     
@@ -349,54 +341,35 @@ def api_flex_chart_data():
         app.logger.error(f"Date parse error: {e}")
         return jsonify({'error': f'Неверный формат даты: {e}'}), 400
     
-    query = SensorReading.query.filter(
-        SensorReading.timestamp >= start,
-        SensorReading.timestamp <= end
-    )
-    if sensors:
-        query = query.filter(SensorReading.sensor_id.in_(sensors))
-    
-    readings = query.order_by(SensorReading.timestamp).all()
-
-    aggregated = defaultdict(lambda: {
-        'temperatures': [], 
-        'humidities': [], 
-        'humidity_ratios': []  # 👈 новое
-    })
+    # Разрешение по длине периода: до 2 суток — минутные средние, как раньше,
+    # дальше часовые и суточные, чтобы точек было порядка тысяч
+    span = end - start
+    if span <= timedelta(days=2):
+        resolution = '1m'
+    elif span <= timedelta(days=62):
+        resolution = '1h'
+    else:
+        resolution = '1d'
 
-    for r in readings:
-        ts_local = r.timestamp.astimezone(target_tz)
-        ts_normalized = ts_local.replace(second=0, microsecond=0)
-        key = (r.sensor_id, ts_normalized)
-        
-        if r.temperature is not None:
-            aggregated[key]['temperatures'].append(r.temperature)
-        if r.humidity is not None:
-            aggregated[key]['humidities'].append(r.humidity)
-        if r.humidity_ratio is not None:  # 👈 новое
-            aggregated[key]['humidity_ratios'].append(r.humidity_ratio)
-    
-    # Формируем ответ: усредняем значения внутри минуты
     data = []
-    for (sensor_id, ts), values in aggregated.items():
+    for row in rollup_points(resolution, start, end, sensors or None):
         point = {
-            'timestamp': ts.isoformat(),
-            'sensor_id': sensor_id
+            'timestamp': row['timestamp'],
+            'sensor_id': row['sensor_id']
         }
-        if 'temperature' in metrics and values['temperatures']:
-            point['temperature'] = round(sum(values['temperatures']) / len(values['temperatures']), 1)
-        if 'humidity' in metrics and values['humidities']:
-            point['humidity'] = round(sum(values['humidities']) / len(values['humidities']), 1)
-        if 'humidity_ratio' in metrics and values['humidity_ratios']:
-            point['humidity_ratio'] = round(
-            sum(values['humidity_ratios']) / len(values['humidity_ratios']), 2)
+        if 'temperature' in metrics and row['temperature'] is not None:
+            point['temperature'] = round(row['temperature'], 1)
+        if 'humidity' in metrics and row['humidity'] is not None:
+            point['humidity'] = round(row['humidity'], 1)
+        if 'humidity_ratio' in metrics and row['humidity_ratio'] is not None:
+            point['humidity_ratio'] = round(row['humidity_ratio'], 2)
         
         data.append(point)
     
     # Сортируем по времени для корректного отображения
     data.sort(key=lambda x: (x['timestamp'], x['sensor_id']))
     
-    app.logger.info(f"Returned {len(data)} aggregated points")
+    app.logger.info(f"Returned {len(data)} aggregated points ({resolution})")
     return jsonify(data)
 
 @app.route('/sensor-mapping')
@@ -650,6 +623,9 @@ def settings():
                             )
                         )
                         db.session.execute(stmt)
+                # Коллектор сбросит кэш расписания; NOTIFY уходит только вместе с commit
+                db.session.execute(text("SELECT pg_notify('settings_changed', :sensor_id)"),
+                                   {"sensor_id": str(sensor_id)})
             db.session.commit()
             flash('Настройки сохранены', 'success')
         except Exception as e:
@@ -775,6 +751,21 @@ def control_humidifier_job():
             print(f"Error in control_humidifier_job: {e}")
             db.session.rollback()
 
+def create_partitions_job():
+    """Создаёт партиции sensor_readings на текущий и следующие месяцы (миграция 013)"""
+    with app.app_context():
+        try:
+            created = db.session.execute(
+                text("SELECT sensor_readings_premake_partitions(:months)"),
+                {"months": PARTITION_PREMAKE_MONTHS}
+            ).scalar()
+            db.session.commit()
+            if created:
+                print(f"🗂️ Создано партиций sensor_readings: {created}")
+        except Exception as e:
+            print(f"Error in create_partitions_job: {e}")
+            db.session.rollback()
+
 @app.route('/static/<path:filename>')
 def static_files(filename):
     """Serve static files from the static folder"""
@@ -794,6 +785,14 @@ def init_scheduler():
                 id='humidifier_control_job',
                 replace_existing=True
             )
+            scheduler.add_job(
+                func=create_partitions_job,
+                trigger="interval",
+                hours=24,
+                next_run_time=datetime.now(),  # и сразу при старте
+                id='partitions_job',
+                replace_existing=True
+            )
             scheduler.start()
             print("Scheduler started for humidifier control")
 
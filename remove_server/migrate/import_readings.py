@@ -0,0 +1,303 @@
+"""
+Bulk import of historical sensor readings into sensor_readings.
+
+Reads korobochka dumps (plain pg_dump format) or CSV files with a header row,
+optionally gzip-compressed, as a stream. korobochka's sensor_readings is
+partitioned by day, and `pg_dump -t sensor_readings` dumps the empty parent
+only, so dump the partitions with it:
+
+    pg_dump --data-only -t 'sensor_readings*' sensor_data > site2.sql         # PostgreSQL 15
+    pg_dump --data-only --table-and-children=sensor_readings sensor_data ...  # PostgreSQL 16+
+
+Every COPY block of sensor_readings, sensor_readings_pYYYYMMDD and
+sensor_readings_default is read. Other tables matched by the pattern are ignored.
+
+Rows are loaded in chunks: COPY into a temporary table, then one
+INSERT ... SELECT that skips rows already present. A row is a duplicate when
+its puid is already stored, whatever the timestamp: a korobochka dump holds the
+edge's receive time, while readings it forwarded live may carry another one.
+reading_puids (migration 016) enforces this on insert.
+
+Rows without a puid come from korobochka versions that generated the puid only
+when forwarding, so it was never stored locally. The collector stored such
+readings with its own receive time. A puid-less row is therefore skipped when
+the collector already has a row of the same sensor within --legacy-window
+seconds, which means it was receiving that sensor live at the time. Readings
+that were forwarded late, after an outage, cannot be matched. The importer
+prints a warning with the number of puid-less rows it inserted.
+
+Progress is stored per file in the same transaction as each chunk, and an
+interrupted import continues where it stopped.
+
+Usage:
+    python import_readings.py korobochka_site2.sql.gz readings.csv
+    python import_readings.py --chunk-size 100000 --tz-offset 7 dump.sql
+    docker compose run --rm -v /srv/dumps:/dumps migrate python import_readings.py /dumps/site2.sql.gz
+"""
+import argparse
+import csv
+import gzip
+import io
+import itertools
+import os
+import re
+import sys
+import time
+from datetime import datetime, timezone, timedelta
+
+import numpy as np
+
+from migrate import connect_to_db
+
+# humidity.py and reading_codec.py are shared with the collector: next to this
+# file in the image, in ../collector when run from the repository
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'collector'))
+from humidity import humidity_ratio  # noqa: E402
+from reading_codec import parse_reading  # noqa: E402
+
+# Column order of the temporary table and of the COPY stream
+COLUMNS = ['timestamp', 'sensor_id', 'temperature', 'humidity', 'humidity_ratio',
+           'source_ip', 'destination_ip', 'puid']
+
+# Source column names that differ from sensor_readings
+COLUMN_ALIASES = {'ip_address': 'source_ip', 'time': 'timestamp'}
+
+# COPY header of sensor_readings or one of its partitions, schema-qualified or not
+DUMP_TABLE = re.compile(r'COPY (?:"?\w+"?\.)?"?sensor_readings(?:_p\d+|_default)?"? \(')
+
+
+def parse_iso_to_utc(time_str, default_tz_offset=7):
+    """Same rules as the collector: naive timestamps are taken as UTC+default_tz_offset."""
+    dt = datetime.fromisoformat(time_str)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone(timedelta(hours=default_tz_offset)))
+    return dt.astimezone(timezone.utc)
+
+
+def open_text(path):
+    """Open a plain or gzip-compressed text file."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def unescape_copy(value):
+    """Decode one field of the COPY text format."""
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+    return (value.replace('\\\\', '\0').replace('\\t', '\t').replace('\\n', '\n')
+            .replace('\\r', '\r').replace('\0', '\\'))
+
+
+def read_dump(lines):
+    """Yield records from the sensor_readings COPY blocks (parent and partitions) of a pg_dump file."""
+    columns = None
+    skipping = False
+    for line in lines:
+        line = line.rstrip('\n')
+        if columns is None and not skipping:
+            if DUMP_TABLE.match(line):
+                columns = [c.strip().strip('"') for c in line[line.index('(') + 1:line.index(')')].split(',')]
+            elif line.startswith('COPY '):
+                skipping = True
+            continue
+        if line == '\\.':
+            columns = None
+            skipping = False
+            continue
+        if skipping:
+            continue
+        yield dict(zip(columns, (unescape_copy(v) for v in line.split('\t'))))
+
+
+def read_csv(lines):
+    """Yield records from a CSV file with a header row."""
+    for record in csv.DictReader(lines):
+        yield {k: (v if v != '' else None) for k, v in record.items()}
+
+
+def read_records(path, fmt):
+    """Stream records from a file, detecting the format from the first line."""
+    f = open_text(path)
+    first = f.readline()
+    if fmt == 'auto':
+        fmt = 'dump' if first.startswith('--') or first.startswith('COPY ') or first.startswith('SET ') else 'csv'
+    lines = itertools.chain([first], f)
+    try:
+        yield from (read_dump(lines) if fmt == 'dump' else read_csv(lines))
+    finally:
+        f.close()
+
+
+def normalize(record, tz_offset, destination_ip):
+    """Record -> tuple in COLUMNS order (humidity_ratio filled later). Raises ValueError."""
+    # Same type rules as live ingestion in korobochka and the collector
+    reading = parse_reading({COLUMN_ALIASES.get(k, k): v for k, v in record.items()})
+    if not reading.timestamp:
+        raise ValueError("missing timestamp")
+    return (
+        parse_iso_to_utc(reading.timestamp, tz_offset),
+        reading.sensor_id,
+        reading.temperature,
+        reading.humidity,
+        None,
+        reading.source_ip,
+        reading.destination_ip or destination_ip,
+        reading.puid,
+    )
+
+
+def copy_value(value):
+    """Encode one value for the COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def load_chunk(conn, rows, known_months, legacy_window):
+    """
+    COPY one chunk into the temporary table and merge it.
+    Returns (inserted rows, inserted rows without a puid).
+    """
+    # humidity_ratio for the whole chunk in one vectorized call
+    ratios = humidity_ratio(
+        [np.nan if r[2] is None else r[2] for r in rows],
+        [np.nan if r[3] is None else r[3] for r in rows],
+    )
+    buffer = io.StringIO()
+    for row, ratio in zip(rows, ratios):
+        row = row[:4] + (float(ratio) if np.isfinite(ratio) else None,) + row[5:]
+        buffer.write('\t'.join(copy_value(v) for v in row))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cursor = conn.cursor()
+    # Monthly partitions for history (migration 013), otherwise rows land in DEFAULT
+    for month in sorted({r[0].date().replace(day=1) for r in rows} - known_months):
+        cursor.execute("SELECT sensor_readings_create_partition(%s)", (month,))
+        known_months.add(month)
+    cursor.copy_expert(f"COPY import_staging ({', '.join(COLUMNS)}) FROM STDIN", buffer)
+    # Rows with a taken puid are dropped by the reading_puids trigger, repeats
+    # inside the chunk included (the earliest wins). Puid-less rows are matched
+    # by sensor and time: idx_sensor_id_timestamp serves the window lookup
+    cursor.execute(f"""
+        INSERT INTO sensor_readings ({', '.join(COLUMNS)})
+        SELECT {', '.join(COLUMNS)}
+        FROM import_staging st
+        WHERE st.puid IS NOT NULL
+           OR NOT EXISTS (
+               SELECT 1 FROM sensor_readings s
+               WHERE s.sensor_id = st.sensor_id
+                 AND s.timestamp BETWEEN st.timestamp - %(window)s AND st.timestamp + %(window)s
+           )
+        ORDER BY st.timestamp
+        ON CONFLICT DO NOTHING
+        RETURNING puid IS NULL
+    """, {"window": timedelta(seconds=legacy_window)})
+    flags = [legacy for legacy, in cursor.fetchall()]
+    cursor.execute("TRUNCATE import_staging")
+    return len(flags), sum(flags)
+
+
+def import_file(conn, path, args, known_months):
+    """Import one file in chunks, resuming from the stored progress."""
+    source = f"{os.path.basename(path)}:{os.path.getsize(path)}"
+    cursor = conn.cursor()
+    cursor.execute("SELECT rows_done FROM import_progress WHERE source = %s", (source,))
+    row = cursor.fetchone()
+    done = row[0] if row and not args.restart else 0
+    conn.commit()
+    if done:
+        print(f"{path}: resuming after {done} records")
+
+    records = itertools.islice(read_records(path, args.format), done, None)
+    resumed_at = done
+    totals = {"inserted": 0, "duplicates": 0, "invalid": 0, "legacy": 0}
+    started = time.monotonic()
+    while True:
+        chunk = list(itertools.islice(records, args.chunk_size))
+        if not chunk:
+            break
+        rows = []
+        for record in chunk:
+            try:
+                rows.append(normalize(record, args.tz_offset, args.destination_ip))
+            except (ValueError, TypeError, KeyError) as e:
+                totals["invalid"] += 1
+                if totals["invalid"] <= 10:
+                    print(f"  skipping invalid record {record}: {e}")
+        try:
+            inserted, legacy = load_chunk(conn, rows, known_months, args.legacy_window) if rows else (0, 0)
+            done += len(chunk)
+            cursor.execute("""
+                INSERT INTO import_progress (source, rows_done, updated_at)
+                VALUES (%s, %s, CURRENT_TIMESTAMP)
+                ON CONFLICT (source) DO UPDATE SET rows_done = EXCLUDED.rows_done, updated_at = EXCLUDED.updated_at
+            """, (source, done))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        totals["inserted"] += inserted
+        totals["legacy"] += legacy
+        totals["duplicates"] += len(rows) - inserted
+        rate = (done - resumed_at) / max(time.monotonic() - started, 1e-6)
+        print(f"{path}: {done} records, inserted {totals['inserted']}, duplicates {totals['duplicates']}, "
+              f"invalid {totals['invalid']} ({rate:.0f} rows/s)")
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import of historical sensor readings")
+    parser.add_argument('files', nargs='+', help="korobochka dumps or CSV files (.gz allowed)")
+    parser.add_argument('--format', choices=['auto', 'dump', 'csv'], default='auto')
+    parser.add_argument('--chunk-size', type=int, default=50000, help="rows per COPY and transaction")
+    parser.add_argument('--tz-offset', type=int, default=7, help="UTC offset of naive timestamps, hours")
+    parser.add_argument('--destination-ip', help="destination_ip for rows that do not have one")
+    parser.add_argument('--restart', action='store_true', help="ignore stored progress and read files from the start")
+    parser.add_argument('--legacy-window', type=float, default=5,
+                        help="skip a row without puid if the sensor already has a row this many seconds around it")
+    args = parser.parse_args()
+
+    conn = connect_to_db()
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS import_progress (
+            source VARCHAR(255) PRIMARY KEY,
+            rows_done BIGINT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Temporary tables skip WAL, like the collector's unlogged staging table
+    cursor.execute("""
+        CREATE TEMP TABLE import_staging (
+            timestamp TIMESTAMPTZ,
+            sensor_id INTEGER,
+            temperature DOUBLE PRECISION,
+            humidity DOUBLE PRECISION,
+            humidity_ratio DOUBLE PRECISION,
+            source_ip VARCHAR(50),
+            destination_ip VARCHAR(50),
+            puid VARCHAR(64)
+        )
+    """)
+    conn.commit()
+
+    known_months = set()
+    for path in args.files:
+        totals = import_file(conn, path, args, known_months)
+        print(f"{path}: done, inserted {totals['inserted']}, duplicates {totals['duplicates']}, "
+              f"invalid {totals['invalid']}")
+        if totals["legacy"]:
+            print(f"WARNING: {path}: {totals['legacy']} inserted rows have no puid and no collector row "
+                  f"within {args.legacy_window:g} s. If the site forwarded them late (after an outage), "
+                  f"they duplicate live readings under another timestamp.", file=sys.stderr)
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
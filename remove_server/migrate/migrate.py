@@ -3,6 +3,7 @@ import sys
 import psycopg2
 from dotenv import load_dotenv
 import glob
+import re
 
 # Load environment variables
 load_dotenv()
@@ -18,6 +19,20 @@ def connect_to_db():
     )
     return conn
 
+def split_sql(script):
+    """Split a migration into statements on ';', keeping $$-quoted function bodies whole."""
+    commands, current, quote = [], [], None
+    for token in re.split(r"(\$[A-Za-z_]*\$|;)", script):
+        if quote is None and token == ';':
+            commands.append(''.join(current))
+            current = []
+            continue
+        if re.fullmatch(r"\$[A-Za-z_]*\$", token):
+            quote = token if quote is None else (None if token == quote else quote)
+        current.append(token)
+    commands.append(''.join(current))
+    return commands
+
 def apply_migrations():
     """Apply all pending migrations."""
     conn = connect_to_db()
@@ -51,7 +66,7 @@ def apply_migrations():
         
         # Read and execute migration
         with open(migration_file, 'r') as f:
-            sql_commands = f.read().split(';')
+            sql_commands = split_sql(f.read())
             
         for command in sql_commands:
             command = command.strip()
@@ -116,7 +131,7 @@ def rollback_migration(migration_name):
         print(f"Rolling back migration: {migration_name}")
         
         with open(rollback_file, 'r') as f:
-            sql_commands = f.read().split(';')
+            sql_commands = split_sql(f.read())
             
         for command in sql_commands:
             command = command.strip()
@@ -0,0 +1,12 @@
+-- Уникальность puid — опора для ON CONFLICT и ответа на повторы одним запросом.
+-- 006 создавала индекс с IF NOT EXISTS — если он тогда не создался из-за дублей,
+-- сначала убираем повторы (оставляем первую запись), затем создаём индекс
+
+-- 1. Удаляем дубликаты по puid
+DELETE FROM sensor_readings a
+USING sensor_readings b
+WHERE a.puid = b.puid
+  AND a.id > b.id;
+
+-- 2. Уникальный индекс на puid
+CREATE UNIQUE INDEX IF NOT EXISTS idx_puid ON sensor_readings(puid);
@@ -0,0 +1,107 @@
+-- Миграция 013: помесячные партиции sensor_readings (по UTC) и BRIN по timestamp.
+-- Все чтения фронта фильтруют по времени, с партициями запрос за последние
+-- часы трогает только текущий месяц и не растёт вместе с историей.
+-- Ключ партиции обязан входить в уникальные индексы, поэтому
+-- первичный ключ становится (id, timestamp), а уникальность puid — (puid, timestamp)
+-- (повтор из outbox korobochka приходит с тем же timestamp).
+
+-- 1. Партиция на месяц. Строки, успевшие попасть в DEFAULT, переносятся до ATTACH
+CREATE OR REPLACE FUNCTION sensor_readings_create_partition(month_start date)
+RETURNS boolean AS $$
+DECLARE
+    part_name text := 'sensor_readings_p' || to_char(month_start, 'YYYYMM');
+    range_start timestamptz := date_trunc('month', month_start::timestamp) AT TIME ZONE 'UTC';
+    range_end timestamptz := (date_trunc('month', month_start::timestamp) + interval '1 month') AT TIME ZONE 'UTC';
+BEGIN
+    IF to_regclass(part_name) IS NOT NULL THEN
+        RETURN false;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE sensor_readings INCLUDING DEFAULTS)', part_name);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM sensor_readings_default WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+        'INSERT INTO %I SELECT * FROM moved',
+        range_start, range_end, part_name
+    );
+    EXECUTE format(
+        'ALTER TABLE sensor_readings ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        part_name, range_start, range_end
+    );
+    RETURN true;
+END
+$$ LANGUAGE plpgsql;
+
+-- 2. Партиции на текущий месяц и months_ahead вперёд, возвращает число созданных.
+-- Вызывается задачей планировщика во front
+CREATE OR REPLACE FUNCTION sensor_readings_premake_partitions(months_ahead integer DEFAULT 3)
+RETURNS integer AS $$
+DECLARE
+    created integer := 0;
+    month_offset integer;
+BEGIN
+    FOR month_offset IN 0..months_ahead LOOP
+        IF sensor_readings_create_partition(
+            (date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => month_offset))::date
+        ) THEN
+            created := created + 1;
+        END IF;
+    END LOOP;
+    RETURN created;
+END
+$$ LANGUAGE plpgsql;
+
+-- 3. Перевод обычной таблицы на партиции: история раскладывается по месяцам,
+-- в которых есть данные, последовательность id сохраняется
+DO $$
+DECLARE
+    month_start date;
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('sensor_readings')) IS DISTINCT FROM 'r' THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE sensor_readings RENAME TO sensor_readings_legacy;
+    UPDATE sensor_readings_legacy SET timestamp = CURRENT_TIMESTAMP WHERE timestamp IS NULL;
+
+    CREATE TABLE sensor_readings (LIKE sensor_readings_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp);
+    ALTER TABLE sensor_readings ALTER COLUMN timestamp SET NOT NULL;
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY sensor_readings.id',
+                   pg_get_serial_sequence('sensor_readings_legacy', 'id'));
+    CREATE TABLE sensor_readings_default PARTITION OF sensor_readings DEFAULT;
+
+    FOR month_start IN
+        SELECT DISTINCT date_trunc('month', timestamp AT TIME ZONE 'UTC')::date FROM sensor_readings_legacy
+    LOOP
+        PERFORM sensor_readings_create_partition(month_start);
+    END LOOP;
+
+    INSERT INTO sensor_readings SELECT * FROM sensor_readings_legacy;
+    DROP TABLE sensor_readings_legacy;
+
+    -- Индексы строятся после загрузки: так быстрее, чем поддерживать их на каждой вставке
+    ALTER TABLE sensor_readings ADD PRIMARY KEY (id, timestamp);
+    RAISE NOTICE 'sensor_readings переведена на помесячные партиции';
+END
+$$;
+
+CREATE TABLE IF NOT EXISTS sensor_readings_default PARTITION OF sensor_readings DEFAULT;
+
+-- 4. Индексы. Одиночный по sensor_id покрыт составным, по humidity_ratio
+-- ни один запрос не фильтрует
+DROP INDEX IF EXISTS idx_sensor_id;
+DROP INDEX IF EXISTS idx_timestamp;
+DROP INDEX IF EXISTS idx_sensor_readings_humidity_ratio;
+
+-- Защита от дублей (timestamp, sensor_id) и опора ON CONFLICT коллектора
+CREATE UNIQUE INDEX IF NOT EXISTS uq_sensor_time ON sensor_readings (timestamp, sensor_id);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_puid_timestamp ON sensor_readings (puid, timestamp);
+
+-- Последнее показание датчика и выборки по одному датчику (get_sensor_status, графики)
+CREATE INDEX IF NOT EXISTS idx_sensor_id_timestamp ON sensor_readings (sensor_id, timestamp DESC);
+
+-- Диапазоны по времени по всем датчикам: строки пишутся по возрастанию времени,
+-- BRIN на порядки меньше B-tree и почти не стоит на вставке
+CREATE INDEX IF NOT EXISTS idx_sensor_readings_timestamp_brin
+    ON sensor_readings USING brin (timestamp) WITH (pages_per_range = 32);
+
+-- 5. Партиции вперёд
+SELECT sensor_readings_premake_partitions(3);
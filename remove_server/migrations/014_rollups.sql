@@ -0,0 +1,109 @@
+-- Миграция 014: роллапы показаний по минутам, часам и суткам.
+-- На бакет и метрику: число значений, сумма, сумма квадратов, минимум и максимум —
+-- из них собираются среднее и стандартное отклонение любого более крупного интервала.
+-- Сутки — по местному времени (Asia/Novosibirsk), минуты и часы совпадают с UTC.
+-- Роллапы поддерживает коллектор: триггер на sensor_readings отмечает затронутые
+-- минуты в rollup_dirty, фоновая задача пересчитывает их целиком из сырых строк,
+-- а часы и сутки — из минут. Пересчёт, а не прибавление, делает слияние поздних
+-- и повторных строк идемпотентным
+
+-- 1. Таблицы роллапов
+CREATE TABLE IF NOT EXISTS sensor_readings_1m (
+    sensor_id INTEGER NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    temperature_count INTEGER NOT NULL DEFAULT 0,
+    temperature_sum DOUBLE PRECISION,
+    temperature_sumsq DOUBLE PRECISION,
+    temperature_min DOUBLE PRECISION,
+    temperature_max DOUBLE PRECISION,
+    humidity_count INTEGER NOT NULL DEFAULT 0,
+    humidity_sum DOUBLE PRECISION,
+    humidity_sumsq DOUBLE PRECISION,
+    humidity_min DOUBLE PRECISION,
+    humidity_max DOUBLE PRECISION,
+    humidity_ratio_count INTEGER NOT NULL DEFAULT 0,
+    humidity_ratio_sum DOUBLE PRECISION,
+    humidity_ratio_sumsq DOUBLE PRECISION,
+    humidity_ratio_min DOUBLE PRECISION,
+    humidity_ratio_max DOUBLE PRECISION,
+    PRIMARY KEY (sensor_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS sensor_readings_1h (
+    sensor_id INTEGER NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    temperature_count INTEGER NOT NULL DEFAULT 0,
+    temperature_sum DOUBLE PRECISION,
+    temperature_sumsq DOUBLE PRECISION,
+    temperature_min DOUBLE PRECISION,
+    temperature_max DOUBLE PRECISION,
+    humidity_count INTEGER NOT NULL DEFAULT 0,
+    humidity_sum DOUBLE PRECISION,
+    humidity_sumsq DOUBLE PRECISION,
+    humidity_min DOUBLE PRECISION,
+    humidity_max DOUBLE PRECISION,
+    humidity_ratio_count INTEGER NOT NULL DEFAULT 0,
+    humidity_ratio_sum DOUBLE PRECISION,
+    humidity_ratio_sumsq DOUBLE PRECISION,
+    humidity_ratio_min DOUBLE PRECISION,
+    humidity_ratio_max DOUBLE PRECISION,
+    PRIMARY KEY (sensor_id, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS sensor_readings_1d (
+    sensor_id INTEGER NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    temperature_count INTEGER NOT NULL DEFAULT 0,
+    temperature_sum DOUBLE PRECISION,
+    temperature_sumsq DOUBLE PRECISION,
+    temperature_min DOUBLE PRECISION,
+    temperature_max DOUBLE PRECISION,
+    humidity_count INTEGER NOT NULL DEFAULT 0,
+    humidity_sum DOUBLE PRECISION,
+    humidity_sumsq DOUBLE PRECISION,
+    humidity_min DOUBLE PRECISION,
+    humidity_max DOUBLE PRECISION,
+    humidity_ratio_count INTEGER NOT NULL DEFAULT 0,
+    humidity_ratio_sum DOUBLE PRECISION,
+    humidity_ratio_sumsq DOUBLE PRECISION,
+    humidity_ratio_min DOUBLE PRECISION,
+    humidity_ratio_max DOUBLE PRECISION,
+    PRIMARY KEY (sensor_id, bucket)
+);
+
+-- 2. Очередь пересчёта: (датчик, начало минуты)
+CREATE TABLE IF NOT EXISTS rollup_dirty (
+    sensor_id INTEGER NOT NULL,
+    bucket TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (sensor_id, bucket)
+);
+
+-- 3. Отметка минут на любой вставке или правке показаний (коллектор, staging,
+-- бэкфиллы) — в той же транзакции, поэтому ни одна строка не теряется
+CREATE OR REPLACE FUNCTION sensor_readings_mark_rollup()
+RETURNS trigger AS $$
+BEGIN
+    INSERT INTO rollup_dirty (sensor_id, bucket)
+    SELECT DISTINCT sensor_id, date_trunc('minute', timestamp)
+    FROM changed_rows
+    ORDER BY 1, 2
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trg_sensor_readings_rollup_insert
+    AFTER INSERT ON sensor_readings
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sensor_readings_mark_rollup();
+
+CREATE OR REPLACE TRIGGER trg_sensor_readings_rollup_update
+    AFTER UPDATE ON sensor_readings
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sensor_readings_mark_rollup();
+
+-- 4. История: все минуты с данными встают в очередь, коллектор разберёт их пачками
+INSERT INTO rollup_dirty (sensor_id, bucket)
+SELECT DISTINCT sensor_id, date_trunc('minute', timestamp)
+FROM sensor_readings
+ON CONFLICT DO NOTHING;
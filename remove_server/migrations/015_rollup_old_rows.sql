@@ -0,0 +1,27 @@
+-- Миграция 015: роллапы при правке и удалении показаний.
+-- UPDATE, сдвигающий timestamp или sensor_id, уносит строку из старой минуты —
+-- её тоже надо пересчитать, а 014 отмечала только новые значения.
+-- DELETE отмечает минуты удалённых строк: коллектор удалит опустевшие бакеты
+
+CREATE OR REPLACE FUNCTION sensor_readings_mark_rollup_update()
+RETURNS trigger AS $$
+BEGIN
+    INSERT INTO rollup_dirty (sensor_id, bucket)
+    SELECT sensor_id, date_trunc('minute', timestamp) FROM old_rows
+    UNION
+    SELECT sensor_id, date_trunc('minute', timestamp) FROM new_rows
+    ORDER BY 1, 2
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trg_sensor_readings_rollup_update
+    AFTER UPDATE ON sensor_readings
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sensor_readings_mark_rollup_update();
+
+CREATE OR REPLACE TRIGGER trg_sensor_readings_rollup_delete
+    AFTER DELETE ON sensor_readings
+    REFERENCING OLD TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sensor_readings_mark_rollup();
@@ -0,0 +1,70 @@
+-- Миграция 016: puid уникален глобально, а не в паре с timestamp.
+-- После 013 уникален только (puid, timestamp): повтор с тем же puid, но другим
+-- временем (клиент без timestamp, повтор после TTL кэша puid или перезапуска
+-- коллектора) вставлялся второй строкой. Ключ партиции обязан входить в
+-- уникальные индексы sensor_readings, поэтому puid занимается в отдельной
+-- непартиционированной таблице reading_puids — BEFORE-триггером того же INSERT.
+-- Строку с уже занятым puid триггер пропускает, как ON CONFLICT DO NOTHING
+
+-- 1. puid -> записанная строка
+CREATE TABLE IF NOT EXISTS reading_puids (
+    puid VARCHAR(64) PRIMARY KEY,
+    reading_id INTEGER NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL
+);
+
+-- 2. Занять puid при вставке. Строка, которая всё равно не вставится из-за
+-- (timestamp, sensor_id), puid не занимает — иначе он указывал бы на чужую строку.
+-- Та же строка (тот же id) проходит повторно
+CREATE OR REPLACE FUNCTION sensor_readings_claim_puid()
+RETURNS trigger AS $$
+BEGIN
+    IF NEW.puid IS NULL THEN
+        RETURN NEW;
+    END IF;
+    IF EXISTS (
+        SELECT 1 FROM sensor_readings
+        WHERE timestamp = NEW.timestamp AND sensor_id = NEW.sensor_id
+    ) THEN
+        RETURN NEW;
+    END IF;
+    INSERT INTO reading_puids (puid, reading_id, timestamp)
+    VALUES (NEW.puid, NEW.id, NEW.timestamp)
+    ON CONFLICT (puid) DO UPDATE SET timestamp = EXCLUDED.timestamp
+    WHERE reading_puids.reading_id = EXCLUDED.reading_id;
+    IF FOUND THEN
+        RETURN NEW;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trg_sensor_readings_claim_puid
+    BEFORE INSERT ON sensor_readings
+    FOR EACH ROW EXECUTE FUNCTION sensor_readings_claim_puid();
+
+-- 3. Удалённая строка освобождает свой puid
+CREATE OR REPLACE FUNCTION sensor_readings_release_puid()
+RETURNS trigger AS $$
+BEGIN
+    DELETE FROM reading_puids p
+    USING released_rows r
+    WHERE p.puid = r.puid AND p.reading_id = r.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER trg_sensor_readings_release_puid
+    AFTER DELETE ON sensor_readings
+    REFERENCING OLD TABLE AS released_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION sensor_readings_release_puid();
+
+-- 4. История — после триггера: он держит блокировку таблицы до конца миграции,
+-- поэтому ни одна вставка не проскочит между заполнением и триггером.
+-- У повторявшегося puid остаётся первая строка
+INSERT INTO reading_puids (puid, reading_id, timestamp)
+SELECT DISTINCT ON (puid) puid, id, timestamp
+FROM sensor_readings
+WHERE puid IS NOT NULL
+ORDER BY puid, id
+ON CONFLICT (puid) DO NOTHING;
@@ -0,0 +1,39 @@
+-- Миграция 017: отметка в rollup_dirty не теряется в гонке с пересчётом.
+-- Раньше триггер при уже стоящей в очереди минуте делал ON CONFLICT DO NOTHING.
+-- Если коллектор забирал эту минуту до commit вставки, пересчёт не видел новую
+-- строку, а отметки о ней уже не было — роллап оставался устаревшим навсегда.
+-- Теперь повторная отметка обновляет marked_at: строка очереди блокируется до
+-- commit вставки (коллектор с SKIP LOCKED её не заберёт), а коллектор удаляет
+-- из очереди только отметки не новее прочитанных при захвате
+
+ALTER TABLE rollup_dirty ADD COLUMN IF NOT EXISTS marked_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION sensor_readings_mark_rollup()
+RETURNS trigger AS $$
+BEGIN
+    INSERT INTO rollup_dirty (sensor_id, bucket, marked_at)
+    SELECT sensor_id, bucket, clock_timestamp()
+    FROM (
+        SELECT DISTINCT sensor_id, date_trunc('minute', timestamp) AS bucket FROM changed_rows
+    ) changed
+    ORDER BY 1, 2
+    ON CONFLICT (sensor_id, bucket) DO UPDATE SET marked_at = EXCLUDED.marked_at;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION sensor_readings_mark_rollup_update()
+RETURNS trigger AS $$
+BEGIN
+    INSERT INTO rollup_dirty (sensor_id, bucket, marked_at)
+    SELECT sensor_id, bucket, clock_timestamp()
+    FROM (
+        SELECT sensor_id, date_trunc('minute', timestamp) AS bucket FROM old_rows
+        UNION
+        SELECT sensor_id, date_trunc('minute', timestamp) FROM new_rows
+    ) changed
+    ORDER BY 1, 2
+    ON CONFLICT (sensor_id, bucket) DO UPDATE SET marked_at = EXCLUDED.marked_at;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,99 @@
+-- Миграция 018: роллапы истории заполняются сразу.
+-- 014 лишь ставила всю историю в очередь rollup_dirty, и пока коллектор её не
+-- разобрал, графики фронта за прошлые периоды были пустыми. Здесь роллапы
+-- считаются из сырых строк одним проходом на уровень — так же, как пересчёт
+-- коллектора: минута из sensor_readings, час из минут (по UTC), сутки из часов
+-- по местному времени (Asia/Novosibirsk, как ROLLUP_TIMEZONE коллектора).
+-- Вставки во время миграции отмечают минуты как обычно, а оставшаяся очередь
+-- истории только повторно пересчитает уже верные бакеты. На большой истории
+-- миграция идёт долго, запись показаний при этом не блокируется
+
+-- 1. Минуты
+INSERT INTO sensor_readings_1m (
+    sensor_id, bucket,
+    temperature_count, temperature_sum, temperature_sumsq, temperature_min, temperature_max,
+    humidity_count, humidity_sum, humidity_sumsq, humidity_min, humidity_max,
+    humidity_ratio_count, humidity_ratio_sum, humidity_ratio_sumsq, humidity_ratio_min, humidity_ratio_max
+)
+SELECT sensor_id, date_trunc('minute', timestamp),
+       count(temperature), sum(temperature::float8), sum(temperature::float8 * temperature::float8), min(temperature), max(temperature),
+       count(humidity), sum(humidity::float8), sum(humidity::float8 * humidity::float8), min(humidity), max(humidity),
+       count(humidity_ratio), sum(humidity_ratio::float8), sum(humidity_ratio::float8 * humidity_ratio::float8), min(humidity_ratio), max(humidity_ratio)
+FROM sensor_readings
+GROUP BY 1, 2
+ON CONFLICT (sensor_id, bucket) DO UPDATE SET
+    temperature_count = EXCLUDED.temperature_count,
+    temperature_sum = EXCLUDED.temperature_sum,
+    temperature_sumsq = EXCLUDED.temperature_sumsq,
+    temperature_min = EXCLUDED.temperature_min,
+    temperature_max = EXCLUDED.temperature_max,
+    humidity_count = EXCLUDED.humidity_count,
+    humidity_sum = EXCLUDED.humidity_sum,
+    humidity_sumsq = EXCLUDED.humidity_sumsq,
+    humidity_min = EXCLUDED.humidity_min,
+    humidity_max = EXCLUDED.humidity_max,
+    humidity_ratio_count = EXCLUDED.humidity_ratio_count,
+    humidity_ratio_sum = EXCLUDED.humidity_ratio_sum,
+    humidity_ratio_sumsq = EXCLUDED.humidity_ratio_sumsq,
+    humidity_ratio_min = EXCLUDED.humidity_ratio_min,
+    humidity_ratio_max = EXCLUDED.humidity_ratio_max;
+
+-- 2. Часы
+INSERT INTO sensor_readings_1h (
+    sensor_id, bucket,
+    temperature_count, temperature_sum, temperature_sumsq, temperature_min, temperature_max,
+    humidity_count, humidity_sum, humidity_sumsq, humidity_min, humidity_max,
+    humidity_ratio_count, humidity_ratio_sum, humidity_ratio_sumsq, humidity_ratio_min, humidity_ratio_max
+)
+SELECT sensor_id, date_trunc('hour', bucket AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+       sum(temperature_count), sum(temperature_sum), sum(temperature_sumsq), min(temperature_min), max(temperature_max),
+       sum(humidity_count), sum(humidity_sum), sum(humidity_sumsq), min(humidity_min), max(humidity_max),
+       sum(humidity_ratio_count), sum(humidity_ratio_sum), sum(humidity_ratio_sumsq), min(humidity_ratio_min), max(humidity_ratio_max)
+FROM sensor_readings_1m
+GROUP BY 1, 2
+ON CONFLICT (sensor_id, bucket) DO UPDATE SET
+    temperature_count = EXCLUDED.temperature_count,
+    temperature_sum = EXCLUDED.temperature_sum,
+    temperature_sumsq = EXCLUDED.temperature_sumsq,
+    temperature_min = EXCLUDED.temperature_min,
+    temperature_max = EXCLUDED.temperature_max,
+    humidity_count = EXCLUDED.humidity_count,
+    humidity_sum = EXCLUDED.humidity_sum,
+    humidity_sumsq = EXCLUDED.humidity_sumsq,
+    humidity_min = EXCLUDED.humidity_min,
+    humidity_max = EXCLUDED.humidity_max,
+    humidity_ratio_count = EXCLUDED.humidity_ratio_count,
+    humidity_ratio_sum = EXCLUDED.humidity_ratio_sum,
+    humidity_ratio_sumsq = EXCLUDED.humidity_ratio_sumsq,
+    humidity_ratio_min = EXCLUDED.humidity_ratio_min,
+    humidity_ratio_max = EXCLUDED.humidity_ratio_max;
+
+-- 3. Сутки
+INSERT INTO sensor_readings_1d (
+    sensor_id, bucket,
+    temperature_count, temperature_sum, temperature_sumsq, temperature_min, temperature_max,
+    humidity_count, humidity_sum, humidity_sumsq, humidity_min, humidity_max,
+    humidity_ratio_count, humidity_ratio_sum, humidity_ratio_sumsq, humidity_ratio_min, humidity_ratio_max
+)
+SELECT sensor_id, date_trunc('day', bucket AT TIME ZONE 'Asia/Novosibirsk') AT TIME ZONE 'Asia/Novosibirsk',
+       sum(temperature_count), sum(temperature_sum), sum(temperature_sumsq), min(temperature_min), max(temperature_max),
+       sum(humidity_count), sum(humidity_sum), sum(humidity_sumsq), min(humidity_min), max(humidity_max),
+       sum(humidity_ratio_count), sum(humidity_ratio_sum), sum(humidity_ratio_sumsq), min(humidity_ratio_min), max(humidity_ratio_max)
+FROM sensor_readings_1h
+GROUP BY 1, 2
+ON CONFLICT (sensor_id, bucket) DO UPDATE SET
+    temperature_count = EXCLUDED.temperature_count,
+    temperature_sum = EXCLUDED.temperature_sum,
+    temperature_sumsq = EXCLUDED.temperature_sumsq,
+    temperature_min = EXCLUDED.temperature_min,
+    temperature_max = EXCLUDED.temperature_max,
+    humidity_count = EXCLUDED.humidity_count,
+    humidity_sum = EXCLUDED.humidity_sum,
+    humidity_sumsq = EXCLUDED.humidity_sumsq,
+    humidity_min = EXCLUDED.humidity_min,
+    humidity_max = EXCLUDED.humidity_max,
+    humidity_ratio_count = EXCLUDED.humidity_ratio_count,
+    humidity_ratio_sum = EXCLUDED.humidity_ratio_sum,
+    humidity_ratio_sumsq = EXCLUDED.humidity_ratio_sumsq,
+    humidity_ratio_min = EXCLUDED.humidity_ratio_min,
+    humidity_ratio_max = EXCLUDED.humidity_ratio_max;